@@ -0,0 +1,72 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import ast
+import json
+import argparse
+
+
+# The C# corpus as JSON lines, {"problem_id": "CS0022-3@1", "code": "..."},
+# read one program at a time. Convert data/cs-data-dict (a Python dict
+# literal) with
+#
+#   python data_processing/cs_corpus.py
+#
+# The lines are written in the iteration order of that dict, so the
+# generators see the problems in the same order as when they eval'd it.
+
+CS_DICT_FILE = 'data/cs-data-dict'
+CS_CORPUS = 'data/cs-data.jsonl'
+
+
+def convert_dict_file(source=CS_DICT_FILE, destination=CS_CORPUS):
+    with open(source) as f:
+        programs = ast.literal_eval(f.read())
+
+    with open(destination + '.tmp', 'w') as f:
+        for problem_id, code in programs.items():
+            f.write(json.dumps({'problem_id': problem_id, 'code': code}) + '\n')
+    os.rename(destination + '.tmp', destination)
+
+    return len(programs)
+
+
+def iter_cs_programs(path=CS_CORPUS, problem_ids=None):
+    '''Yields (problem_id, code) of the corpus in [path], optionally only those in [problem_ids].'''
+    assert os.path.exists(path), '{} not found, create it with data_processing/cs_corpus.py'.format(path)
+
+    if problem_ids is not None:
+        problem_ids = set(problem_ids)
+
+    with open(path) as f:
+        for line in f:
+            program = json.loads(line)
+            problem_id = program['problem_id'].encode('utf-8')
+            if problem_ids is None or problem_id in problem_ids:
+                yield problem_id, program['code'].encode('utf-8')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Convert the C# corpus from a dict literal to JSON lines")
+    parser.add_argument('source', nargs='?', default=CS_DICT_FILE)
+    parser.add_argument('destination', nargs='?', default=CS_CORPUS)
+    args = parser.parse_args()
+
+    print 'programs:', convert_dict_file(args.source, args.destination)
+    print 'written to', args.destination
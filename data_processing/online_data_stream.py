@@ -0,0 +1,182 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import Queue
+import traceback
+import multiprocessing
+import numpy as np
+from functools import partial
+
+from data_processing.training_data_generator_cs import get_cs_tokenized, rename_ids_, vectorize, \
+    FixIDNotFoundInSource
+from util.helpers import line_fix_to_edit_fix, get_fix_kind
+
+
+# Same limits as the offline generator in training_data_generator_cs.py
+max_program_length = 450
+min_program_length = 75
+max_fix_length = 25
+max_mutations = 5
+
+
+class MutationWorkerException(Exception):
+    pass
+
+
+def mutation_worker(queue, *args):
+    '''Runs _mutation_worker(), passing what kills it through [queue] to the trainer.'''
+    try:
+        _mutation_worker(queue, *args)
+    except Exception:
+        queue.put(MutationWorkerException(traceback.format_exc()))
+        raise
+
+
+def _mutation_worker(queue, tokenized_programs, tl_dict, kind_mutations, variants_per_program, seed, fix_kind='replace'):
+    '''Endlessly picks a training program, mutates it and puts the vectorized
+    (program, fix) pairs of all its variants on [queue] as one list.'''
+    rng = np.random.RandomState(seed)
+    drop_ids = kind_mutations == 'typo'
+
+    if kind_mutations == 'typo':
+        from data_processing.typo_mutator import LoopCountThresholdExceededException, FailedToMutateException, Typo_Mutate, typo_mutate
+        mutate = partial(typo_mutate, Typo_Mutate(rng))
+        def rename_ids(x, y): return x, y
+    else:
+        from data_processing.undeclared_mutator_cs import LoopCountThresholdExceededException, FailedToMutateException, id_mutate
+        mutate = partial(id_mutate, rng)
+        rename_ids = partial(rename_ids_, rng)
+
+    def vectorize_pair(program, fix):
+        try:
+            prog_vector = vectorize(program, tl_dict, max_program_length, drop_ids, reverse=True, vecFor='encoder')
+            fix_vector = vectorize(fix, tl_dict, max_fix_length, drop_ids, reverse=False, vecFor='decoder')
+        except KeyError:
+            # The dictionary is fixed by the offline data, skip pairs with unseen tokens
+            return None
+
+        if prog_vector is None or fix_vector is None:
+            return None
+        return prog_vector, fix_vector
+
+    while True:
+        tokenized_code = tokenized_programs[rng.randint(len(tokenized_programs))]
+        pairs = []
+
+        # Correct pair, as in generate_training_data()
+        pairs.append(vectorize_pair(rename_ids(tokenized_code, '')[0], '-1'))
+
+        try:
+            iterator = mutate(tokenized_code, max_mutations, variants_per_program)
+        except (FailedToMutateException, LoopCountThresholdExceededException):
+            iterator = []
+        except Exception:
+            if kind_mutations == 'typo':
+                raise
+            iterator = []
+
+        for corrupt_program, fix in iterator:
+            if fix_kind == 'edit':
+                fix = line_fix_to_edit_fix(corrupt_program, fix)
+            if (min_program_length <= len(corrupt_program.split()) <= max_program_length
+                    and len(fix.split()) <= max_fix_length):
+                try:
+                    corrupt_program, fix = rename_ids(corrupt_program, fix)
+                except FixIDNotFoundInSource:
+                    continue
+                pairs.append(vectorize_pair(corrupt_program, fix))
+
+        queue.put([pair for pair in pairs if pair is not None])
+
+
+class online_data_stream:
+    '''Fresh training pairs for train.py --online_mutation, mutated on the fly
+    from the training problems of a bin by [num_workers] processes.
+
+    Pairs are drawn at random from a shuffle buffer, so that a batch mixes
+    variants of many programs instead of the variants of one.'''
+
+    def __init__(self, data_directory, kind_mutations, tl_dict, num_workers=4, queue_size=64,
+                 variants_per_program=8, shuffle_buffer_size=10000, seed=1189, poll_interval=10):
+        problem_ids_file = os.path.join(data_directory, 'problem-ids.npy')
+        assert os.path.exists(problem_ids_file), \
+            '{} not found, regenerate the data with training_data_generator_cs.py'.format(problem_ids_file)
+
+        problem_ids = np.load(problem_ids_file, allow_pickle=True).item()
+        tokenized_code = get_cs_tokenized(problem_ids['train'])
+        tokenized_programs = [tokenized_code[problem_id] for problem_id in problem_ids['train']]
+
+        self.rng = np.random.RandomState(seed)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.poll_interval = poll_interval
+        self.buffer = []
+
+        self.queue = multiprocessing.Queue(maxsize=queue_size)
+        self.workers = [multiprocessing.Process(target=mutation_worker,
+                                                args=(self.queue, tokenized_programs, tl_dict, kind_mutations,
+                                                      variants_per_program, seed + 1 + i,
+                                                      get_fix_kind(data_directory, kind_mutations)))
+                        for i in range(num_workers)]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+        print 'Started {} mutation workers on {} training programs'.format(num_workers, len(tokenized_programs))
+
+    def _get(self):
+        '''The next list of pairs, raising MutationWorkerException instead of waiting
+        forever once a worker has failed.'''
+        while True:
+            try:
+                pairs = self.queue.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if dead:
+                    raise MutationWorkerException('mutation worker(s) exited with code(s) {}'.format(
+                        ', '.join(str(worker.exitcode) for worker in dead)))
+                continue
+
+            if isinstance(pairs, MutationWorkerException):
+                raise pairs
+            return pairs
+
+    def _fill_buffer(self, minimum):
+        while len(self.buffer) < minimum:
+            self.buffer += self._get()
+
+        # Top up without blocking
+        while len(self.buffer) < self.shuffle_buffer_size and not self.queue.empty():
+            self.buffer += self._get()
+
+    def get_examples(self, count):
+        self._fill_buffer(max(count, min(self.shuffle_buffer_size, 2 * count)))
+
+        examples = []
+        for _ in range(count):
+            k = self.rng.randint(len(self.buffer))
+            self.buffer[k], self.buffer[-1] = self.buffer[-1], self.buffer[k]
+            examples.append(self.buffer.pop())
+
+        return examples
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
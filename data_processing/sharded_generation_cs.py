@@ -0,0 +1,262 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import argparse
+import numpy as np
+
+from data_processing.training_data_generator_cs import get_cs_problem_ids, generation_limits, \
+    generate_training_data, build_dictionary, vectorize_data, save_dictionaries, load_dictionaries, \
+    save_pairs, assign_folds
+from util.helpers import make_dir_if_not_exists
+
+
+# training_data_generator_cs.py split across machines sharing OUTPUT_DIRECTORY:
+#
+#   python data_processing/sharded_generation_cs.py plan OUTPUT_DIRECTORY -n 8
+#   python data_processing/sharded_generation_cs.py work OUTPUT_DIRECTORY 0      # ... up to 7, anywhere
+#   python data_processing/sharded_generation_cs.py merge OUTPUT_DIRECTORY
+#
+# Every shard mutates its problems with a random stream per problem (as with
+# --workers), so the pairs do not depend on the number of shards, and vectorizes
+# them with a dictionary of its own. The shards keep the problems in corpus
+# order, so that merge() assigns the same folds as my_save_bins(). merge()
+# builds the global dictionary from the shard dictionaries, renumbers the
+# vectors and writes bin_0 ... bin_4 one split at a time: at most one shard and
+# one split, as int32 arrays, are in memory.
+
+
+class ShardNotGeneratedException(Exception):
+    pass
+
+
+def manifest_path(output_directory):
+    return os.path.join(output_directory, 'shard-manifest.npy')
+
+
+def shard_directory(output_directory, shard):
+    return os.path.join(output_directory, 'shards', 'shard_%d' % shard)
+
+
+def load_manifest(output_directory):
+    return np.load(manifest_path(output_directory), allow_pickle=True).item()
+
+
+def plan(output_directory, shard_count, kind_mutations, seed, edit_targets, array_mutator,
+         duplicate_window=None, duplicate_threshold=None):
+    # In corpus order, which my_save_bins() shuffles into folds
+    full_list = get_cs_problem_ids()
+    shards = [full_list[len(full_list)*i//shard_count:len(full_list)*(i+1)//shard_count]
+              for i in range(shard_count)]
+
+    manifest = {'kind_mutations': kind_mutations, 'seed': seed, 'edit_targets': edit_targets,
+                'array_mutator': array_mutator, 'limits': generation_limits(kind_mutations), 'shards': shards,
+                'duplicate_window': duplicate_window, 'duplicate_threshold': duplicate_threshold}
+
+    make_dir_if_not_exists(output_directory)
+    np.save(manifest_path(output_directory), manifest)
+
+    for i, shard in enumerate(shards):
+        print 'shard {}: {} problems'.format(i, len(shard))
+    return manifest
+
+
+def work(output_directory, shard, workers):
+    manifest = load_manifest(output_directory)
+    kind_mutations = manifest['kind_mutations']
+    min_program_length, max_program_length, max_fix_length, max_mutations, max_variants = manifest['limits']
+    drop_ids = kind_mutations == 'typo'
+
+    # The random stream of each problem only depends on (seed, problem id) with workers > 0
+    token_strings, mutations_distribution, _, variant_yield = generate_training_data(
+        None, min_program_length, max_program_length, max_fix_length, kind_mutations, max_mutations, max_variants,
+        manifest['seed'], edit_targets=manifest['edit_targets'], array_mutator=manifest['array_mutator'],
+        workers=max(workers, 1), problem_ids=manifest['shards'][shard],
+        duplicate_window=manifest.get('duplicate_window'), duplicate_threshold=manifest.get('duplicate_threshold'))
+
+    tl_dict = build_dictionary(token_strings, drop_ids, tl_dict={})
+    token_vectors = vectorize_data(token_strings, tl_dict, max_program_length, max_fix_length, drop_ids)
+
+    destination = shard_directory(output_directory, shard)
+    make_dir_if_not_exists(destination)
+    save_dictionaries(destination, tl_dict)
+    np.save(os.path.join(destination, 'error-seeding-distribution.npy'), mutations_distribution)
+    np.save(os.path.join(destination, 'variant-yield.npy'), variant_yield)
+    # Written last: its presence marks the shard as done
+    np.save(os.path.join(destination, 'examples.npy'), token_vectors['train'])
+
+
+def shard_examples_path(output_directory, shard):
+    path = os.path.join(shard_directory(output_directory, shard), 'examples.npy')
+    if not os.path.exists(path):
+        raise ShardNotGeneratedException(path)
+    return path
+
+
+def load_shard(output_directory, shard):
+    return np.load(shard_examples_path(output_directory, shard), allow_pickle=True).item()
+
+
+def merge_dictionaries(output_directory, shard_count, drop_ids):
+    '''The global dictionary, and for each shard an array mapping its token ids to global ones.'''
+    # The reserved tokens of build_dictionary()
+    tl_dict = {'_pad_': 0, '_eos_': 1, '~': 2}
+    if drop_ids:
+        tl_dict['_<id>_@'] = 3
+
+    remaps = []
+    for shard in range(shard_count):
+        shard_tl_dict, shard_rev_tl_dict = load_dictionaries(shard_directory(output_directory, shard))
+        remap = np.zeros(len(shard_tl_dict), dtype=np.int64)
+        for token_id in range(len(shard_tl_dict)):
+            token = shard_rev_tl_dict[token_id]
+            if token not in tl_dict:
+                tl_dict[token] = len(tl_dict)
+            remap[token_id] = tl_dict[token]
+        remaps.append(remap)
+
+    print 'dictionary size:', len(tl_dict)
+    return tl_dict, remaps
+
+
+def example_counts(output_directory, shard_count):
+    '''{problem id: number of examples}, reading one shard at a time.'''
+    counts = {}
+    for shard in range(shard_count):
+        token_vectors = load_shard(output_directory, shard)
+        for problem_id, pairs in token_vectors.items():
+            counts[problem_id] = len(pairs)
+        del token_vectors
+    return counts
+
+
+def merge_split(output_directory, problem_ids, shard_of, remaps, counts):
+    '''The examples of [problem_ids], in that order, renumbered into the global
+    dictionary: an (examples, 2) object array of int32 vectors, as load_data
+    reads it, filled in place one shard at a time.'''
+    offsets, total = {}, 0
+    for problem_id in problem_ids:
+        offsets[problem_id] = total
+        total += counts.get(problem_id, 0)
+
+    examples = np.empty((total, 2), dtype=object)
+    for shard in sorted(set(shard_of[problem_id] for problem_id in problem_ids)):
+        token_vectors = load_shard(output_directory, shard)
+        remap = remaps[shard]
+        for problem_id in set(offsets).intersection(token_vectors):
+            for k, (prog_vector, fix_vector) in enumerate(token_vectors[problem_id], offsets[problem_id]):
+                examples[k, 0] = remap[prog_vector].astype(np.int32)
+                examples[k, 1] = remap[fix_vector].astype(np.int32)
+        del token_vectors
+
+    return examples
+
+
+def merge(output_directory):
+    manifest = load_manifest(output_directory)
+    shards = manifest['shards']
+    drop_ids = manifest['kind_mutations'] == 'typo'
+
+    shard_of = {}
+    for shard, problem_ids in enumerate(shards):
+        for problem_id in problem_ids:
+            shard_of[problem_id] = shard
+
+    for shard in range(len(shards)):
+        shard_examples_path(output_directory, shard)
+
+    tl_dict, remaps = merge_dictionaries(output_directory, len(shards), drop_ids)
+    counts = example_counts(output_directory, len(shards))
+
+    mutations_distribution = {}
+    for shard in range(len(shards)):
+        shard_distribution = np.load(os.path.join(shard_directory(output_directory, shard),
+                                                  'error-seeding-distribution.npy'), allow_pickle=True).item()
+        for action, count in shard_distribution.items():
+            mutations_distribution[action] = mutations_distribution.get(action, 0) + count
+    np.save(os.path.join(output_directory, 'error-seeding-distribution.npy'), mutations_distribution)
+
+    variant_yield = {}
+    for shard in range(len(shards)):
+        variant_yield.update(np.load(os.path.join(shard_directory(output_directory, shard), 'variant-yield.npy'),
+                                     allow_pickle=True).item())
+    np.save(os.path.join(output_directory, 'variant-yield.npy'), variant_yield)
+
+    # As generate_training_data() leaves it for my_save_bins() with workers > 0
+    rng = np.random.RandomState(manifest['seed'])
+    all_problem_ids = [problem_id for problem_ids in shards for problem_id in problem_ids]
+
+    for i, problem_ids_this_fold in enumerate(assign_folds(all_problem_ids, rng)):
+        destination = os.path.join(output_directory, 'bin_{}'.format(i))
+        make_dir_if_not_exists(destination)
+        split_sizes = {}
+
+        for key in ['train', 'validation', 'test']:
+            examples = merge_split(output_directory, problem_ids_this_fold[key], shard_of, remaps, counts)
+            split_sizes[key] = len(examples)
+            save_pairs(destination, {key: examples}, tl_dict)
+            del examples
+
+        print('Fold {}: (Train, Validation, Test) == ({} {} {})'.format(i, split_sizes['train'],
+                                                                         split_sizes['validation'], split_sizes['test']))
+        np.save(os.path.join(destination, 'problem-ids.npy'), problem_ids_this_fold)
+
+        # Read back by util.helpers.get_fix_kind()
+        if manifest['edit_targets']:
+            np.save(os.path.join(destination, 'fix-kind.npy'), 'edit')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="training_data_generator_cs.py in shards, which can be generated on different machines")
+    subparsers = parser.add_subparsers(dest='step')
+
+    plan_parser = subparsers.add_parser('plan', help='Partition the problems into shards and write the manifest')
+    plan_parser.add_argument('output_directory')
+    plan_parser.add_argument('-n', '--shards', type=int, required=True, help='Number of shards')
+    plan_parser.add_argument(
+        "-i", "--ids", help="Generate inputs for undeclared-ids-neural-network", action="store_true")
+    plan_parser.add_argument('-s', '--seed', type=int, default=1189)
+    plan_parser.add_argument("--edit_targets", action="store_true",
+                             help="Typo fixes as '<line> ~ <edit script>' (see util/helpers.py)")
+    plan_parser.add_argument("--array_mutator", action="store_true", help="Mutate typos with Array_Typo_Mutate")
+    plan_parser.add_argument("--duplicate_window", type=int, default=0,
+                             help="Stop mutating a program early once --duplicate_threshold of its last this many "
+                                  "typo pairs were duplicates (default: never)")
+    plan_parser.add_argument("--duplicate_threshold", type=float, default=0.9)
+
+    work_parser = subparsers.add_parser('work', help='Generate and vectorize one shard')
+    work_parser.add_argument('output_directory')
+    work_parser.add_argument('shard', type=int)
+    work_parser.add_argument("-w", "--workers", type=int, default=1, help="Mutate in this many processes")
+
+    merge_parser = subparsers.add_parser('merge', help='Write the dictionary and bins from all the shards')
+    merge_parser.add_argument('output_directory')
+
+    args = parser.parse_args()
+
+    if args.step == 'plan':
+        assert not (args.ids and args.edit_targets), '--edit_targets is only for typo fixes'
+        plan(args.output_directory, args.shards, 'ids' if args.ids else 'typo', args.seed,
+             args.edit_targets, args.array_mutator, args.duplicate_window or None, args.duplicate_threshold)
+    elif args.step == 'work':
+        work(args.output_directory, args.shard, args.workers)
+    else:
+        merge(args.output_directory)
+
+    print '\n\n--------------- {} outputs written to {} ---------------\n\n'.format(args.step, args.output_directory)
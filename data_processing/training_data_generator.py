@@ -15,10 +15,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from util.helpers import get_rev_dict, make_dir_if_not_exists
+from util.helpers import get_rev_dict, make_dir_if_not_exists, problem_rng
 import os
 import argparse
 import sqlite3
+import multiprocessing
 import numpy as np
 from functools import partial
 
@@ -67,10 +68,8 @@ def rename_ids_(rng, corrupt_program, fix):
     return corrupt_program_new, fix_new
 
 
-def generate_training_data(db_path, bins, validation_users, min_program_length, max_program_length,
-                           max_fix_length, kind_mutations, max_mutations, max_variants, seed):
-    rng = np.random.RandomState(seed)
-
+def make_mutator(kind_mutations, rng):
+    '''(mutator object or None, mutate, rename_ids, exceptions that only skip the program)'''
     if kind_mutations == 'typo':
         from data_processing.typo_mutator import LoopCountThresholdExceededException, FailedToMutateException, Typo_Mutate, typo_mutate
         mutator_obj = Typo_Mutate(rng)
@@ -78,9 +77,78 @@ def generate_training_data(db_path, bins, validation_users, min_program_length,
         def rename_ids(x, y): return x, y
     else:
         from data_processing.undeclared_mutator import LoopCountThresholdExceededException, FailedToMutateException, id_mutate
+        mutator_obj = None
         mutate = partial(id_mutate, rng)
         rename_ids = partial(rename_ids_, rng)
 
+    return mutator_obj, mutate, rename_ids, (FailedToMutateException, LoopCountThresholdExceededException)
+
+
+def mutate_problem(cursor, problem_id, problem_validation_users, mutate, rename_ids, skip_exceptions, kind_mutations,
+                   min_program_length, max_program_length, max_fix_length, max_mutations, max_variants):
+    '''({'train': pairs, 'validation': pairs}, program lengths, fix lengths, mutate calls, exceptions) of one problem.'''
+    pairs = {'train': [], 'validation': []}
+    program_lengths, fix_lengths = [], []
+    mutate_calls, exceptions = 0, 0
+
+    # Should be ">=?" and "<=?"???
+    query = 'SELECT user_id, tokenized_code, codelength FROM Code ' \
+            'WHERE problem_id=? and codelength>? and codelength<? and errorcount=0;'
+    for row in cursor.execute(query, (problem_id, min_program_length, max_program_length)):
+        user_id, tokenized_code, program_length = map(str, row)
+        key = 'validation' if user_id in problem_validation_users else 'train'
+
+        program_lengths.append(program_length)
+
+        id_renamed_correct_program, _ = rename_ids(tokenized_code, '')
+
+        # Correct pairs
+        pairs[key].append((id_renamed_correct_program, '-1'))
+
+        # Mutate
+        mutate_calls += 1
+        try:
+            iterator = mutate(tokenized_code, max_mutations, max_variants)
+        except skip_exceptions:
+            exceptions += 1
+        except Exception:
+            exceptions += 1
+            if kind_mutations == 'typo':
+                raise
+        else:
+            for corrupt_program, fix in iterator:
+                corrupt_program_length = len(corrupt_program.split())
+                fix_length = len(fix.split())
+                fix_lengths.append(fix_length)
+                if (min_program_length <= corrupt_program_length <= max_program_length
+                        and fix_length <= max_fix_length):
+                    try:
+                        corrupt_program, fix = rename_ids(corrupt_program, fix)
+                    except FixIDNotFoundInSource:
+                        exceptions += 1
+                    pairs[key].append((corrupt_program, fix))
+
+    return pairs, program_lengths, fix_lengths, mutate_calls, exceptions
+
+
+def _mutate_problem(task):
+    '''One problem of generate_training_data(workers > 0), with its own random stream and mutator.'''
+    db_path, problem_id, problem_validation_users, seed, kind_mutations, mutate_args = task
+
+    mutator_obj, mutate, rename_ids, skip_exceptions = make_mutator(kind_mutations, problem_rng(seed, problem_id))
+    with sqlite3.connect(db_path) as conn:
+        result = mutate_problem(conn.cursor(), problem_id, problem_validation_users, mutate, rename_ids,
+                                skip_exceptions, kind_mutations, *mutate_args)
+
+    mutation_counts = mutator_obj.get_mutation_counts() if mutator_obj is not None else {}
+    return (problem_id,) + result + (mutation_counts,)
+
+
+def generate_training_data(db_path, bins, validation_users, min_program_length, max_program_length,
+                           max_fix_length, kind_mutations, max_mutations, max_variants, seed, workers=0):
+    '''With [workers] > 0, see training_data_generator_cs.generate_training_data().'''
+    mutate_args = (min_program_length, max_program_length, max_fix_length, max_mutations, max_variants)
+
     token_strings = {'train': {}, 'validation': {}}
 
     exceptions_in_mutate_call = 0
@@ -92,45 +160,50 @@ def generate_training_data(db_path, bins, validation_users, min_program_length,
         for problem_id in bin_:
             problem_list.append(problem_id)
 
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        # Should be ">=?" and "<=?"???
-        query = 'SELECT user_id, tokenized_code, codelength FROM Code ' \
-                'WHERE problem_id=? and codelength>? and codelength<? and errorcount=0;'
-        for problem_id in problem_list:
-            for row in cursor.execute(query, (problem_id, min_program_length, max_program_length)):
-                user_id, tokenized_code, program_length = map(str, row)
-                key = 'validation' if user_id in validation_users[problem_id] else 'train'
-
-                program_lengths.append(program_length)
-
-                id_renamed_correct_program, _ = rename_ids(tokenized_code, '')
-
-                # Correct pairs
-                token_strings[key].setdefault(problem_id, []).append((id_renamed_correct_program, '-1'))
-
-                # Mutate
-                total_mutate_calls += 1
-                try:
-                    iterator = mutate(tokenized_code, max_mutations, max_variants)
-                except (FailedToMutateException, LoopCountThresholdExceededException):
-                    exceptions_in_mutate_call += 1
-                except Exception:
-                    exceptions_in_mutate_call += 1
-                    if kind_mutations == 'typo':
-                        raise
-                else:
-                    for corrupt_program, fix in iterator:
-                        corrupt_program_length = len(corrupt_program.split())
-                        fix_length = len(fix.split())
-                        fix_lengths.append(fix_length)
-                        if (min_program_length <= corrupt_program_length <= max_program_length
-                                and fix_length <= max_fix_length):
-                            try:
-                                corrupt_program, fix = rename_ids(corrupt_program, fix)
-                            except FixIDNotFoundInSource:
-                                exceptions_in_mutate_call += 1
-                            token_strings[key].setdefault(problem_id, []).append((corrupt_program, fix))
+    def merge(problem_id, pairs, this_program_lengths, this_fix_lengths, mutate_calls, exceptions):
+        for key in pairs:
+            if pairs[key]:
+                token_strings[key].setdefault(problem_id, []).extend(pairs[key])
+        program_lengths.extend(this_program_lengths)
+        fix_lengths.extend(this_fix_lengths)
+        return mutate_calls, exceptions
+
+    if workers > 0:
+        tasks = [(db_path, problem_id, validation_users[problem_id], seed, kind_mutations, mutate_args)
+                 for problem_id in problem_list]
+        mutation_distribution = {}
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            # imap() keeps the order of [tasks]
+            for result in pool.imap(_mutate_problem, tasks):
+                mutate_calls, exceptions = merge(*result[:-1])
+                total_mutate_calls += mutate_calls
+                exceptions_in_mutate_call += exceptions
+                for action, count in result[-1].items():
+                    mutation_distribution[action] = mutation_distribution.get(action, 0) + count
+        except BaseException:
+            # close() would let the workers finish every queued problem before the error comes out
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        rng = np.random.RandomState(seed)
+        mutator_obj, mutate, rename_ids, skip_exceptions = make_mutator(kind_mutations, rng)
+
+        with sqlite3.connect(db_path) as conn:
+            cursor = conn.cursor()
+            for problem_id in problem_list:
+                mutate_calls, exceptions = merge(problem_id, *mutate_problem(
+                    cursor, problem_id, validation_users[problem_id], mutate, rename_ids, skip_exceptions,
+                    kind_mutations, *mutate_args))
+                total_mutate_calls += mutate_calls
+                exceptions_in_mutate_call += exceptions
+
+        mutation_distribution = mutator_obj.get_mutation_distribution() if kind_mutations == 'typo' else {}
 
     program_lengths = np.sort(program_lengths)
     fix_lengths = np.sort(fix_lengths)
@@ -147,7 +220,7 @@ def generate_training_data(db_path, bins, validation_users, min_program_length,
     print 'Total mutate calls:', total_mutate_calls
     print 'Exceptions in mutate() call:', exceptions_in_mutate_call, '\n'
 
-    return token_strings, mutator_obj.get_mutation_distribution() if kind_mutations == 'typo' else {}
+    return token_strings, mutation_distribution
 
 
 def build_dictionary(token_strings, drop_ids, tl_dict={}):
@@ -279,6 +352,9 @@ if __name__ == '__main__':
         description="Process 'C' dataset to be used in repair tasks")
     parser.add_argument(
         "-i", "--ids", help="Generate inputs for undeclared-ids-neural-network", action="store_true")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Mutate in this many processes, with a random stream per problem "
+                             "(the output is the same for any number of workers, but not the same as with 0)")
     args = parser.parse_args()
 
     kind_mutations = 'ids' if args.ids else 'typo'
@@ -304,7 +380,8 @@ if __name__ == '__main__':
 
     token_strings, mutations_distribution = generate_training_data(db_path, bins, validation_users,
                                                                    min_program_length, max_program_length, max_fix_length,
-                                                                   kind_mutations, max_mutations, max_variants, seed)
+                                                                   kind_mutations, max_mutations, max_variants, seed,
+                                                                   workers=args.workers)
 
     np.save(os.path.join(output_directory, 'tokenized-examples.npy'), token_strings)
     np.save(os.path.join(output_directory, 'error-seeding-distribution.npy'), mutations_distribution)
@@ -15,11 +15,16 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from data_processing.cs_corpus import iter_cs_programs
 from util.cs_tokenizer import CS_Tokenizer
-from util.helpers import get_rev_dict, make_dir_if_not_exists
+from util.tokenized_cache import TokenizedCache, TOKENIZED_CACHE
+from util.helpers import get_rev_dict, make_dir_if_not_exists, line_fix_to_edit_fix, problem_rng, ProgramDelta, \
+    program_tokens, count_tokens
 import os
 import argparse
 import sqlite3
+import itertools
+import multiprocessing
 import numpy as np
 from functools import partial
 
@@ -31,20 +36,55 @@ class FixIDNotFoundInSource(Exception):
 tokenize = CS_Tokenizer().tokenize
 
 
-def get_cs_tokenized():
-    with open('data/cs-data-dict') as f:
-        result = eval(f.read())
-    for problem_id, code in result.items():
-        result[problem_id], _, _ = tokenize(code)
-    return result
+_tokenized_caches = {}
+
+
+def get_tokenized_cache(path=TOKENIZED_CACHE):
+    if path not in _tokenized_caches:
+        _tokenized_caches[path] = TokenizedCache(CS_Tokenizer(), path)
+    return _tokenized_caches[path]
+
+
+def iter_cs_tokenized(problem_ids=None, cache_path=TOKENIZED_CACHE, batch_size=1000):
+    '''Yields (problem_id, tokenized code) of the corpus (see cs_corpus.py) in its order, reading and
+    tokenizing [batch_size] programs at a time. Tokenization results are kept in [cache_path]
+    (see util/tokenized_cache.py) unless it is None.'''
+    programs = iter_cs_programs(problem_ids=problem_ids)
+    while True:
+        batch = list(itertools.islice(programs, batch_size))
+        if not batch:
+            break
+
+        if cache_path is None:
+            tokenized = [tokenize(code) for _, code in batch]
+        else:
+            tokenized = get_tokenized_cache(cache_path).tokenize_many([code for _, code in batch])
+
+        for (problem_id, _), (tokenized_code, _, _) in zip(batch, tokenized):
+            yield problem_id, tokenized_code
+
+
+def get_cs_tokenized(problem_ids=None, cache_path=TOKENIZED_CACHE):
+    return dict(iter_cs_tokenized(problem_ids, cache_path))
+
+
+def get_cs_problem_ids():
+    '''The problem ids of the corpus, in its order, without tokenizing.'''
+    return [problem_id for problem_id, _ in iter_cs_programs()]
+
+
+def generation_limits(kind_mutations):
+    '''(min_program_length, max_program_length, max_fix_length, max_mutations, max_variants)'''
+    return 75, 450, 25, 5, 4000 if kind_mutations == 'ids' else 50
 
 
 def rename_ids_(rng, corrupt_program, fix):
     corrupt_program_new = ''
     fix_new = ''
+    corrupt_tokens = program_tokens(corrupt_program)
 
     names = []
-    for token in corrupt_program.split():
+    for token in corrupt_tokens:
         if '_<id>_' in token:
             if token not in names:
                 names.append(token)
@@ -52,7 +92,7 @@ def rename_ids_(rng, corrupt_program, fix):
     rng.shuffle(names)
     name_dictionary = {}
 
-    for token in corrupt_program.split():
+    for token in corrupt_tokens:
         if '_<id>_' in token:
             if token not in name_dictionary:
                 name_dictionary[token] = '_<id>_' + \
@@ -63,12 +103,15 @@ def rename_ids_(rng, corrupt_program, fix):
             if token not in name_dictionary:
                 raise FixIDNotFoundInSource
 
-    # Rename
-    for token in corrupt_program.split():
-        if '_<id>_' in token:
-            corrupt_program_new += name_dictionary[token] + " "
-        else:
-            corrupt_program_new += token + " "
+    # Rename, a ProgramDelta just keeps the renaming
+    if isinstance(corrupt_program, ProgramDelta):
+        corrupt_program_new = corrupt_program.renamed(name_dictionary)
+    else:
+        for token in corrupt_tokens:
+            if '_<id>_' in token:
+                corrupt_program_new += name_dictionary[token] + " "
+            else:
+                corrupt_program_new += token + " "
 
     for token in fix.split():
         if '_<id>_' in token:
@@ -79,59 +122,174 @@ def rename_ids_(rng, corrupt_program, fix):
     return corrupt_program_new, fix_new
 
 
-def generate_training_data(bins, min_program_length, max_program_length,
-                           max_fix_length, kind_mutations, max_mutations, max_variants, seed):
-    rng = np.random.RandomState(seed)
+def make_mutator(kind_mutations, rng, array_mutator=False, duplicate_window=None, duplicate_threshold=None):
+    '''(mutator object or None, mutate, rename_ids, exceptions that only skip the program)
 
-    if kind_mutations == 'typo':
+    Typo variants of a program stop early once at least [duplicate_threshold] of
+    the last [duplicate_window] pairs were duplicates (see typo_mutator.VariantYield).'''
+    if kind_mutations == 'typo' and array_mutator:
+        from data_processing.typo_mutator import LoopCountThresholdExceededException, FailedToMutateException, Array_Typo_Mutate, array_typo_mutate
+        mutator_obj = Array_Typo_Mutate(rng)
+        mutate = partial(array_typo_mutate, mutator_obj, deltas=True, duplicate_window=duplicate_window,
+                         duplicate_threshold=duplicate_threshold)
+        def rename_ids(x, y): return x, y
+    elif kind_mutations == 'typo':
         from data_processing.typo_mutator import LoopCountThresholdExceededException, FailedToMutateException, Typo_Mutate, typo_mutate
         mutator_obj = Typo_Mutate(rng)
-        mutate = partial(typo_mutate, mutator_obj)
+        mutate = partial(typo_mutate, mutator_obj, deltas=True, duplicate_window=duplicate_window,
+                         duplicate_threshold=duplicate_threshold)
         def rename_ids(x, y): return x, y
     else:
         from data_processing.undeclared_mutator_cs import LoopCountThresholdExceededException, FailedToMutateException, id_mutate
-        mutate = partial(id_mutate, rng)
+        mutator_obj = None
+        mutate = partial(id_mutate, rng, deltas=True)
         rename_ids = partial(rename_ids_, rng)
 
+    # Variants are ProgramDeltas of the program, materialized by vectorize()
+    return mutator_obj, mutate, rename_ids, (FailedToMutateException, LoopCountThresholdExceededException)
+
+
+def mutate_program(tokenized_code, mutate, rename_ids, skip_exceptions, kind_mutations, min_program_length,
+                   max_program_length, max_fix_length, max_mutations, max_variants, edit_targets=False):
+    '''(pairs, the correct one first, fix lengths, exceptions) of one program.'''
+    id_renamed_correct_program, _ = rename_ids(tokenized_code, '')
+
+    # Correct pairs
+    pairs = [(id_renamed_correct_program, '-1')]
+    fix_lengths = []
+    exceptions = 0
+
+    # Mutate
+    try:
+        iterator = mutate(tokenized_code, max_mutations, max_variants)
+    except skip_exceptions:
+        exceptions += 1
+    except Exception:
+        exceptions += 1
+        if kind_mutations == 'typo':
+            raise
+    else:
+        for corrupt_program, fix in iterator:
+            if edit_targets:
+                fix = line_fix_to_edit_fix(corrupt_program, fix)
+            corrupt_program_length = count_tokens(corrupt_program)
+            fix_length = len(fix.split())
+            fix_lengths.append(fix_length)
+            if (min_program_length <= corrupt_program_length <= max_program_length
+                    and fix_length <= max_fix_length):
+                try:
+                    corrupt_program, fix = rename_ids(corrupt_program, fix)
+                except FixIDNotFoundInSource:
+                    exceptions += 1
+                pairs.append((corrupt_program, fix))
+
+    return pairs, fix_lengths, exceptions
+
+
+def _mutate_problem(task):
+    '''One problem of generate_training_data(workers > 0), with its own random stream and mutator.'''
+    problem_id, tokenized_code, seed, kind_mutations, array_mutator, mutate_args, edit_targets, early_stop = task
+
+    mutator_obj, mutate, rename_ids, skip_exceptions = make_mutator(
+        kind_mutations, problem_rng(seed, problem_id), array_mutator, *early_stop)
+    pairs, fix_lengths, exceptions = mutate_program(tokenized_code, mutate, rename_ids, skip_exceptions,
+                                                    kind_mutations, *mutate_args, edit_targets=edit_targets)
+
+    mutation_counts = mutator_obj.get_mutation_counts() if mutator_obj is not None else {}
+    this_yield = mutator_obj.last_yield if mutator_obj is not None else None
+    return problem_id, len(tokenized_code.split()), pairs, fix_lengths, exceptions, mutation_counts, this_yield
+
+
+def print_variant_yield(variant_yield):
+    '''Summary of the per-program VariantYield stats of generate_training_data().'''
+    if not variant_yield:
+        return
+    stats = variant_yield.values()
+    variants = sum(this_yield['variants'] for this_yield in stats)
+    made = sum(this_yield['pairs'] for this_yield in stats)
+    unique = sum(this_yield['unique'] for this_yield in stats)
+    print 'Variants:', variants, '\tPairs made =', made, '\tUnique =', unique, \
+        '\tUnique per variant = %.3f' % (float(unique) / max(variants, 1))
+    print 'Programs stopped early:', sum(this_yield['stopped_early'] for this_yield in stats), 'of', len(stats)
+
+
+def generate_training_data(bins, min_program_length, max_program_length,
+                           max_fix_length, kind_mutations, max_mutations, max_variants, seed, skip_problem_ids=(),
+                           edit_targets=False, array_mutator=False, workers=0, problem_ids=None,
+                           duplicate_window=None, duplicate_threshold=None):
+    '''With [workers] > 0, problems are mutated by a pool of that many processes.
+    Each problem then has its own random stream, derived from ([seed], problem id),
+    and its own typo mutator (whose pmf adapts within the problem only), so the
+    output does not depend on the number of workers. The typo mutation
+    distribution is the sum over problems.
+
+    The corpus is read lazily, so only the generated pairs grow with it.
+
+    Also returns the VariantYield stats of each typo-mutated program (see
+    make_mutator() for [duplicate_window] and [duplicate_threshold]).'''
+    mutate_args = (min_program_length, max_program_length, max_fix_length, max_mutations, max_variants)
+    early_stop = (duplicate_window, duplicate_threshold)
+
     token_strings = {'train': {}, 'validation': {}}
 
     exceptions_in_mutate_call = 0
     total_mutate_calls = 0
     program_lengths, fix_lengths = [], []
+    variant_yield = {}
 
-    for problem_id, tokenized_code in get_cs_tokenized().items():
-        program_length = len(tokenized_code.split())
-        key = 'train'
-
-        program_lengths.append(program_length)
+    problems = ((problem_id, tokenized_code) for problem_id, tokenized_code in iter_cs_tokenized(problem_ids)
+                if problem_id not in skip_problem_ids)
 
-        id_renamed_correct_program, _ = rename_ids(tokenized_code, '')
+    if workers > 0:
+        tasks = ((problem_id, tokenized_code, seed, kind_mutations, array_mutator, mutate_args, edit_targets,
+                  early_stop) for problem_id, tokenized_code in problems)
+        mutation_distribution = {}
 
-        # Correct pairs
-        token_strings[key].setdefault(problem_id, []).append((id_renamed_correct_program, '-1'))
-
-        # Mutate
-        total_mutate_calls += 1
+        pool = multiprocessing.Pool(workers)
         try:
-            iterator = mutate(tokenized_code, max_mutations, max_variants)
-        except (FailedToMutateException, LoopCountThresholdExceededException):
-            exceptions_in_mutate_call += 1
-        except Exception:
-            exceptions_in_mutate_call += 1
-            if kind_mutations == 'typo':
-                raise
+            # imap() would read all of [tasks] at once
+            for chunk in iter(lambda: list(itertools.islice(tasks, 64 * workers)), []):
+                # imap() keeps the order of [chunk]
+                for problem_id, program_length, pairs, this_fix_lengths, exceptions, mutation_counts, this_yield \
+                        in pool.imap(_mutate_problem, chunk):
+                    program_lengths.append(program_length)
+                    if this_yield is not None:
+                        variant_yield[problem_id] = this_yield
+                    token_strings['train'][problem_id] = pairs
+                    fix_lengths += this_fix_lengths
+                    exceptions_in_mutate_call += exceptions
+                    total_mutate_calls += 1
+                    for action, count in mutation_counts.items():
+                        mutation_distribution[action] = mutation_distribution.get(action, 0) + count
+        except BaseException:
+            # close() would let the workers finish every queued problem before the error comes out
+            pool.terminate()
+            raise
         else:
-            for corrupt_program, fix in iterator:
-                corrupt_program_length = len(corrupt_program.split())
-                fix_length = len(fix.split())
-                fix_lengths.append(fix_length)
-                if (min_program_length <= corrupt_program_length <= max_program_length
-                        and fix_length <= max_fix_length):
-                    try:
-                        corrupt_program, fix = rename_ids(corrupt_program, fix)
-                    except FixIDNotFoundInSource:
-                        exceptions_in_mutate_call += 1
-                    token_strings[key].setdefault(problem_id, []).append((corrupt_program, fix))
+            pool.close()
+        finally:
+            pool.join()
+
+        # For the bins, independent of the mutations
+        rng = np.random.RandomState(seed)
+    else:
+        rng = np.random.RandomState(seed)
+        mutator_obj, mutate, rename_ids, skip_exceptions = make_mutator(kind_mutations, rng, array_mutator,
+                                                                        *early_stop)
+
+        for problem_id, tokenized_code in problems:
+            program_lengths.append(len(tokenized_code.split()))
+            total_mutate_calls += 1
+
+            pairs, this_fix_lengths, exceptions = mutate_program(tokenized_code, mutate, rename_ids, skip_exceptions,
+                                                                 kind_mutations, *mutate_args, edit_targets=edit_targets)
+            token_strings['train'][problem_id] = pairs
+            fix_lengths += this_fix_lengths
+            exceptions_in_mutate_call += exceptions
+            if mutator_obj is not None and mutator_obj.last_yield is not None:
+                variant_yield[problem_id] = mutator_obj.last_yield
+
+        mutation_distribution = mutator_obj.get_mutation_distribution() if kind_mutations == 'typo' else {}
 
     program_lengths = np.sort(program_lengths)
     fix_lengths = np.sort(fix_lengths)
@@ -146,16 +304,18 @@ def generate_training_data(bins, min_program_length, max_program_length,
         print 'fix_lengths'
         print fix_lengths
     print 'Total mutate calls:', total_mutate_calls
-    print 'Exceptions in mutate() call:', exceptions_in_mutate_call, '\n'
+    print 'Exceptions in mutate() call:', exceptions_in_mutate_call
+    print_variant_yield(variant_yield)
+    print
 
-    return token_strings, mutator_obj.get_mutation_distribution() if kind_mutations == 'typo' else {}, rng
+    return token_strings, mutation_distribution, rng, variant_yield
 
 
 def build_dictionary(token_strings, drop_ids, tl_dict={}):
 
     def build_dict(list_generator, dict_ref):
-        for tokenized_code in list_generator:
-            for token in tokenized_code.split():
+        for tokens in list_generator:
+            for token in tokens:
                 if drop_ids and '_<id>_' in token:
                     continue
                 token = token.strip()
@@ -171,7 +331,7 @@ def build_dictionary(token_strings, drop_ids, tl_dict={}):
 
     for key in token_strings:
         for pfs in token_strings[key].values():
-            build_dict((prog + ' ' + fix for prog, fix in pfs), tl_dict)
+            build_dict((program_tokens(prog) + fix.split() for prog, fix in pfs), tl_dict)
 
     print 'dictionary size:', len(tl_dict)
     assert len(tl_dict) > 4
@@ -182,7 +342,7 @@ def vectorize(tokens, tl_dict, max_vector_length, drop_ids, reverse, vecFor='enc
     assert vecFor == 'encoder' or not reverse, 'reverse passed as True for decoder sequence'
 
     vec_tokens = []
-    for token in tokens.split():
+    for token in program_tokens(tokens):
         if drop_ids and '_<id>_' in token:
             token = '_<id>_@'
 
@@ -243,22 +403,31 @@ def save_pairs(destination, token_vectors, tl_dict):
         save_dictionaries(destination, tl_dict)
 
 
-def my_save_bins(destination, tl_dict, token_vectors, rng):
-    full_list = get_cs_tokenized().keys()
+def assign_folds(problem_ids, rng, fold_n=5):
+    '''{'train': problem ids, 'validation': .., 'test': ..} of each fold. Every problem is tested
+    in one fold; in the others it goes to train or validation at random (80/20).'''
+    full_list = list(problem_ids)
     rng.shuffle(full_list)
-    fold_n = 5
     bins = []
     for i in range(fold_n):
         bins.append(full_list[len(full_list)*i//fold_n:len(full_list)*(i+1)//fold_n])
-    for i, bin_ in enumerate(bins):
-        token_vectors_this_fold = {'train': [], 'validation': [], 'test': []}
+    folds = []
+    for bin_ in bins:
+        problem_ids_this_fold = {'train': [], 'validation': [], 'test': list(bin_)}
         for problem_id in set(full_list) - set(bin_):
-            if rng.rand() < 0.8:
-                token_vectors_this_fold['train'] += token_vectors['train'][problem_id]
-            else:
-                token_vectors_this_fold['validation'] += token_vectors['train'][problem_id]
-        for problem_id in bin_:
-            token_vectors_this_fold['test'] += token_vectors['train'][problem_id]
+            problem_ids_this_fold['train' if rng.rand() < 0.8 else 'validation'].append(problem_id)
+        folds.append(problem_ids_this_fold)
+    return folds
+
+
+def my_save_bins(destination, tl_dict, token_vectors, rng, problem_ids=None):
+    full_list = get_cs_problem_ids() if problem_ids is None else problem_ids
+    # Which problems went where, used by data_processing/online_data_stream.py
+    for i, problem_ids_this_fold in enumerate(assign_folds(full_list, rng)):
+        token_vectors_this_fold = {'train': [], 'validation': [], 'test': []}
+        for key in token_vectors_this_fold:
+            for problem_id in problem_ids_this_fold[key]:
+                token_vectors_this_fold[key] += token_vectors['train'][problem_id]
         print('Fold {}: (Train, Validation, Test) == ({} {} {})'.format(i,
             len(token_vectors_this_fold['train']),
             len(token_vectors_this_fold['validation']),
@@ -266,6 +435,7 @@ def my_save_bins(destination, tl_dict, token_vectors, rng):
         make_dir_if_not_exists(os.path.join(destination, 'bin_{}'.format(i)))
         save_pairs(os.path.join(destination,
             'bin_{}'.format(i)), token_vectors_this_fold, tl_dict)
+        np.save(os.path.join(destination, 'bin_{}'.format(i), 'problem-ids.npy'), problem_ids_this_fold)
 
 def save_bins(destination, tl_dict, token_vectors, rng):
     fold_n = 5
@@ -306,17 +476,30 @@ if __name__ == '__main__':
         description="Process 'C' dataset to be used in repair tasks")
     parser.add_argument(
         "-i", "--ids", help="Generate inputs for undeclared-ids-neural-network", action="store_true")
+    parser.add_argument("--extend_dictionary", metavar='OLD_OUTPUT_DIRECTORY',
+                        help="Only generate inputs for the problems missing from the bins in OLD_OUTPUT_DIRECTORY, "
+                             "appending their new tokens to its dictionary (see neural_net/warm_start.py)")
+    parser.add_argument("-o", "--output_directory",
+                        help="default: data/network_inputs/iitk-<kind>-<seed>, with -extended appended for --extend_dictionary")
+    parser.add_argument("--edit_targets", action="store_true",
+                        help="Typo fixes as '<line> ~ <edit script>' (see util/helpers.py) instead of the whole corrected line")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Mutate in this many processes, with a random stream per problem "
+                             "(the output is the same for any number of workers, but not the same as with 0)")
+    parser.add_argument("--array_mutator", action="store_true",
+                        help="Mutate typos with Array_Typo_Mutate (same kind of pairs, much faster, different random stream)")
+    parser.add_argument("--duplicate_window", type=int, default=0,
+                        help="Stop mutating a program early once --duplicate_threshold of its last this many "
+                             "typo pairs were duplicates (default: never)")
+    parser.add_argument("--duplicate_threshold", type=float, default=0.9)
     args = parser.parse_args()
 
     kind_mutations = 'ids' if args.ids else 'typo'
+    assert not (args.ids and args.edit_targets), '--edit_targets is only for typo fixes'
 
     drop_ids = kind_mutations == 'typo'
-    max_program_length = 450
-    min_program_length = 75
-    max_fix_length = 25
-
-    max_mutations = 5
-    max_variants = 4000 if kind_mutations == 'ids' else 50
+    min_program_length, max_program_length, max_fix_length, max_mutations, max_variants = \
+        generation_limits(kind_mutations)
 
     db_path = os.path.join('data', 'iitk-dataset', 'dataset.db')
     validation_users = np.load(os.path.join('data', 'iitk-dataset', 'validation_users.npy'), allow_pickle=True).item()
@@ -325,24 +508,56 @@ if __name__ == '__main__':
     seed = 1189
 
     output_directory = os.path.join('data/network_inputs', 'iitk-%s-%d' % (kind_mutations, seed))
+    if args.edit_targets:
+        output_directory += '-edit'
+
+    old_tl_dict, old_problem_ids = {}, set()
+    if args.extend_dictionary is not None:
+        output_directory = args.extend_dictionary.rstrip('/') + '-extended'
+        old_tl_dict, _ = load_dictionaries(os.path.join(args.extend_dictionary, 'bin_0'))
+
+        for binid in range(5):
+            problem_ids = np.load(os.path.join(args.extend_dictionary, 'bin_%d' % binid, 'problem-ids.npy'),
+                                  allow_pickle=True).item()
+            for split in problem_ids:
+                old_problem_ids.update(problem_ids[split])
+
+        print 'extending:', args.extend_dictionary, '({} problems, {} tokens)'.format(len(old_problem_ids), len(old_tl_dict))
+
+    if args.output_directory is not None:
+        output_directory = args.output_directory
 
     print 'output_directory:', output_directory
     make_dir_if_not_exists(os.path.join(output_directory))
 
-    token_strings, mutations_distribution, rng = generate_training_data(bins, min_program_length, max_program_length, max_fix_length,
-                                                                   kind_mutations, max_mutations, max_variants, seed)
+    token_strings, mutations_distribution, rng, variant_yield = generate_training_data(bins, min_program_length, max_program_length, max_fix_length,
+                                                                   kind_mutations, max_mutations, max_variants, seed,
+                                                                   skip_problem_ids=old_problem_ids,
+                                                                   edit_targets=args.edit_targets,
+                                                                   array_mutator=args.array_mutator,
+                                                                   workers=args.workers,
+                                                                   duplicate_window=args.duplicate_window or None,
+                                                                   duplicate_threshold=args.duplicate_threshold)
 
     np.save(os.path.join(output_directory, 'tokenized-examples.npy'), token_strings)
     np.save(os.path.join(output_directory, 'error-seeding-distribution.npy'), mutations_distribution)
+    np.save(os.path.join(output_directory, 'variant-yield.npy'), variant_yield)
 
     # token_strings = np.load(os.path.join(output_directory, 'tokenized-examples.npy'), allow_pickle=True).item()
 
-    tl_dict = build_dictionary(token_strings, drop_ids)
+    # Tokens of the old dictionary keep their ids, new ones are appended
+    tl_dict = build_dictionary(token_strings, drop_ids, tl_dict=dict(old_tl_dict))
 
     # Tokenize
     token_vectors = vectorize_data(token_strings, tl_dict, max_program_length, max_fix_length, drop_ids)
 
     # Save
-    my_save_bins(output_directory, tl_dict, token_vectors, rng)
+    my_save_bins(output_directory, tl_dict, token_vectors, rng,
+                 problem_ids=token_vectors['train'].keys() if args.extend_dictionary is not None else None)
+
+    # Read back by util.helpers.get_fix_kind()
+    if args.edit_targets:
+        for binid in range(5):
+            np.save(os.path.join(output_directory, 'bin_%d' % binid, 'fix-kind.npy'), 'edit')
 
     print '\n\n--------------- all outputs written to {} ---------------\n\n'.format(output_directory)
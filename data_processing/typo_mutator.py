@@ -16,7 +16,10 @@ limitations under the License.
 """
 
 import re
-from util.helpers import isolate_line, fetch_line, extract_line_number, get_lines, recompose_program
+import bisect
+import collections
+from util.helpers import isolate_line, extract_line_number, get_lines, recompose_program, TokenizedProgram, \
+    intern_token, token_ids_to_string, ProgramDelta
 
 
 class FailedToMutateException(Exception):
@@ -91,10 +94,18 @@ class Typo_Mutate:
     def get_actions(self):
         return self.__actions
 
+    @classmethod
+    def get_action_pattern_map(self):
+        return self.__action_pattern_map
+
     __mutation_distribution = None
     __pmf = None
 
     def find_and_replace(self, corrupted_prog, regex, replacement, mutation_name):
+        return self._find_and_replace(corrupted_prog, regex, replacement, mutation_name)[:3]
+
+    def _find_and_replace(self, corrupted_prog, regex, replacement, mutation_name):
+        '''find_and_replace(), also returning where the replacement starts (None if there was none).'''
         positions = [m.span() for m in re.finditer(regex, corrupted_prog)]
 
         if len(positions) > 1:
@@ -102,7 +113,7 @@ class Typo_Mutate:
         elif len(positions) == 1:
             to_corrupt = 0
         else:
-            return corrupted_prog, None, mutation_name
+            return corrupted_prog, None, mutation_name, None
 
         line_number = extract_line_number(isolate_line(
             corrupted_prog, positions[to_corrupt][0]))
@@ -110,7 +121,7 @@ class Typo_Mutate:
         corrupted_prog = corrupted_prog[:positions[to_corrupt][0]] + \
             replacement + corrupted_prog[positions[to_corrupt][1]:]
 
-        return corrupted_prog, line_number, mutation_name
+        return corrupted_prog, line_number, mutation_name, positions[to_corrupt][0]
 
     def __update_pmf(self):
         _dist = self.__mutation_distribution
@@ -131,6 +142,9 @@ class Typo_Mutate:
 
     update_pmf = __update_pmf
 
+    def get_pmf(self):
+        return self.__pmf
+
     def __init__(self, rng):
         self.rng = rng
 
@@ -146,14 +160,36 @@ class Typo_Mutate:
         assert self.__pmf != None, 'pmf is None'
 
     def easy_mutate(self, corrupted_prog):
+        return self.easy_mutate_line(corrupted_prog)[:3]
+
+    def easy_mutate_line(self, corrupted_prog):
+        '''easy_mutate(), also returning the token ids of the mutated line (None if
+        nothing was mutated). No action touches a ~ or a line number, so the line
+        is read around the replacement instead of re-splitting the program.'''
         action_map = self.__action_pattern_map
         action = self.rng.choice(self.__actions, p=self.__pmf)
-        return self.find_and_replace(corrupted_prog, regex=action_map[action][0], replacement=action_map[action][1], mutation_name=action)
+        corrupted_prog, line_number, mutation_name, start = self._find_and_replace(
+            corrupted_prog, regex=action_map[action][0], replacement=action_map[action][1], mutation_name=action)
+
+        if line_number is None:
+            return corrupted_prog, None, mutation_name, None
+
+        begin = corrupted_prog.rfind('~', 0, start) + 1
+        end = corrupted_prog.find('~', start)
+        line = corrupted_prog[begin:end if end != -1 else len(corrupted_prog)]
+        # Up to the next ~, so the next line's number is in [line], as in get_lines()
+        return corrupted_prog, line_number, mutation_name, tuple(
+            intern_token(token) for token in line.split() if token not in _line_number_tokens)
 
     def update_mutation_distribution(self, list_of_applied_mutations):
         for each in list_of_applied_mutations:
             self.__mutation_distribution[each] += 1
 
+    def get_mutation_counts(self):
+        '''Mutations applied so far, without the initial count of one.'''
+        extra = 1 if self.__flag_one_extra_count else 0
+        return {action: count - extra for action, count in self.__mutation_distribution.items()}
+
     def get_mutation_distribution(self):
         print '\n***************************\nfn:get_mutation_distribution():\n', self.__mutation_distribution, '\n***************************\n'
         if self.__flag_one_extra_count:
@@ -163,18 +199,78 @@ class Typo_Mutate:
         return self.__mutation_distribution
 
 
-def typo_mutate(mutator_obj, prog, max_num_mutations, num_mutated_progs, just_one=False):
+# Line number digits, which get_lines() drops
+_line_number_tokens = frozenset(str(n) for n in range(10))
+
+
+class VariantYield(object):
+    '''The distinct (corrupted program, fix) pairs made from one program, in the
+    order they were made, told apart by a 64-bit fingerprint instead of being kept
+    in a set. With a [window], saturated() once at least [threshold] of the last
+    [window] pairs made were duplicates.'''
+
+    def __init__(self, window=None, threshold=None):
+        self.fingerprints = set()
+        self.pairs = []
+        self.variants = 0
+        self.made = 0
+        self.stopped_early = False
+
+        self.window = window if window and threshold is not None else None
+        self.threshold = threshold
+        self.recent = collections.deque()
+        self.recent_duplicates = 0
+
+    def add(self, corrupt, fix):
+        # hash() is 64-bit on 64-bit builds; a ProgramDelta hashes its edits
+        fingerprint = hash((corrupt, fix))
+        duplicate = fingerprint in self.fingerprints
+        self.made += 1
+
+        if not duplicate:
+            self.fingerprints.add(fingerprint)
+            self.pairs.append((corrupt, fix))
+
+        if self.window is not None:
+            self.recent.append(duplicate)
+            self.recent_duplicates += duplicate
+            if len(self.recent) > self.window:
+                self.recent_duplicates -= self.recent.popleft()
+
+    def saturated(self):
+        if self.window is not None and len(self.recent) == self.window:
+            self.stopped_early = self.recent_duplicates >= self.threshold * self.window
+        return self.stopped_early
+
+    def stats(self):
+        return {'variants': self.variants, 'pairs': self.made, 'unique': len(self.pairs),
+                'stopped_early': self.stopped_early}
+
+
+def typo_mutate(mutator_obj, prog, max_num_mutations, num_mutated_progs, just_one=False, deltas=False,
+                duplicate_window=None, duplicate_threshold=None):
+    '''[(corrupted program, fix)]. With [deltas], corrupted programs are ProgramDeltas of [prog].
+    With [duplicate_window], stops before [num_mutated_progs] variants once at least [duplicate_threshold]
+    of the last [duplicate_window] pairs were duplicates. Leaves the VariantYield stats in mutator_obj.last_yield.'''
 
     assert len(prog) > 10 and max_num_mutations > 0 and num_mutated_progs > 0, "Invalid argument(s) supplied to the function token_mutate_series_network2"
     # Why did you assert the number of program characters (instead of the
     # number of tokens) is more than 10?
-    corrupt_fix_pair = set()
+    mutator_obj.last_yield = None
+    found = VariantYield(duplicate_window, duplicate_threshold)
+    original = TokenizedProgram.from_string(prog)
 
     for _ in range(num_mutated_progs):
+        if found.saturated():
+            break
+        found.variants += 1
+
         num_mutations = mutator_obj.rng.choice(
             range(max_num_mutations)) + 1 if max_num_mutations > 1 else 1
         # Identical to num_mutations = mutator_obj.rng.choice(range(max_num_mutations)) + 1
         this_corrupted = prog
+        # this_corrupted, one line updated per mutation
+        corrupted = original.copy()
         lines = set()
         mutation_count = 0
         loop_counter = 0
@@ -187,14 +283,13 @@ def typo_mutate(mutator_obj, prog, max_num_mutations, num_mutated_progs, just_on
                 print "mutation_count", mutation_count
                 raise LoopCountThresholdExceededException
 
-            this_corrupted, line, mutation_name = mutator_obj.easy_mutate(
+            this_corrupted, line, mutation_name, corrupt_line = mutator_obj.easy_mutate_line(
                 this_corrupted)     # line is line_number here!
 
             if line is not None:
-                fix = fetch_line(prog, line)
-                corrupt_line = fetch_line(this_corrupted, line)
+                corrupted[line] = corrupt_line
 
-                if fix != corrupt_line:
+                if corrupt_line != original.get_line_ids(line):
                     lines.add(line)
                     mutation_count += 1
                     if line not in mutations:
@@ -205,8 +300,8 @@ def typo_mutate(mutator_obj, prog, max_num_mutations, num_mutated_progs, just_on
         assert len(lines) > 0, "Could not mutate!"
 
         flag_empty_line_in_corrupted = False
-        for _line_ in get_lines(this_corrupted):
-            if _line_.strip() == '':
+        for i in range(len(corrupted)):
+            if len(corrupted.get_line_ids(i)) == 0:
                 flag_empty_line_in_corrupted = True
                 break
 
@@ -216,26 +311,204 @@ def typo_mutate(mutator_obj, prog, max_num_mutations, num_mutated_progs, just_on
         sorted_lines = sorted(lines)
 
         for line in sorted_lines:
-            fix = fetch_line(prog, line)
-            corrupt_line = fetch_line(this_corrupted, line)
-            assert len(fetch_line(
-                prog, line, include_line_number=False).strip()) != 0, "empty fix"
-            assert len(fetch_line(this_corrupted, line, include_line_number=False).strip(
-            )) != 0, "empty corrupted line"
+            fix = original.fetch_line(line)
+            corrupt_line = corrupted.fetch_line(line)
+            assert len(original.get_line(line).strip()) != 0, "empty fix"
+            assert len(corrupted.get_line(line).strip()) != 0, "empty corrupted line"
             if fix != corrupt_line:
-                corrupt_fix_pair.add((this_corrupted, fix))
+                found.add(ProgramDelta.between(original, corrupted) if deltas else this_corrupted, fix)
                 mutator_obj.update_mutation_distribution(mutations[line])
 
                 if just_one:
                     break
 
-                try:
-                    this_corrupted = do_fix_at_line(this_corrupted, line, fetch_line(
-                        prog, line, include_line_number=False))
-                except IndexError:
-                    raise
+                # Same string as do_fix_at_line() returns
+                corrupted[line] = original.get_line_ids(line)
+                if not deltas:
+                    this_corrupted = corrupted.to_string()
 
-        if len(corrupt_fix_pair) > 0:
+        if len(found.pairs) > 0:
             mutator_obj.update_pmf()
 
-    return list(corrupt_fix_pair)
+    mutator_obj.last_yield = found.stats()
+    return found.pairs
+
+
+def _occurrences(tokens, pattern):
+    if len(pattern) == 1:
+        return [i for i, token in enumerate(tokens) if token == pattern[0]]
+    return [i for i in range(len(tokens) - len(pattern) + 1) if tuple(tokens[i:i + len(pattern)]) == pattern]
+
+
+class Array_Typo_Mutate(Typo_Mutate):
+    '''The mutations of Typo_Mutate, on the token ids of a TokenizedProgram.
+
+    The positions of every delimiter (pattern) in the correct program are
+    indexed once; a mutation only has to look at the few lines the variant has
+    already changed. The random numbers of all variants are drawn up front, and
+    actions are sampled from the same pmf, updated after every variant, as
+    easy_mutate() does.'''
+
+    loop_count_threshold = 50
+
+    def __init__(self, rng):
+        Typo_Mutate.__init__(self, rng)
+        self.patterns = []
+
+        for action in self.get_actions():
+            regex, replacement = self.get_action_pattern_map()[action]
+            self.patterns.append((tuple(intern_token(token) for token in regex.replace('\\', '').split()),
+                                  [intern_token(token) for token in replacement.split()]))
+
+    @staticmethod
+    def index_program(program, pattern):
+        '''(positions, index of the first position of each line, positions per line)'''
+        positions, first, count = [], {}, {}
+
+        for line in range(len(program)):
+            columns = _occurrences(program.get_line_ids(line), pattern)
+            if columns:
+                first[line], count[line] = len(positions), len(columns)
+                positions += [(line, column) for column in columns]
+
+        return positions, first, count
+
+    @staticmethod
+    def locate(index, changed, pattern, uniform):
+        '''The occurrence of [pattern] picked by [uniform] in [0, 1), uniformly over the
+        unchanged lines of the program and the [changed] lines of the variant.'''
+        positions, first, count = index
+        changed_lines = sorted(changed)
+        unchanged_total = len(positions)
+        changed_positions = []
+
+        for line in changed_lines:
+            unchanged_total -= count.get(line, 0)
+            changed_positions += [(line, column) for column in _occurrences(changed[line], pattern)]
+
+        total = unchanged_total + len(changed_positions)
+
+        if total == 0:
+            return None
+
+        k = min(int(uniform * total), total - 1)
+        if k >= unchanged_total:
+            return changed_positions[k - unchanged_total]
+
+        # Skip the blocks of the changed lines, in the order they appear in [positions]
+        for line in changed_lines:
+            if line not in count:
+                continue
+            if k >= first[line]:
+                k += count[line]
+            else:
+                break
+
+        return positions[k]
+
+    @staticmethod
+    def line_piece(token_ids, line, num_lines):
+        '''Line [line] of TokenizedProgram.to_string().'''
+        line_string = token_ids_to_string(token_ids)
+        if line_string and line == num_lines - 1:
+            line_string += ' '
+        return ' '.join(str(line)) + ' ~ ' + line_string + ' '
+
+    def mutate_variants(self, prog, max_num_mutations, num_mutated_progs, just_one=False, deltas=False,
+                        duplicate_window=None, duplicate_threshold=None):
+        assert len(prog) > 10 and max_num_mutations > 0 and num_mutated_progs > 0, "Invalid argument(s) supplied to the function mutate_variants"
+
+        original = TokenizedProgram.from_string(prog)
+        num_lines = len(original)
+        pieces = [self.line_piece(original.get_line_ids(line), line, num_lines) for line in range(num_lines)]
+        empty_lines = set(line for line in range(num_lines) if len(original.get_line_ids(line)) == 0)
+        indices = {pattern: self.index_program(original, pattern) for pattern, _ in self.patterns}
+
+        all_num_mutations = self.rng.randint(1, max_num_mutations + 1, size=num_mutated_progs)
+        # [:, :, 0] picks the action, [:, :, 1] the occurrence
+        uniforms = self.rng.random_sample((num_mutated_progs, self.loop_count_threshold, 2))
+
+        self.last_yield = None
+        found = VariantYield(duplicate_window, duplicate_threshold)
+        actions = self.get_actions()
+
+        for variant in range(num_mutated_progs):
+            if found.saturated():
+                break
+            found.variants += 1
+
+            # Inverse transform sampling with the current pmf
+            cdf = []
+            for probability in self.get_pmf():
+                cdf.append(probability + (cdf[-1] if cdf else 0))
+            variant_uniforms = uniforms[variant].tolist()
+
+            changed = {}
+            lines = set()
+            mutations = {}
+            mutation_count = 0
+            attempt = 0
+
+            while mutation_count < all_num_mutations[variant]:
+                attempt += 1
+                if attempt == self.loop_count_threshold:
+                    print "mutation_count", mutation_count
+                    raise LoopCountThresholdExceededException
+
+                action_uniform, occurrence_uniform = variant_uniforms[attempt - 1]
+                action = min(bisect.bisect_right(cdf, action_uniform), len(actions) - 1)
+                pattern, replacement = self.patterns[action]
+                position = self.locate(indices[pattern], changed, pattern, occurrence_uniform)
+
+                if position is None:
+                    continue
+
+                line, column = position
+                tokens = changed.setdefault(line, list(original.get_line_ids(line)))
+                tokens[column:column + len(pattern)] = replacement
+
+                if tuple(tokens) != original.get_line_ids(line):
+                    lines.add(line)
+                    mutation_count += 1
+                    mutations.setdefault(line, []).append(actions[action])
+
+            assert len(lines) > 0, "Could not mutate!"
+
+            if any(len(changed[line]) == 0 if line in changed else line in empty_lines
+                   for line in empty_lines | set(changed)):
+                continue
+
+            if deltas:
+                edits = {line: tuple(tokens) for line, tokens in changed.items()
+                         if tuple(tokens) != original.get_line_ids(line)}
+            else:
+                variant_pieces = list(pieces)
+                for line, tokens in changed.items():
+                    variant_pieces[line] = self.line_piece(tokens, line, num_lines)
+
+            for line in sorted(lines):
+                assert len(original.get_line_ids(line)) != 0, "empty fix"
+                if tuple(changed[line]) != original.get_line_ids(line):
+                    found.add(ProgramDelta(original, edits) if deltas else ''.join(variant_pieces), original.fetch_line(line))
+                    self.update_mutation_distribution(mutations[line])
+
+                    if just_one:
+                        break
+
+                    if deltas:
+                        del edits[line]
+                    else:
+                        variant_pieces[line] = pieces[line]
+
+            if len(found.pairs) > 0:
+                self.update_pmf()
+
+        self.last_yield = found.stats()
+        return found.pairs
+
+
+def array_typo_mutate(mutator_obj, prog, max_num_mutations, num_mutated_progs, just_one=False, deltas=False,
+                      duplicate_window=None, duplicate_threshold=None):
+    '''Drop-in replacement for typo_mutate() with an Array_Typo_Mutate.'''
+    return mutator_obj.mutate_variants(prog, max_num_mutations, num_mutated_progs, just_one, deltas,
+                                       duplicate_window, duplicate_threshold)
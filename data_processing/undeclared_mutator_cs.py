@@ -15,9 +15,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import bisect
 import regex as re
 
-from util.helpers import fix_ids_are_in_program, extract_line_number, get_rev_dict, get_lines, recompose_program
+from util.helpers import extract_line_number, get_rev_dict, get_lines, recompose_program, \
+    IdOccurrenceIndex, get_ids, TokenizedProgram, ProgramDelta, intern_token
 
 
 class FailedToMutateException(Exception):
@@ -36,20 +38,27 @@ class LoopCountThresholdExceededException(Exception):
     pass
 
 
-def which_fix_goes_first(program, fix1, fix2):
+def which_fix_goes_first(program, fix1, fix2, index=None):
+    '''[index]: the IdOccurrenceIndex of [program], if the caller keeps one.'''
     try:
         fix1_location = extract_line_number(' '.join(fix1.split()[1:]))
         fix2_location = extract_line_number(' '.join(fix2.split()[1:]))
     except Exception:
         raise
 
-    if not fix_ids_are_in_program(recompose_program(get_lines(program)[fix2_location:]), fix2) and fix_ids_are_in_program(recompose_program(get_lines(program)[fix1_location:]), fix1):
+    if index is None:
+        index = IdOccurrenceIndex.from_program(program)
+
+    fix1_ids_follow = index.all_occur_from(get_ids(fix1), fix1_location)
+    fix2_ids_follow = index.all_occur_from(get_ids(fix2), fix2_location)
+
+    if not fix2_ids_follow and fix1_ids_follow:
         return fix1
 
-    if not fix_ids_are_in_program(recompose_program(get_lines(program)[fix1_location:]), fix1) and fix_ids_are_in_program(recompose_program(get_lines(program)[fix2_location:]), fix2):
+    if not fix1_ids_follow and fix2_ids_follow:
         return fix2
 
-    if not fix_ids_are_in_program(recompose_program(get_lines(program)[fix1_location:]), fix1) and not fix_ids_are_in_program(recompose_program(get_lines(program)[fix2_location:]), fix2):
+    if not fix1_ids_follow and not fix2_ids_follow:
         raise CouldNotFindUsesForEitherException
 
     if fix1_location < fix2_location:
@@ -57,7 +66,6 @@ def which_fix_goes_first(program, fix1, fix2):
     elif fix2_location < fix1_location:
         return fix2
 
-    prog_lines = get_lines(program)
     id_in_fix1 = None
     id_in_fix2 = None
 
@@ -78,96 +86,177 @@ def which_fix_goes_first(program, fix1, fix2):
     assert id_in_fix1 != id_in_fix2, fix1 + ' & ' + fix2
     assert fix1_location == fix2_location
 
-    for i in range(fix1_location, len(prog_lines)):
-        for token in prog_lines[i].split():
-            if token == id_in_fix1:
-                return fix1
-            elif token == id_in_fix2:
-                return fix2
-
-    assert False, 'unreachable code'
-
-
-def find_declaration(rng, variables, line_indexes, orig_lines):
-    rng.shuffle(variables)
-    for variable in variables:
-        rng.shuffle(line_indexes)
-        declaration_regex = re.compile(r'''
-            (?P<decl>
-                (?P<type>
-                    _<type>_\w+
-                    (
-                        \ _<op>_\[
-                        \ _<op>_\]
-                    )*
-                )
-              \ {}
-            )
-          \ _<op>_=
-          \ [^,;]+
-          \ _<op>_;
-        '''.format(variable), re.X)
-        for i in line_indexes:
-            regex_matches = list(declaration_regex.finditer(orig_lines[i]))
-            if len(regex_matches) != 1:
-                continue
-            declaration = regex_matches[0].group('decl') + ' _<op>_;'
-            l, r = regex_matches[0].span('type')
-            orig_lines[i] = orig_lines[i][:l] + orig_lines[i][r+1:]
-            return declaration, i
-    raise NothingToMutateException
-
-
-def insert_fix(declaration_pos, orig_lines):
-    function_regex = re.compile(r'''
-            (
-                _<type>_\w+
-              | _<keyword>_void
-              | _<id>_\d+@
-            )
-            (
-                \ _<op>_\[
-                \ _<op>_\]
-            )*
-          \ _<id>_\d+@
-          \ _<op>_\(
-        ''', re.X)
-    function_start_regex = re.compile(r'_<op>_\{')
-    for i in range(declaration_pos-1, -1, -1):
-        if len(function_regex.findall(orig_lines[i])) == 1:
-            for j in range(i, declaration_pos+1):
-                if next(function_start_regex.search(orig_lines[j])) is not None:
-                    return j
-    raise FailedToMutateException
+    # Whichever is used first (an array declaration has no id before the [ and never is)
+    first_use_1 = index.first_occurrence_from(id_in_fix1, fix1_location)
+    first_use_2 = index.first_occurrence_from(id_in_fix2, fix2_location)
+    assert first_use_1 is not None or first_use_2 is not None, 'unreachable code'
 
+    if first_use_2 is None or (first_use_1 is not None and first_use_1 < first_use_2):
+        return fix1
+    return fix2
 
-def undeclare_variable(rng, program_string):
-    # Lines
-    orig_lines = get_lines(program_string)
-    # Variables
-    variables = []
-    for token in program_string.split():
-        if '_<id>_' in token and token not in variables:
-            variables.append(token)
-    # Look for a declaration
-    declaration, declaration_pos = find_declaration(
-        rng, variables, list(range(len(orig_lines))), orig_lines)
-    # Find the function signature
-    fix_line = insert_fix(declaration_pos, orig_lines)
+
+_type_regex = re.compile(r'_<type>_\w+$')
+_function_name_regex = re.compile(r'(_<type>_\w+|_<keyword>_void|_<id>_\d+@)$')
+_id_regex = re.compile(r'_<id>_\d+@$')
+
+
+def _declarations_in_line(tokens):
+    '''{variable: [(start, end), ...]}: tokens[start:end] is the type of a
+    "<type> ([ ])* <variable> = ... ;" declaration without commas.'''
+    declarations = {}
+
+    for start, token in enumerate(tokens):
+        if not _type_regex.match(token):
+            continue
+
+        end = start + 1
+        while tokens[end:end + 2] == ['_<op>_[', '_<op>_]']:
+            end += 2
+
+        if end + 1 >= len(tokens) or '_<id>_' not in tokens[end] or tokens[end + 1] != '_<op>_=':
+            continue
+
+        # The initializer runs to the first token with a , or ; and that has to be the ;
+        k = end + 2
+        while k < len(tokens) and ',' not in tokens[k] and ';' not in tokens[k]:
+            k += 1
+
+        if k > end + 2 and k < len(tokens) and tokens[k] == '_<op>_;':
+            declarations.setdefault(tokens[end], []).append((start, end))
+
+    return declarations
+
+
+def _count_function_headers(tokens):
+    count = 0
+
+    for start, token in enumerate(tokens):
+        if not _function_name_regex.match(token):
+            continue
+
+        end = start + 1
+        while tokens[end:end + 2] == ['_<op>_[', '_<op>_]']:
+            end += 2
+
+        if end + 1 < len(tokens) and _id_regex.match(tokens[end]) and tokens[end + 1] == '_<op>_(':
+            count += 1
+
+    return count
+
+
+class DeclarationIndex(object):
+    '''Every declaration site (variable, type span, line) of a program and the
+    lines where function bodies start, from one pass over its tokens, and the
+    IdOccurrenceIndex of the program.
+
+    A variable has a site on a line if the line declares it exactly once.
+    undeclare() removes a type and re-indexes just that line; copy() is cheap,
+    so that the index of the correct program is built once for all variants.'''
+
+    def __init__(self, program_string):
+        self.lines = [line.split() for line in get_lines(program_string)]
+
+        self.variables = []
+        seen = set()
+        for token in program_string.split():
+            if '_<id>_' in token and token not in seen:
+                seen.add(token)
+                self.variables.append(token)
+
+        self.sites = {}
+        for line in range(len(self.lines)):
+            self._index_line(line)
+
+        self.ids = IdOccurrenceIndex(self.lines)
+
+        # Neither is changed by removing a type
+        self.function_lines = [i for i, tokens in enumerate(self.lines) if _count_function_headers(tokens) == 1]
+        self.body_start_lines = [i for i, tokens in enumerate(self.lines) if '_<op>_{' in tokens]
+
+    def _index_line(self, line):
+        for variable, spans in _declarations_in_line(self.lines[line]).items():
+            if len(spans) == 1:
+                self.sites.setdefault(variable, {})[line] = spans[0]
+
+    def copy(self):
+        index = DeclarationIndex.__new__(DeclarationIndex)
+        index.lines = list(self.lines)
+        index.variables = self.variables
+        index.sites = {variable: dict(lines) for variable, lines in self.sites.items()}
+        index.ids = self.ids.copy()
+        index.function_lines = self.function_lines
+        index.body_start_lines = self.body_start_lines
+        return index
+
+    def sample(self, rng):
+        '''A uniformly random variable that has a site, and one of its sites, uniformly:
+        the distribution of trying variables and then lines in shuffled order.'''
+        candidates = [variable for variable in self.variables if self.sites.get(variable)]
+        if not candidates:
+            raise NothingToMutateException
+
+        variable = candidates[rng.randint(len(candidates))]
+        lines = sorted(self.sites[variable])
+        return variable, lines[rng.randint(len(lines))]
+
+    def undeclare(self, variable, line):
+        '''Removes the type of [variable] on [line], returns the declaration.'''
+        start, end = self.sites[variable][line]
+        tokens = self.lines[line]
+        declaration = ' '.join(tokens[start:end + 1]) + ' _<op>_;'
+
+        self.lines[line] = tokens[:start] + tokens[end:]
+        for lines in self.sites.values():
+            lines.pop(line, None)
+        self._index_line(line)
+        self.ids.update_line(line, self.lines[line])
+
+        return declaration
+
+    def insertion_line(self, declaration_line):
+        '''First line of the body of the nearest function header above [declaration_line].'''
+        for i in reversed(self.function_lines[:bisect.bisect_left(self.function_lines, declaration_line)]):
+            k = bisect.bisect_left(self.body_start_lines, i)
+            if k < len(self.body_start_lines) and self.body_start_lines[k] <= declaration_line:
+                return self.body_start_lines[k]
+        raise FailedToMutateException
+
+    def program(self):
+        return recompose_program([' '.join(tokens) for tokens in self.lines])
+
+    def delta(self, base, original):
+        '''ProgramDelta of [base], the TokenizedProgram of the [original] index this is a copy of.'''
+        return ProgramDelta(base, {line: tuple(intern_token(token) for token in tokens)
+                                   for line, tokens in enumerate(self.lines) if tokens is not original.lines[line]})
+
+
+def undeclare_random_variable(rng, index):
+    '''Undeclares a variable in [index], returns (fix, fix line).'''
+    variable, declaration_pos = index.sample(rng)
+    # The function signature
+    fix_line = index.insertion_line(declaration_pos)
+    declaration = index.undeclare(variable, declaration_pos)
     fix = '_<insertion>_ {} ~ {}'.format(' '.join(str(fix_line)), declaration)
-    # ...
-    if orig_lines[declaration_pos].strip() == '':
-        del orig_lines[declaration_pos]
-    return recompose_program(orig_lines), fix, fix_line
+    return fix, fix_line
 
 
-def id_mutate(rng, prog, max_num_mutations, num_mutated_progs, exact=False, name_dict=None):
+def undeclare_variable(rng, program_string):
+    index = DeclarationIndex(program_string)
+    fix, fix_line = undeclare_random_variable(rng, index)
+    return index.program(), fix, fix_line
+
+
+def id_mutate(rng, prog, max_num_mutations, num_mutated_progs, exact=False, name_dict=None, deltas=False):
+    '''[(corrupted program, fix)]. With [deltas], corrupted programs are ProgramDeltas of [prog].'''
     assert max_num_mutations > 0 and num_mutated_progs > 0, "Invalid argument(s) supplied to the function token_mutate"
     corrupted = []
     fixes = []
+    index = DeclarationIndex(prog)
+    base = TokenizedProgram.from_string(prog) if deltas else None
 
     for _ in range(num_mutated_progs):
-        tokens = prog
+        variant = index.copy()
 
         if exact:
             num_mutations = max_num_mutations
@@ -180,7 +269,7 @@ def id_mutate(rng, prog, max_num_mutations, num_mutated_progs, exact=False, name
         for _ in range(num_mutations):
             # Step 2: Induce _[ONE]_ mutation, removing empty lines and shifting program if required
             try:
-                mutated, this_fix, _ = undeclare_variable(rng, tokens)
+                this_fix, _ = undeclare_random_variable(rng, variant)
                 mutation_count += 1
             # Couldn't delete anything
             except NothingToMutateException:
@@ -191,22 +280,20 @@ def id_mutate(rng, prog, max_num_mutations, num_mutated_progs, exact=False, name
 
             # Deleted something that can't be fixed (all uses gone from the program)
             else:
-                # REPLACE! program with mutated version
-                tokens = mutated
-
-                if not fix_ids_are_in_program(mutated, this_fix):
+                if not variant.ids.all_occur_from(get_ids(this_fix), 0):
                     # Discarding previous fix: all uses are gone
                     continue
 
                 # Update fix line
                 if fix_line is not None:
                     fix_line = which_fix_goes_first(
-                        mutated, fix_line, this_fix)
+                        None, fix_line, this_fix, index=variant.ids)
                 else:
                     fix_line = this_fix
 
         if fix_line is not None:
-            corrupted.append(tokens)
+            # The program with all mutations of the variant
+            corrupted.append(variant.delta(base, index) if deltas else variant.program())
             fixes.append(fix_line)
 
     for fix in fixes:
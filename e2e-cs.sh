@@ -7,6 +7,7 @@ echo y | conda install pathlib regex subprocess32 tensorflow-gpu==1.0.1 typing
 
 mkdir logs
 export PYTHONPATH=.
+python data_processing/cs_corpus.py
 python data_processing/training_data_generator_cs.py
 bash neural_net/1fold-train.sh
 python post_processing/proc_cs.py data/Mutation/ > proc_cs.json
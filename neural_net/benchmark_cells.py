@@ -0,0 +1,105 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from neural_net.train import seq2seq_model, load_data
+
+
+def random_batch(rng, vocab_size, batch_size, max_length):
+    lengths = rng.randint(max_length / 2, max_length + 1, size=batch_size)
+    sequences = [rng.randint(2, vocab_size, size=length) for length in lengths]
+    return load_data.prepare_batch(sequences)
+
+
+def benchmark(cell_type, args):
+    rng = np.random.RandomState(1189)
+    graph = tf.Graph()
+
+    with graph.as_default():
+        model = seq2seq_model(args.vocab_size, args.embedding_dim, args.max_output_seq_len,
+                              cell_type=cell_type,
+                              memory_dim=args.memory_dim,
+                              num_layers=args.num_layers,
+                              dropout=args.dropout)
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=args.threads,
+                                inter_op_parallelism_threads=args.threads)
+        if args.cpu:
+            config.device_count['GPU'] = 0
+        sess = tf.Session(config=config)
+        sess.run(tf.global_variables_initializer())
+
+    batches = [random_batch(rng, args.vocab_size, args.batch_size, args.input_length) +
+               random_batch(rng, args.vocab_size, args.batch_size, args.output_length)
+               for _ in range(args.warmup + args.steps)]
+
+    results = {}
+
+    for name, step in [('train_step', lambda x, x_len, y, y_len: model.train_step(sess, x, x_len, y, y_len)),
+                       ('sample', lambda x, x_len, y, y_len: model.sample(sess, x, x_len))]:
+        for batch in batches[:args.warmup]:
+            step(*batch)
+
+        start_time = time.time()
+        for batch in batches[args.warmup:]:
+            step(*batch)
+        results[name] = (time.time() - start_time) / args.steps
+
+    sess.close()
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Time train_step() and sample() of the network for each LSTM cell type on synthetic batches.')
+    parser.add_argument('--cell_types', help='Comma separated cell types to compare',
+                        default='LSTM,LSTMBlock,LSTMBlockFused')
+    parser.add_argument('--data_directory', help='Take the vocabulary size from this data directory')
+    parser.add_argument('--vocab_size', type=int, help='vocabulary size', default=150)
+    parser.add_argument('-e', '--embedding_dim', type=int, help='embedding_dim', default=50)
+    parser.add_argument('-m', '--memory_dim', type=int, help='memory_dim', default=300)
+    parser.add_argument('-n', '--num_layers', type=int, help='num_layers', default=4)
+    parser.add_argument('-d', '--dropout', type=float, help='Probability of a unit getting dropped', default=0.2)
+    parser.add_argument('-o', '--max_output_seq_len', type=int, help='max_output_seq_len', default=28)
+    parser.add_argument('-b', '--batch_size', type=int, help='batch size', default=128)
+    parser.add_argument('--input_length', type=int, help='maximum encoder sequence length', default=400)
+    parser.add_argument('--output_length', type=int, help='maximum decoder sequence length', default=20)
+    parser.add_argument('--steps', type=int, help='timed steps per cell type', default=20)
+    parser.add_argument('--warmup', type=int, help='untimed steps per cell type', default=3)
+    parser.add_argument('--threads', type=int, help='intra/inter op threads (0 lets TensorFlow decide)', default=0)
+    parser.add_argument('--cpu', action='store_true', help='Hide the GPUs from TensorFlow')
+
+    args = parser.parse_args()
+
+    if args.data_directory is not None:
+        args.vocab_size = load_data(args.data_directory, shuffle=False, load_only_dicts=True).vocabulary_size
+
+    cell_types = args.cell_types.split(',')
+    results = {cell_type: benchmark(cell_type, args) for cell_type in cell_types}
+
+    baseline = results[cell_types[0]]
+    print '\n{:<16} {:>16} {:>10} {:>16} {:>10}'.format('cell_type', 'train_step (ms)', 'speedup', 'sample (ms)', 'speedup')
+    for cell_type in cell_types:
+        print '{:<16} {:>16.1f} {:>9.2f}x {:>16.1f} {:>9.2f}x'.format(
+            cell_type,
+            1000 * results[cell_type]['train_step'], baseline['train_step'] / results[cell_type]['train_step'],
+            1000 * results[cell_type]['sample'], baseline['sample'] / results[cell_type]['sample'])
@@ -0,0 +1,210 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import copy
+import argparse
+from shutil import copy as copy_file
+import numpy as np
+import tensorflow as tf
+
+from neural_net.train import load_data, seq2seq_model, evaluate, model_kwargs_from_args, list_checkpoints
+from neural_net.distill import sample_latency
+from util.helpers import make_dir_if_not_exists, Accuracy_calculator_for_deepfix
+
+
+# Low-rank factorization of a trained LSTM network:
+#
+#   python neural_net/compress.py data/checkpoints/iitk-typo-1189/bin_0/ \
+#       data/checkpoints/iitk-typo-1189-lowrank/bin_0/ --lstm_rank 128 --projection_rank 64
+#
+# initializes every LSTM weight matrix W (and the output projection) of the
+# low-rank network with the truncated SVD of the trained one, W ~ (U S^1/2)(S^1/2 V^T),
+# copies all other weights, and prints the train.py command for a short
+# fine-tune. --compare then reports accuracy and latency of both networks.
+
+
+def low_rank_factors(matrix, rank):
+    u, s, v = np.linalg.svd(matrix, full_matrices=False)
+    root_s = np.sqrt(s[:rank])
+    return u[:, :rank] * root_s, root_s[:, np.newaxis] * v[:rank]
+
+
+def source_variable(name):
+    '''(name of the trained variable, which factor) a low-rank variable is initialized from.'''
+    for low_rank, full, factor in [('low_rank_lstm_cell/weights_u', 'lstm_cell/weights', 0),
+                                   ('low_rank_lstm_cell/weights_v', 'lstm_cell/weights', 1),
+                                   ('low_rank_lstm_cell/biases', 'lstm_cell/biases', None),
+                                   ('decoder/projection_u', 'decoder/weights', 0),
+                                   ('decoder/projection_v', 'decoder/weights', 1)]:
+        if low_rank in name:
+            if factor is not None and not name.endswith(low_rank):
+                # Adam slot of a factor
+                return None, None
+            return name.replace(low_rank, full), factor
+    return name, None
+
+
+def compress_checkpoint(checkpoint, train_args, which_network, vocabulary_size, destination, step):
+    with tf.variable_scope(which_network):
+        model = seq2seq_model(vocabulary_size, scope=which_network, **model_kwargs_from_args(train_args))
+
+    sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+    sess.run(tf.global_variables_initializer())
+
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    old_shapes = reader.get_variable_to_shape_map()
+    factors = {}
+
+    for variable in model.saver._var_list:
+        name, factor = source_variable(variable.op.name)
+
+        if name is None or name not in old_shapes:
+            # Adam slots of the factors start from zero
+            print 'Left initialized:', variable.op.name
+            continue
+
+        if factor is None:
+            value = reader.get_tensor(name)
+        else:
+            rank = variable.get_shape().as_list()[1 - factor]
+            if name not in factors:
+                factors[name] = low_rank_factors(reader.get_tensor(name), rank)
+            value = factors[name][factor]
+
+        assert list(value.shape) == variable.get_shape().as_list(), \
+            '{}: {} from {}, {} expected'.format(variable.op.name, value.shape, name, variable.get_shape().as_list())
+        variable.load(value, sess)
+
+    for name, (u, v) in sorted(factors.items()):
+        full = reader.get_tensor(name)
+        print 'SVD of {} {}: rank {}, relative error {:.4f}'.format(
+            name, list(full.shape), u.shape[1], np.linalg.norm(full - np.dot(u, v)) / np.linalg.norm(full))
+
+    model.saver.save(sess, os.path.join(destination, 'saved-model-attn'), global_step=step)
+    sess.close()
+
+
+def weight_count(model):
+    '''Weights in the LSTM and output projection matrices, i.e. multiply-adds per example and timestep.'''
+    return sum(int(np.prod(variable.get_shape().as_list())) for variable in tf.trainable_variables()
+               if variable in model.saver._var_list and len(variable.get_shape()) == 2
+               and 'embedding' not in variable.op.name and 'attention' not in variable.op.name)
+
+
+def report(checkpoints_directory, batch_size, eval_max_examples, latency_batches):
+    configuration = np.load(os.path.join(checkpoints_directory, 'experiment-configuration.npy'),
+                            allow_pickle=True).item()
+    scope = configuration['which_network']
+
+    steps = list_checkpoints(os.path.join(checkpoints_directory, 'best'))
+    checkpoint = os.path.join(checkpoints_directory, 'best', 'saved-model-attn-%d' % steps[-1]) if steps else \
+        os.path.join(checkpoints_directory, 'saved-model-attn-%d' % list_checkpoints(checkpoints_directory)[-1])
+
+    graph = tf.Graph()
+    with graph.as_default():
+        dataset = load_data(configuration['args'].data_directory)
+        model_kwargs = model_kwargs_from_args(configuration['args'])
+        model_kwargs['dropout'] = 0
+        with tf.variable_scope(scope):
+            model = seq2seq_model(dataset.vocabulary_size, scope=scope, **model_kwargs)
+
+        sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+        model.load_parameters(sess, checkpoint)
+
+        get_all_accuracies_batch = Accuracy_calculator_for_deepfix(dataset.get_tl_dictionary()['~']).get_all_accuracies_batch
+        _, _, localization_accuracy, repair_accuracy = evaluate(sess, model, dataset, 'valid', batch_size,
+                                                                get_all_accuracies_batch, eval_max_examples)
+        latency = sample_latency(sess, model, dataset, batch_size, latency_batches)
+        weights = weight_count(model)
+        sess.close()
+
+    print '{:<60} {:>10} {:>10} {:>12} {:>12}'.format(checkpoint, localization_accuracy, repair_accuracy, weights,
+                                                      '%.1f ms' % (1000 * latency))
+    return repair_accuracy, weights, latency
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Factor the LSTM weights and output projection of a trained network into low-rank matrices.')
+    parser.add_argument('checkpoints_directory', help='Checkpoints directory of the trained network')
+    parser.add_argument('output_directory', help='Checkpoints directory of the low-rank network')
+    parser.add_argument('--lstm_rank', type=int, help='Rank of the LSTM weight matrices', default=None)
+    parser.add_argument('--projection_rank', type=int, help='Rank of the output projection', default=None)
+    parser.add_argument('-r', '--checkpoint', type=int,
+                        help='Step of the checkpoint to compress (default: the newest in best/)', default=None)
+    parser.add_argument('-e', '--epochs', type=int, help='Epochs of fine-tuning', default=5)
+    parser.add_argument('--compare', action='store_true',
+                        help='Instead of compressing, report validation accuracy, weights and CPU latency of both directories')
+    parser.add_argument('-b', '--batch_size', type=int, help='batch size', default=128)
+    parser.add_argument('--eval_max_examples', type=int,
+                        help='Compare on at most this many validation examples (0 for all)', default=0)
+    parser.add_argument('--latency_batches', type=int, help='Batches over which to time sample()', default=10)
+
+    args = parser.parse_args()
+
+    if args.compare:
+        print '{:<60} {:>10} {:>10} {:>12} {:>12}'.format('checkpoint', 'loc-acc', 'repair-acc', 'weights', 'sample()')
+        original = report(args.checkpoints_directory, args.batch_size, args.eval_max_examples, args.latency_batches)
+        compressed = report(args.output_directory, args.batch_size, args.eval_max_examples, args.latency_batches)
+        print '\nrepair accuracy {:+.4f}, {:.1f}% of the weights, {:.2f}x faster sample()'.format(
+            compressed[0] - original[0], 100.0 * compressed[1] / original[1], original[2] / compressed[2])
+        sys.exit(0)
+
+    assert args.lstm_rank is not None or args.projection_rank is not None, 'pass --lstm_rank and/or --projection_rank'
+
+    configuration = np.load(os.path.join(args.checkpoints_directory, 'experiment-configuration.npy'),
+                            allow_pickle=True).item()
+    assert configuration['args'].cell_type == 'LSTM' or args.lstm_rank is None, '--lstm_rank needs an LSTM network'
+
+    if args.checkpoint is None:
+        checkpoint = os.path.join(args.checkpoints_directory, 'best', 'saved-model-attn-%d' %
+                                  list_checkpoints(os.path.join(args.checkpoints_directory, 'best'))[-1])
+    else:
+        checkpoint = os.path.join(args.checkpoints_directory, 'saved-model-attn-%d' % args.checkpoint)
+    step = int(checkpoint.rsplit('-', 1)[1])
+
+    train_args = copy.deepcopy(configuration['args'])
+    train_args.lstm_rank = args.lstm_rank
+    train_args.projection_rank = args.projection_rank
+
+    dataset = load_data(train_args.data_directory, shuffle=False, load_only_dicts=True)
+
+    make_dir_if_not_exists(os.path.join(args.output_directory, 'best'))
+    compress_checkpoint(checkpoint, train_args, configuration['which_network'], dataset.vocabulary_size,
+                        args.output_directory, step)
+
+    # Also servable before fine-tuning
+    for each_file in os.listdir(args.output_directory):
+        if each_file.startswith('saved-model-attn-%d.' % step):
+            copy_file(os.path.join(args.output_directory, each_file), os.path.join(args.output_directory, 'best'))
+
+    configuration = dict(configuration)
+    configuration['args'] = train_args
+    np.save(os.path.join(args.output_directory, 'experiment-configuration.npy'), configuration)
+
+    print '\nLow-rank checkpoint written to', os.path.join(args.output_directory, 'saved-model-attn-%d' % step)
+    print 'Fine-tune with:\n'
+    print 'python -O neural_net/train.py {} {} -r {} -re 0 -e {} --embedding_dim {} --memory_dim {} -n {} --cell_type {} -o {} -d {}{}{}'.format(
+        train_args.data_directory, args.output_directory, step, args.epochs, train_args.embedding_dim,
+        train_args.memory_dim, train_args.num_layers, train_args.cell_type, train_args.max_output_seq_len,
+        train_args.dropout, ' --lstm_rank %d' % args.lstm_rank if args.lstm_rank else '',
+        ' --projection_rank %d' % args.projection_rank if args.projection_rank else '')
+    print '\nthen compare with:\n'
+    print 'python neural_net/compress.py {} {} --compare'.format(args.checkpoints_directory, args.output_directory)
@@ -0,0 +1,133 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import re
+import copy
+import argparse
+import numpy as np
+import tensorflow as tf
+from shutil import copy as copy_file
+
+from neural_net.train import load_data, seq2seq_model, list_checkpoints
+from util.helpers import make_dir_if_not_exists
+
+
+class VariableMappingException(Exception):
+    pass
+
+
+# Scope names the different LSTM implementations create their weights under
+CELL_SCOPE_REGEX = re.compile(
+    r'\A(lstm_cell|lstm_block_cell|LSTMBlockCell|lstm_block_fused_cell|LSTMBlockFusedCell|lstm_block_wrapper)\Z')
+CELL_INDEX_REGEX = re.compile(r'\Acell_(\d+)\Z')
+
+
+# LSTMCell, LSTMBlockCell and LSTMBlockFusedCell store the same [input + memory, 4 * memory]
+# weights (gates i, j, f, o) and [4 * memory] biases, only their variable scopes differ.
+# Returns (network/section, layer, name inside the cell) for LSTM variables, the name otherwise
+def variable_key(name):
+    name = name.split(':')[0]
+    parts = name.split('/')
+
+    for k, part in enumerate(parts):
+        if CELL_SCOPE_REGEX.match(part):
+            layer = None
+            for previous in parts[:k]:
+                match = CELL_INDEX_REGEX.match(previous)
+                if match is not None:
+                    layer = int(match.group(1))
+            return '/'.join(parts[:2]), layer, '/'.join(parts[k + 1:])
+
+    return name
+
+
+class checkpoint_converter:
+    '''Rewrites saved-model-attn-* checkpoints for a model built with another LSTM cell_type.'''
+
+    def __init__(self, train_args, which_network, cell_type):
+        dataset = load_data(train_args.data_directory, shuffle=False, load_only_dicts=True)
+
+        with tf.variable_scope(which_network):
+            self.model = seq2seq_model(dataset.vocabulary_size, train_args.embedding_dim,
+                                       train_args.max_output_seq_len,
+                                       cell_type=cell_type,
+                                       memory_dim=train_args.memory_dim,
+                                       num_layers=train_args.num_layers,
+                                       dropout=train_args.dropout,
+                                       scope=which_network
+                                       )
+
+        self.variables = self.model.saver._var_list
+        self.sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    def convert(self, source, destination):
+        reader = tf.train.NewCheckpointReader(source)
+        source_shapes = reader.get_variable_to_shape_map()
+        source_names = {variable_key(name): name for name in source_shapes}
+
+        for variable in self.variables:
+            key = variable_key(variable.name)
+
+            if key not in source_names:
+                raise VariableMappingException('{} not found in {}'.format(variable.name, source))
+
+            source_name = source_names[key]
+            if list(source_shapes[source_name]) != variable.get_shape().as_list():
+                raise VariableMappingException('{}: shape {} in {}, {} expected'.format(
+                    variable.name, source_shapes[source_name], source, variable.get_shape().as_list()))
+
+            self.sess.run(variable.assign(reader.get_tensor(source_name)))
+
+        self.model.saver.save(self.sess, destination)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Convert the checkpoints of a trained network to another LSTM cell type.')
+    parser.add_argument('checkpoints_directory', help='Checkpoints directory to convert')
+    parser.add_argument('output_directory', help='Where to write the converted checkpoints directory')
+    parser.add_argument('--cell_type', help='One of LSTM, LSTMBlock or LSTMBlockFused.',
+                        choices=['LSTM', 'LSTMBlock', 'LSTMBlockFused'], default='LSTMBlock')
+
+    args = parser.parse_args()
+
+    configuration = np.load(os.path.join(args.checkpoints_directory, 'experiment-configuration.npy'),
+                            allow_pickle=True).item()
+    assert 'LSTM' in configuration['args'].cell_type, 'only LSTM networks can be converted'
+
+    converter = checkpoint_converter(configuration['args'], configuration['which_network'], args.cell_type)
+
+    for subdirectory in ['', 'best']:
+        make_dir_if_not_exists(os.path.join(args.output_directory, subdirectory))
+
+        for step in list_checkpoints(os.path.join(args.checkpoints_directory, subdirectory)):
+            name = 'saved-model-attn-%d' % step
+            print 'Converting', os.path.join(subdirectory, name), '...'
+            converter.convert(os.path.join(args.checkpoints_directory, subdirectory, name),
+                              os.path.join(args.output_directory, subdirectory, name))
+
+    if os.path.exists(os.path.join(args.checkpoints_directory, 'best', 'best.txt')):
+        copy_file(os.path.join(args.checkpoints_directory, 'best', 'best.txt'),
+                  os.path.join(args.output_directory, 'best'))
+
+    configuration = copy.deepcopy(configuration)
+    configuration['args'].cell_type = args.cell_type
+    np.save(os.path.join(args.output_directory, 'experiment-configuration.npy'), configuration)
+
+    print 'Converted checkpoints written to', args.output_directory
@@ -0,0 +1,246 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from neural_net.train import load_data, seq2seq_model, evaluate, update_best_ckpt, get_dataset_name, \
+    model_kwargs_from_args, list_checkpoints
+from util.helpers import make_dir_if_not_exists, buffered_logger, Accuracy_calculator_for_deepfix
+
+
+# Trains a small student network on the examples of a trained (teacher)
+# network, against both the targets and the teacher's output distributions.
+# The student's checkpoints directory looks like one written by train.py, so
+# evaluate_checkpoints.py, generate_fixes.py and proc_cs.py all work with it.
+
+
+def load_teacher(checkpoints_directory, checkpoint, vocabulary_size, vram):
+    configuration = np.load(os.path.join(checkpoints_directory, 'experiment-configuration.npy'),
+                            allow_pickle=True).item()
+    scope = configuration['which_network']
+
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.variable_scope(scope):
+            model = seq2seq_model(vocabulary_size, scope=scope, **model_kwargs_from_args(configuration['args']))
+
+        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=vram)
+        session = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+        model.load_parameters(session, checkpoint)
+
+    return configuration, model, session
+
+
+def sample_latency(session, model, dataset, batch_size, num_batches):
+    '''Mean seconds per sample() call over the first [num_batches] test (or validation) batches.'''
+    which = 'test' if dataset.data_size[2] >= batch_size else 'valid'
+    num_batches = min(num_batches, dataset.data_size[2 if which == 'test' else 1] / batch_size)
+    if num_batches == 0:
+        return float('nan')
+
+    elapsed = 0.0
+    for i in range(num_batches):
+        x, x_len, _, _ = dataset.get_batch(i * batch_size, (i + 1) * batch_size, which=which)
+        start_time = time.time()
+        model.sample(session, x, x_len)
+        elapsed += time.time() - start_time
+
+    return elapsed / num_batches
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Distill a trained network into a smaller student network.')
+    parser.add_argument('teacher_checkpoints_directory', help='Checkpoints directory of the teacher')
+    parser.add_argument('checkpoints_directory', help='Checkpoints directory of the student')
+    parser.add_argument('--data_directory',
+                        help='Data directory (default: the one the teacher was trained on)', default=None)
+    parser.add_argument('--teacher_checkpoint', type=int,
+                        help='Step of the teacher checkpoint (default: the newest in best/)', default=None)
+    parser.add_argument('-b', "--batch_size", type=int,
+                        help="batch size", default=128)
+    parser.add_argument("--embedding_dim", type=int,
+                        help="embedding_dim of the student", default=50)
+    parser.add_argument("--memory_dim", type=int,
+                        help="memory_dim of the student", default=128)
+    parser.add_argument('-n', "--num_layers", type=int,
+                        help="num_layers of the student", default=1)
+    parser.add_argument(
+        '--cell_type', help='Cell of the student, one of LSTM, LSTMBlock, LSTMBlockFused or GRU.', default='GRU')
+    parser.add_argument(
+        '-d', '--dropout', help='Probability to use for dropout', type=float, default=0.2)
+    parser.add_argument('-a', '--alpha', type=float,
+                        help='Weight of the soft (teacher) targets, 1 - alpha goes to the true targets', default=0.5)
+    parser.add_argument('-T', '--temperature', type=float,
+                        help='Softmax temperature of the soft targets', default=2.0)
+    parser.add_argument('-e', "--epochs", type=int, help="epochs", default=20)
+    parser.add_argument(
+        '-c', '--ckpt_every', help='How often to save checkpoints', type=int, default=500)
+    parser.add_argument('--eval_every', type=int,
+                        help='Evaluate on the validation and test sets every k epochs', default=1)
+    parser.add_argument('--eval_max_examples', type=int,
+                        help='Evaluate on at most this many validation/test examples (0 for all)', default=0)
+    parser.add_argument('--latency_batches', type=int,
+                        help='Batches over which to compare the sample() latency of teacher and student', default=10)
+    parser.add_argument(
+        '-v', '--vram', help='Fraction of GPU memory to use for the student', type=float, default=0.6)
+    parser.add_argument(
+        '--teacher_vram', help='Fraction of GPU memory to use for the teacher', type=float, default=0.3)
+
+    args = parser.parse_args()
+
+    dataset_name = get_dataset_name(args.checkpoints_directory)
+    log = buffered_logger('log-distill-' + dataset_name + '.txt')
+    print '\nlogging into {}'.format(log.log_file)
+    sys.stdout = log
+
+    teacher_configuration = np.load(os.path.join(args.teacher_checkpoints_directory, 'experiment-configuration.npy'),
+                                    allow_pickle=True).item()
+    which_network = teacher_configuration['which_network']
+
+    if args.data_directory is None:
+        args.data_directory = teacher_configuration['args'].data_directory
+    # Decoding length has to match the teacher's for the logits to line up
+    args.max_output_seq_len = teacher_configuration['args'].max_output_seq_len
+
+    if args.teacher_checkpoint is None:
+        args.teacher_checkpoint = list_checkpoints(os.path.join(args.teacher_checkpoints_directory, 'best'))[-1]
+    teacher_checkpoint = os.path.join(args.teacher_checkpoints_directory, 'best', 'saved-model-attn-%d' % args.teacher_checkpoint)
+    if not os.path.exists(teacher_checkpoint + '.meta'):
+        teacher_checkpoint = os.path.join(args.teacher_checkpoints_directory, 'saved-model-attn-%d' % args.teacher_checkpoint)
+
+    make_dir_if_not_exists(args.checkpoints_directory)
+    make_dir_if_not_exists(os.path.join(args.checkpoints_directory, 'best'))
+
+    configuration = {}
+    configuration["args"] = args
+    configuration["log"] = 'log-distill-' + dataset_name + '.txt'
+    configuration['which_network'] = which_network
+    configuration['teacher'] = teacher_checkpoint
+
+    np.save(os.path.join(args.checkpoints_directory,
+                         'experiment-configuration.npy'), configuration)
+
+    print 'teacher                   :', teacher_checkpoint
+    print 'data_directory            :', args.data_directory
+    print 'checkpoints_directory     :', args.checkpoints_directory
+    print 'Batch size                :', args.batch_size
+    print 'Embedding dim             :', args.embedding_dim
+    print 'Memory dim                :', args.memory_dim
+    print 'Layers                    :', args.num_layers
+    print 'cell type                 :', args.cell_type
+    print 'alpha                     :', args.alpha
+    print 'temperature               :', args.temperature
+    print 'Epochs                    :', args.epochs
+    print 'network                   :', which_network
+
+    dataset = load_data(args.data_directory)
+    get_all_accuracies_batch = Accuracy_calculator_for_deepfix(dataset.get_tl_dictionary()['~']).get_all_accuracies_batch
+    num_train, num_validation, num_test = dataset.data_size
+    print 'Training:', num_train, 'examples', '\nValidation:', num_validation, 'examples', '\nTest:', num_test, 'examples'
+
+    _, teacher, teacher_sess = load_teacher(args.teacher_checkpoints_directory, teacher_checkpoint,
+                                            dataset.vocabulary_size, args.teacher_vram)
+
+    student_graph = tf.Graph()
+    with student_graph.as_default():
+        with tf.variable_scope(which_network):
+            student = seq2seq_model(dataset.vocabulary_size, args.embedding_dim,
+                                    args.max_output_seq_len,
+                                    cell_type=args.cell_type,
+                                    memory_dim=args.memory_dim,
+                                    num_layers=args.num_layers,
+                                    dropout=args.dropout,
+                                    scope=which_network,
+                                    distillation_alpha=args.alpha,
+                                    distillation_temperature=args.temperature
+                                    )
+
+        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.vram)
+        sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+        sess.run(tf.global_variables_initializer())
+
+    step = 0
+    best_overall_accuracy = 0
+    steps_per_epoch = num_train / args.batch_size
+
+    for t in range(args.epochs):
+        start_time = time.time()
+        train_loss = []
+
+        for i in range(steps_per_epoch):
+            x, x_len, y, y_len = dataset.get_batch(i * args.batch_size, (i + 1) * args.batch_size, which='train')
+
+            teacher_logits = teacher.get_logits(teacher_sess, x, x_len, y, y_len)
+            loss = student.train_step(sess, x, x_len, y, y_len, teacher_logits=teacher_logits)
+            train_loss.append(loss)
+
+            step += 1
+            print "Step: {}/{},\tMinibatch: {},\tEpoch: {},\tLoss: {}".format(step, steps_per_epoch, i, t + float(i + 1) / steps_per_epoch, loss)
+
+            if step % args.ckpt_every == 0:
+                student.save_parameters(sess, os.path.join(
+                    args.checkpoints_directory, 'saved-model-attn'), global_step=step)
+                print "[Checkpoint] Checkpointed at Epoch %d, Minibatch %d." % (t, i)
+
+        if step % args.ckpt_every != 0:
+            student.save_parameters(sess, os.path.join(
+                args.checkpoints_directory, 'saved-model-attn'), global_step=step)
+            print "[Checkpoint] Checkpointed at Epoch {}, Minibatch {}.".format(t + 1, 0)
+
+        print "End of Epoch: {}".format(t + 1)
+        print "[Training] Loss: {}".format(np.mean(train_loss))
+
+        if (t + 1) % args.eval_every == 0 or t + 1 == args.epochs:
+            for which in ['valid', 'test']:
+                loss, token_acc, localization_accuracy, repair_accuracy = evaluate(
+                    sess, student, dataset, which, args.batch_size, get_all_accuracies_batch, args.eval_max_examples)
+
+                print "[{}] Epoch: {}, Loss: {}, Token-level-acc: {}, loc-acc: {}, repair-acc: {}" .format(which,
+                                                                                                           t + 1, loss, token_acc, localization_accuracy, repair_accuracy)
+
+                if (num_test > 0 and which == 'test') or (num_test == 0 and which == 'valid'):
+                    if repair_accuracy > best_overall_accuracy:
+                        best_overall_accuracy = repair_accuracy
+                        update_best_ckpt(args.checkpoints_directory, step, epoch=t + 1, loss=loss, token_acc=token_acc,
+                                         localization_accuracy=localization_accuracy, repair_accuracy=repair_accuracy)
+                        print "[Best Checkpoint] Checkpointed at Epoch %d, Minibatch %d." % (t + 1, 0)
+
+        print "[Time] Took {} minutes to run." .format((time.time() - start_time) / 60)
+
+    ##############################################################################
+
+    which = 'test' if num_test > 0 else 'valid'
+    _, _, _, teacher_repair_accuracy = evaluate(teacher_sess, teacher, dataset, which, args.batch_size,
+                                                get_all_accuracies_batch, args.eval_max_examples)
+    teacher_latency = sample_latency(teacher_sess, teacher, dataset, args.batch_size, args.latency_batches)
+    student_latency = sample_latency(sess, student, dataset, args.batch_size, args.latency_batches)
+
+    print '\n[Distillation] {} repair accuracy: teacher {}, best student {} ({:.1f}%)'.format(
+        which, teacher_repair_accuracy, best_overall_accuracy, 100.0 * best_overall_accuracy / max(teacher_repair_accuracy, 1e-9))
+    print '[Distillation] sample() per batch of {}: teacher {:.1f} ms, student {:.1f} ms ({:.2f}x faster)'.format(
+        args.batch_size, 1000 * teacher_latency, 1000 * student_latency, teacher_latency / student_latency)
+
+    sess.close()
+    teacher_sess.close()
+    log.close()
@@ -0,0 +1,223 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import math
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from neural_net.train import load_data, seq2seq_model, evaluate, update_best_ckpt, get_dataset_name, early_stopping, \
+    list_checkpoints, model_kwargs_from_args, read_best_ckpt, stage_checkpoint, unstage_checkpoint, CheckpointVanishedException, \
+    TRAINING_DONE_MARKER, EARLY_STOP_MARKER, STAGING_DIRECTORY
+from util.helpers import buffered_logger, Accuracy_calculator_for_deepfix
+
+
+class checkpoint_evaluator:
+    '''Scores the saved-model-attn-* checkpoints written by train.py and keeps
+    best/ and best/best.txt up to date, exactly as train.py does in-process.'''
+
+    def __init__(self, checkpoints_directory, batch_size, vram, max_examples=None, stopper=None,
+                 eval_every=0, epochs=None, resume=False):
+        self.checkpoints_directory = checkpoints_directory
+        self.batch_size = batch_size
+        self.max_examples = max_examples
+        self.stopper = stopper
+        self.eval_every = eval_every
+        self.epochs = epochs
+
+        configuration = np.load(os.path.join(checkpoints_directory, 'experiment-configuration.npy'),
+                                allow_pickle=True).item()
+        train_args = configuration['args']
+        scope = configuration['which_network']
+
+        self.dataset = load_data(train_args.data_directory)
+        self.get_all_accuracies_batch = Accuracy_calculator_for_deepfix(
+            self.dataset.get_tl_dictionary()['~']).get_all_accuracies_batch
+
+        num_train, _, self.num_test = self.dataset.data_size
+        self.steps_per_epoch = max(num_train / train_args.batch_size, 1)
+
+        # Same dropout as the training graph, validate_step() feeds the same keep_prob
+        with tf.variable_scope(scope):
+            self.model = seq2seq_model(self.dataset.vocabulary_size, scope=scope,
+                                       **model_kwargs_from_args(train_args))
+
+        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=vram)
+        self.sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+
+        self.best_overall_accuracy = 0
+
+        # Carry on from where the evaluator of the previous run stopped
+        if resume:
+            _, self.best_overall_accuracy = read_best_ckpt(checkpoints_directory)
+            if self.stopper is not None:
+                self.stopper.restore(checkpoints_directory)
+
+    def is_scheduled(self, step):
+        '''With [eval_every] > 0, only the checkpoints at the end of every eval_every-th
+        epoch (and of the last one) are scored, as train.py does in-process.'''
+        if self.eval_every <= 0:
+            return True
+        epoch, minibatch = divmod(step, self.steps_per_epoch)
+        return minibatch == 0 and (epoch % self.eval_every == 0 or epoch == self.epochs)
+
+    def evaluate_checkpoint(self, step):
+        # train.py keeps only the last few checkpoints, the staged copy outlives the evaluation
+        staging_directory = os.path.join(self.checkpoints_directory, STAGING_DIRECTORY)
+        checkpoint = stage_checkpoint(self.checkpoints_directory, step, staging_directory)
+
+        try:
+            return self._evaluate_staged(step, checkpoint, staging_directory)
+        finally:
+            unstage_checkpoint(staging_directory, step)
+
+    def _evaluate_staged(self, step, checkpoint, staging_directory):
+        try:
+            self.model.load_parameters(self.sess, checkpoint)
+        except (tf.errors.NotFoundError, tf.errors.DataLossError):
+            # Removed while it was being staged
+            raise CheckpointVanishedException(checkpoint)
+
+        epoch = int(math.ceil(float(step) / self.steps_per_epoch))
+        results = {}
+
+        for which in ['valid', 'test']:
+            loss, token_acc, localization_accuracy, repair_accuracy = evaluate(
+                self.sess, self.model, self.dataset, which, self.batch_size, self.get_all_accuracies_batch,
+                self.max_examples)
+            results[which] = loss, token_acc, localization_accuracy, repair_accuracy
+
+            print "[{}] Epoch: {}, Step: {}, Loss: {}, Token-level-acc: {}, loc-acc: {}, repair-acc: {}" .format(which,
+                                                                                                                 epoch, step, loss, token_acc, localization_accuracy, repair_accuracy)
+
+        loss, token_acc, localization_accuracy, repair_accuracy = results['test' if self.num_test > 0 else 'valid']
+
+        if repair_accuracy > self.best_overall_accuracy:
+            self.best_overall_accuracy = repair_accuracy
+            update_best_ckpt(self.checkpoints_directory, step, source_directory=staging_directory, epoch=epoch,
+                             loss=loss, token_acc=token_acc, localization_accuracy=localization_accuracy,
+                             repair_accuracy=repair_accuracy)
+
+            print "[Best Checkpoint] Checkpointed at Epoch %d, Step %d." % (epoch, step)
+
+        if self.stopper is not None:
+            valid_loss, _, _, valid_repair_accuracy = results['valid']
+            if not self.stopper.update(valid_loss, valid_repair_accuracy):
+                print "[Early Stopping] No improvement in {} for {} evaluation(s).".format(self.stopper.metric, self.stopper.bad_evaluations)
+            self.stopper.save(self.checkpoints_directory)
+
+        return results
+
+    def run(self, start_after=0, poll_interval=30, latest_only=False):
+        last_evaluated = start_after
+        done_marker = os.path.join(self.checkpoints_directory, TRAINING_DONE_MARKER)
+
+        while True:
+            # Check the marker before listing, so that the last checkpoint is never missed
+            training_done = os.path.exists(done_marker)
+            pending = [step for step in list_checkpoints(self.checkpoints_directory)
+                       if step > last_evaluated and self.is_scheduled(step)]
+
+            if latest_only and len(pending) > 1:
+                print 'Skipping checkpoints:', pending[:-1]
+                pending = pending[-1:]
+
+            for step in pending:
+                start_time = time.time()
+
+                try:
+                    self.evaluate_checkpoint(step)
+                except CheckpointVanishedException as e:
+                    print 'Checkpoint removed before it could be evaluated:', e.args[0]
+
+                last_evaluated = step
+                print "[Time] Took {} minutes to evaluate.".format((time.time() - start_time) / 60)
+                sys.stdout.flush()
+
+                if self.stopper is not None and self.stopper.should_stop:
+                    print "[Early Stopping] Asking train.py to stop after Step {}.".format(step)
+                    open(os.path.join(self.checkpoints_directory, EARLY_STOP_MARKER), 'w').close()
+                    break
+
+                if latest_only:
+                    break
+
+            if (training_done and not pending) or (self.stopper is not None and self.stopper.should_stop):
+                break
+
+            if not pending:
+                time.sleep(poll_interval)
+
+        self.sess.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Asynchronously evaluate the checkpoints written by train.py.')
+    parser.add_argument('checkpoints_directory', help='Checkpoints directory')
+    parser.add_argument('-b', "--batch_size", type=int,
+                        help="batch size", default=128)
+    parser.add_argument(
+        '-v', '--vram', help='Fraction of GPU memory to use', type=float, default=0.1)
+    parser.add_argument('-p', '--poll_interval', type=int,
+                        help='Seconds to wait between looking for new checkpoints', default=30)
+    parser.add_argument('--start_after', type=int,
+                        help='Only evaluate checkpoints saved after this step', default=0)
+    parser.add_argument('--latest_only', action='store_true',
+                        help='When falling behind, skip straight to the newest checkpoint')
+    parser.add_argument('--max_examples', type=int,
+                        help='Evaluate on at most this many validation/test examples (0 for all)', default=0)
+    parser.add_argument('--eval_every', type=int,
+                        help='Only score the checkpoints at the end of every k epochs (0 for every checkpoint)', default=0)
+    parser.add_argument('--epochs', type=int,
+                        help='Epochs train.py runs for, its last checkpoint is always scored', default=None)
+    parser.add_argument('--patience', type=int,
+                        help='Ask train.py to stop after this many evaluations without improvement (0 to disable)', default=0)
+    parser.add_argument('--early_stopping_metric', choices=['repair_accuracy', 'loss'],
+                        help='Validation metric used for early stopping', default='repair_accuracy')
+    parser.add_argument('--min_delta', type=float,
+                        help='Minimum change of the early stopping metric that counts as an improvement', default=0.0)
+
+    args = parser.parse_args()
+
+    log = buffered_logger('eval-' + get_dataset_name(args.checkpoints_directory) + '.txt')
+    print '\nlogging into {}'.format(log.log_file)
+    sys.stdout = log
+
+    print 'checkpoints_directory     :', args.checkpoints_directory
+    print 'Batch size                :', args.batch_size
+    print 'vram                      :', args.vram
+    print 'Poll interval             :', args.poll_interval
+    print 'Start after               :', args.start_after
+    print 'Latest only               :', args.latest_only
+    print 'Max examples              :', args.max_examples
+    print 'Eval every                :', args.eval_every
+    print 'Patience                  :', args.patience
+    print 'Early stopping metric     :', args.early_stopping_metric
+
+    stopper = early_stopping(args.patience, args.early_stopping_metric, args.min_delta) if args.patience > 0 else None
+    evaluator = checkpoint_evaluator(args.checkpoints_directory, args.batch_size, args.vram,
+                                     max_examples=args.max_examples, stopper=stopper,
+                                     eval_every=args.eval_every, epochs=args.epochs, resume=args.start_after > 0)
+    evaluator.run(start_after=args.start_after, poll_interval=args.poll_interval,
+                  latest_only=args.latest_only)
+
+    log.close()
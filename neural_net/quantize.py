@@ -0,0 +1,226 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from neural_net.train import load_data, seq2seq_model, evaluate, model_kwargs_from_args, list_checkpoints, \
+    QUANTIZATION_MODES, quantization_reduce_axes
+from neural_net.distill import sample_latency
+from util.helpers import Accuracy_calculator_for_deepfix
+
+
+# Post-training weight quantization. Only what inference needs is kept: the
+# trainable variables, without Adam's slots. Matrices (LSTM kernels, attention,
+# output projection) are stored as int8 with one symmetric scale per output
+# channel (last axis), the embedding with one per token (row), or as float16;
+# biases stay float32.
+#
+# seq2seq_model(quantized=mode) keeps these arrays as int8 (or float16)
+# variables and casts them to float32 where they are used, so the weights of
+# every fold model a serving process hosts take a quarter (or half) of the
+# float32 memory. serving_memory() measures what each one adds.
+
+
+def quantize_array(value, mode, name):
+    '''Returns {suffix: array} for one variable.'''
+    if value.ndim < 2:
+        return {'': value.astype(np.float32)}
+
+    if mode == 'float16':
+        return {'/float16': value.astype(np.float16)}
+
+    assert mode == 'int8', 'unknown quantization mode: %s' % mode
+    scale = np.max(np.abs(value), axis=quantization_reduce_axes(name, value.ndim), keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    quantized = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+    return {'/int8': quantized, '/scale': scale.astype(np.float32)}
+
+
+def quantized_mode(quantized_file):
+    '''The mode quantized_file was written with, to build its seq2seq_model(quantized=...).'''
+    names = np.load(quantized_file).files
+    for mode in QUANTIZATION_MODES:
+        if any(name.endswith('/' + mode) for name in names):
+            return mode
+    raise ValueError('{} holds no quantized weights'.format(quantized_file))
+
+
+def inference_variables(model):
+    trainable = set(tf.trainable_variables())
+    return [variable for variable in model.saver._var_list if variable in trainable]
+
+
+def quantize_checkpoint(checkpoint, variable_names, mode, destination):
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    arrays = {}
+
+    for name in variable_names:
+        for suffix, array in quantize_array(reader.get_tensor(name), mode, name).items():
+            arrays[name + suffix] = array
+
+    np.savez(destination, **arrays)
+    return destination if destination.endswith('.npz') else destination + '.npz'
+
+
+def load_quantized(session, model, quantized_file):
+    '''Loads a file written by quantize_checkpoint() into [model], built with
+    seq2seq_model(quantized=quantized_mode(quantized_file)), in place of load_parameters().'''
+    assert model.quantized is not None, 'build the model with quantized=quantized_mode(quantized_file)'
+    arrays = np.load(quantized_file)
+    for variable in model.saver._var_list:
+        variable.load(arrays[variable.op.name], session)
+
+
+def weight_bytes(model):
+    '''Memory taken by the variables of [model].'''
+    return sum(variable.dtype.base_dtype.size * variable.get_shape().num_elements()
+               for variable in model.saver._var_list)
+
+
+def resident_memory():
+    '''Resident set size of this process in bytes, or None where /proc is missing.'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def serving_memory(vocabulary_size, scope, model_kwargs, load, x, x_len):
+    '''(bytes, weight bytes, session): the resident memory one more fold model adds
+    to a serving process, in a graph and CPU session of its own, loaded by
+    load(session, model) and run once, and the memory its variables take. Keep the
+    session open while measuring the next one, so that its memory is not reused.'''
+    before = resident_memory()
+    graph = tf.Graph()
+
+    with graph.as_default():
+        with tf.variable_scope(scope):
+            model = seq2seq_model(vocabulary_size, scope=scope, **model_kwargs)
+        session = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+        load(session, model)
+        model.sample(session, x, x_len)
+
+    after = resident_memory()
+    return (after - before if before is not None and after is not None else None), weight_bytes(model), session
+
+
+def float32_bytes(checkpoint, variable_names):
+    shapes = tf.train.NewCheckpointReader(checkpoint).get_variable_to_shape_map()
+    return sum(4 * int(np.prod(shapes[name])) for name in variable_names)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Quantize the weights of a trained network and compare it with the float model.')
+    parser.add_argument('checkpoints_directory', help='Checkpoints directory')
+    parser.add_argument('-m', '--mode', choices=QUANTIZATION_MODES, default='int8')
+    parser.add_argument('-r', '--checkpoint', type=int,
+                        help='Step of the checkpoint to quantize (default: the newest in best/)', default=None)
+    parser.add_argument('-o', '--output',
+                        help='Output file (default: <checkpoint>.<mode>.npz next to the checkpoint)', default=None)
+    parser.add_argument('-b', '--batch_size', type=int, help='batch size', default=128)
+    parser.add_argument('--eval_max_examples', type=int,
+                        help='Compare on at most this many validation examples (0 for all)', default=0)
+    parser.add_argument('--latency_batches', type=int,
+                        help='Batches over which to time sample()', default=10)
+    parser.add_argument('--skip_evaluation', action='store_true', help='Only write the quantized weights')
+
+    args = parser.parse_args()
+
+    configuration = np.load(os.path.join(args.checkpoints_directory, 'experiment-configuration.npy'),
+                            allow_pickle=True).item()
+    scope = configuration['which_network']
+
+    if args.checkpoint is None:
+        checkpoint = os.path.join(args.checkpoints_directory, 'best', 'saved-model-attn-%d' %
+                                  list_checkpoints(os.path.join(args.checkpoints_directory, 'best'))[-1])
+    else:
+        checkpoint = os.path.join(args.checkpoints_directory, 'saved-model-attn-%d' % args.checkpoint)
+
+    if args.output is None:
+        args.output = '{}.{}.npz'.format(checkpoint, args.mode)
+
+    dataset = load_data(configuration['args'].data_directory, shuffle=not args.skip_evaluation,
+                        load_only_dicts=args.skip_evaluation)
+
+    model_kwargs = model_kwargs_from_args(configuration['args'])
+    model_kwargs['dropout'] = 0
+    with tf.variable_scope(scope):
+        model = seq2seq_model(dataset.vocabulary_size, scope=scope, **model_kwargs)
+
+    variable_names = [variable.op.name for variable in inference_variables(model)]
+    quantized_file = quantize_checkpoint(checkpoint, variable_names, args.mode, args.output)
+
+    float_size = float32_bytes(checkpoint, variable_names)
+    quantized_size = os.path.getsize(quantized_file)
+    print 'Quantized {} into {}'.format(checkpoint, quantized_file)
+    print 'Inference weights: {:.2f} MB as float32, {:.2f} MB as {} ({:.1f}%)'.format(
+        float_size / 2.0 ** 20, quantized_size / 2.0 ** 20, args.mode, 100.0 * quantized_size / float_size)
+
+    if args.skip_evaluation:
+        sys.exit(0)
+
+    # The quantized weights are variables of another dtype, in a graph of their own
+    quantized_graph = tf.Graph()
+    with quantized_graph.as_default():
+        with tf.variable_scope(scope):
+            quantized_model = seq2seq_model(dataset.vocabulary_size, scope=scope, quantized=args.mode,
+                                            **model_kwargs)
+
+    get_all_accuracies_batch = Accuracy_calculator_for_deepfix(dataset.get_tl_dictionary()['~']).get_all_accuracies_batch
+
+    results = {}
+    for name, graph, evaluated_model, load in [
+            ('float32', tf.get_default_graph(), model, lambda session: model.load_parameters(session, checkpoint)),
+            (args.mode, quantized_graph, quantized_model,
+             lambda session: load_quantized(session, quantized_model, quantized_file))]:
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+        load(sess)
+        loss, token_acc, localization_accuracy, repair_accuracy = evaluate(
+            sess, evaluated_model, dataset, 'valid', args.batch_size, get_all_accuracies_batch, args.eval_max_examples)
+        latency = sample_latency(sess, evaluated_model, dataset, args.batch_size, args.latency_batches)
+        results[name] = repair_accuracy
+        sess.close()
+
+        print "[{}] Loss: {}, Token-level-acc: {}, loc-acc: {}, repair-acc: {}, sample(): {:.1f} ms per batch of {} (CPU)".format(
+            name, loss, token_acc, localization_accuracy, repair_accuracy, 1000 * latency, args.batch_size)
+
+    print 'Validation repair accuracy change: {:+.4f}'.format(results[args.mode] - results['float32'])
+
+    x, x_len, _, _ = dataset.get_batch(0, min(args.batch_size, dataset.data_size[1]), which='valid')
+    sessions, weights = [], {}
+    for name, quantized, load in [(args.mode, args.mode, lambda session, model: load_quantized(session, model, quantized_file)),
+                                  ('float32', None, lambda session, model: model.load_parameters(session, checkpoint))]:
+        added, weights[name], session = serving_memory(dataset.vocabulary_size, scope,
+                                                       dict(model_kwargs, quantized=quantized), load, x, x_len)
+        sessions.append(session)
+        print '[{}] Per fold model: {:.1f} MB of weights, {} resident'.format(
+            name, weights[name] / 2.0 ** 20, 'unknown (no /proc)' if added is None else '{:.1f} MB'.format(added / 2.0 ** 20))
+
+    print 'Weight memory of a served fold model: {:.1f}% of float32'.format(100.0 * weights[args.mode] / weights['float32'])
+
+    for session in sessions:
+        session.close()
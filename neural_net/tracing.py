@@ -0,0 +1,121 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import re
+import json
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from util.helpers import make_dir_if_not_exists
+
+
+# Node names are matched in this order, gradient ops carry the name of the
+# forward op they differentiate so the backward pass lands in the same bucket
+OP_CATEGORIES = [
+    ('optimizer', re.compile(r'Adam|clip_by_value|beta[12]_power')),
+    ('attention', re.compile(r'attention')),
+    ('output_projection', re.compile(r'output_projection|fully_connected')),
+    ('encoder_lstm', re.compile(r'Encoder/')),
+    ('loss', re.compile(r'sequence_loss')),
+    ('embedding', re.compile(r'embedding')),
+    ('decoder_lstm', re.compile(r'decoder')),
+]
+
+
+def categorize_node(node_name):
+    for category, regex in OP_CATEGORIES:
+        if regex.search(node_name):
+            return category
+    return 'other'
+
+
+def parse_step_stats(step_stats):
+    '''Yields (node_name, op_type, micros) for every op executed in a traced step.'''
+    for dev_stats in step_stats.dev_stats:
+        # GPU kernels are reported twice, once per stream and once on stream:all
+        if dev_stats.device.endswith('stream:all'):
+            continue
+
+        for node_stats in dev_stats.node_stats:
+            label = node_stats.timeline_label
+            op_type = label.split('=', 1)[1].split('(')[0].strip() if '=' in label else node_stats.node_name
+            yield node_stats.node_name, op_type, node_stats.all_end_rel_micros
+
+
+class step_tracer:
+    '''Collects RunMetadata for selected steps, writes each one out as a Chrome
+    trace (open in chrome://tracing) and accumulates time per op category.'''
+
+    def __init__(self, trace_directory, steps):
+        self.trace_directory = trace_directory
+        self.steps = set(steps)
+        self.micros_by_category = {}
+        self.micros_by_op_type = {}
+        self.traced_steps = {}
+
+        make_dir_if_not_exists(trace_directory)
+
+    # Returns the (options, run_metadata) to pass to session.run(), (None, None) if [step] is not traced
+    def run_options(self, step):
+        if step not in self.steps:
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def record(self, name, step, run_metadata):
+        trace_file = os.path.join(self.trace_directory, 'timeline-%s-%d.json' % (name, step))
+        with open(trace_file, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
+        for node_name, op_type, micros in parse_step_stats(run_metadata.step_stats):
+            key = (name, categorize_node(node_name))
+            self.micros_by_category[key] = self.micros_by_category.get(key, 0) + micros
+            key = (name, op_type)
+            self.micros_by_op_type[key] = self.micros_by_op_type.get(key, 0) + micros
+
+        self.traced_steps[name] = self.traced_steps.get(name, 0) + 1
+        print '[Trace] {} step {} written to {}'.format(name, step, trace_file)
+
+    def summary(self):
+        result = {}
+
+        for name, count in self.traced_steps.items():
+            by_category = {category: micros / 1000.0 / count for (name_, category), micros
+                           in self.micros_by_category.items() if name_ == name}
+            by_op_type = {op_type: micros / 1000.0 / count for (name_, op_type), micros
+                          in self.micros_by_op_type.items() if name_ == name}
+            result[name] = {'traced_steps': count,
+                            'ms_per_step_by_category': by_category,
+                            'ms_per_step_by_op_type': by_op_type}
+
+        return result
+
+    def write_summary(self):
+        summary = self.summary()
+
+        with open(os.path.join(self.trace_directory, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=4, sort_keys=True)
+
+        for name in sorted(summary):
+            by_category = summary[name]['ms_per_step_by_category']
+            total = sum(by_category.values())
+            print '\n[Trace] {}: op time per step, averaged over {} step(s)'.format(name, summary[name]['traced_steps'])
+            for category in sorted(by_category, key=by_category.get, reverse=True):
+                print '  {:<20} {:>10.2f} ms  {:>5.1f}%'.format(category, by_category[category],
+                                                              100.0 * by_category[category] / max(total, 1e-9))
+
+        return summary
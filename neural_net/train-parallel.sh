@@ -0,0 +1 @@
+python neural_net/train_scheduler.py --networks typo,ids --bins 0,1,2,3,4 -- -e 200
@@ -18,17 +18,21 @@ limitations under the License.
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.seq2seq as seq2seq
-from tensorflow.contrib.rnn import LSTMCell, LSTMStateTuple, GRUCell, MultiRNNCell, DropoutWrapper
+from tensorflow.contrib.rnn import LSTMCell, LSTMStateTuple, GRUCell, MultiRNNCell, DropoutWrapper, LSTMBlockCell, LSTMBlockFusedCell, RNNCell
 import math
 import os
 import sys
 import time
 import glob
+import re
 import argparse
+import subprocess
 from shutil import copy
 
-from util.helpers import make_dir_if_not_exists, logger, get_rev_dict, Accuracy_calculator_for_deepfix, get_accuracy
+from util.helpers import make_dir_if_not_exists, buffered_logger, metrics_writer, get_rev_dict, Accuracy_calculator_for_deepfix, get_accuracy
 from data_processing.training_data_generator import load_dictionaries
+from neural_net.tracing import step_tracer
+from data_processing.online_data_stream import online_data_stream
 
 
 class load_data:
@@ -126,12 +130,97 @@ class load_data:
         return len(self.tl_dict)
 
 
-def _new_RNN_cell(memory_dim, num_layers, cell_type, dropout, keep_prob):
+class LowRankLSTMCell(RNNCell):
+    '''LSTMCell whose [input + memory, 4 * memory] weight matrix is factored into
+    [input + memory, rank] x [rank, 4 * memory], see neural_net/compress.py.
+    Gates and forget bias are those of LSTMCell.'''
+
+    def __init__(self, num_units, rank, forget_bias=1.0):
+        self._num_units = num_units
+        self._rank = rank
+        self._forget_bias = forget_bias
+
+    @property
+    def state_size(self):
+        return LSTMStateTuple(self._num_units, self._num_units)
+
+    @property
+    def output_size(self):
+        return self._num_units
+
+    def __call__(self, inputs, state, scope=None):
+        with tf.variable_scope(scope or 'low_rank_lstm_cell'):
+            c, h = state
+            inputs_and_memory = tf.concat([inputs, h], 1)
+            input_size = inputs_and_memory.get_shape()[1].value
+
+            weights_u = tf.get_variable('weights_u', [input_size, self._rank], dtype=inputs.dtype)
+            weights_v = tf.get_variable('weights_v', [self._rank, 4 * self._num_units], dtype=inputs.dtype)
+            biases = tf.get_variable('biases', [4 * self._num_units], dtype=inputs.dtype,
+                                     initializer=tf.zeros_initializer())
+
+            lstm_matrix = tf.matmul(tf.matmul(inputs_and_memory, weights_u), weights_v) + biases
+            i, j, f, o = tf.split(lstm_matrix, 4, axis=1)
+
+            new_c = c * tf.sigmoid(f + self._forget_bias) + tf.sigmoid(i) * tf.tanh(j)
+            new_h = tf.tanh(new_c) * tf.sigmoid(o)
+
+            return new_h, LSTMStateTuple(new_c, new_h)
+
+
+# Weights of seq2seq_model(quantized=...), written by neural_net/quantize.py
+QUANTIZATION_MODES = ['int8', 'float16']
+
+
+def quantization_reduce_axes(name, ndim):
+    '''Axes one int8 scale is shared over: per token (row) for the embedding,
+    per output channel (last axis) for the other matrices.'''
+    if name.endswith('embedding_matrix'):
+        return tuple(range(1, ndim))
+    return tuple(range(ndim - 1))
+
+
+def _quantized_getter(mode):
+    '''custom_getter keeping the float32 matrices as [mode] variables (int8 with a
+    float32 scale), cast to float32 where they are used. Vectors stay float32.'''
+
+    def getter(getter, name, *args, **kwargs):
+        shape = tf.TensorShape(kwargs.get('shape'))
+        if not kwargs.get('trainable', True) or shape.ndims is None or shape.ndims < 2 \
+                or tf.as_dtype(kwargs.get('dtype') or tf.float32) != tf.float32:
+            return getter(name, *args, **kwargs)
+
+        # Loaded by load_quantized(), never trained
+        kwargs.update(initializer=tf.zeros_initializer(), regularizer=None, trainable=False)
+
+        if mode == 'float16':
+            kwargs['dtype'] = tf.float16
+            return tf.cast(getter(name + '/float16', *args, **kwargs), tf.float32)
+
+        kwargs['dtype'] = tf.int8
+        weights = getter(name + '/int8', *args, **kwargs)
+
+        reduce_axes = quantization_reduce_axes(name, shape.ndims)
+        kwargs.update(shape=[1 if axis in reduce_axes else dim for axis, dim in enumerate(shape.as_list())],
+                      dtype=tf.float32)
+        scale = getter(name + '/scale', *args, **kwargs)
+
+        return tf.cast(weights, tf.float32) * scale
+
+    return getter
+
+
+def _new_RNN_cell(memory_dim, num_layers, cell_type, dropout, keep_prob, lstm_rank=None):
 
     assert memory_dim is not None and num_layers is not None and cell_type is not None and dropout is not None, 'At least one of the arguments is passed as None'
 
-    if cell_type == 'LSTM':
+    if cell_type == 'LSTM' and lstm_rank is not None:
+        constituent_cell = LowRankLSTMCell(memory_dim, lstm_rank)
+    elif cell_type == 'LSTM':
         constituent_cell = LSTMCell(memory_dim)
+    elif cell_type == 'LSTMBlock':
+        # Same weights layout as LSTMCell, but a single fused kernel per timestep
+        constituent_cell = LSTMBlockCell(memory_dim)
     elif cell_type == 'GRU':
         constituent_cell = GRUCell(memory_dim)
     else:
@@ -158,6 +247,13 @@ class seq2seq_model():
                  cell_type='LSTM', memory_dim=300, num_layers=4, dropout=0.2,
                  attention=True,
                  scope=None,
+                 optimizer_wrapper=None,
+                 global_step=None,
+                 distillation_alpha=0.0,
+                 distillation_temperature=1.0,
+                 lstm_rank=None,
+                 projection_rank=None,
+                 quantized=None,
                  verbose=False):
 
         assert 0 <= dropout and dropout <= 1, '0 <= dropout <= 1, you passed dropout={}'.format(
@@ -173,6 +269,25 @@ class seq2seq_model():
         self.dropout = dropout
         self.scope = scope
 
+        # See neural_net/train_distributed.py
+        self.optimizer_wrapper = optimizer_wrapper
+        self.global_step = global_step
+
+        # See neural_net/distill.py
+        assert 0 <= distillation_alpha and distillation_alpha <= 1, \
+            '0 <= distillation_alpha <= 1, you passed distillation_alpha={}'.format(distillation_alpha)
+        self.distillation_alpha = distillation_alpha
+        self.distillation_temperature = distillation_temperature
+
+        # Low-rank LSTM weights and output projection, see neural_net/compress.py
+        assert lstm_rank is None or cell_type == 'LSTM', 'lstm_rank needs cell_type LSTM'
+        self.lstm_rank = lstm_rank
+        self.projection_rank = projection_rank
+
+        # Inference only, with int8 or float16 weights, see neural_net/quantize.py
+        assert quantized is None or quantized in QUANTIZATION_MODES, 'unknown quantization mode: %s' % quantized
+        self.quantized = quantized
+
         if dropout != 0:
             self.keep_prob = tf.placeholder(tf.float32)
         else:
@@ -181,12 +296,26 @@ class seq2seq_model():
         self.vocab_size = vocab_size
         self.embedding_size = embedding_size
 
-        self.encoder_cell = _new_RNN_cell(
-            memory_dim, num_layers, cell_type, dropout, self.keep_prob)
-        self.decoder_cell = _new_RNN_cell(
-            memory_dim, num_layers, cell_type, dropout, self.keep_prob)
+        self.cell_type = cell_type
 
-        self._make_graph()
+        # LSTMBlockFused runs each encoder layer over the whole sequence in one
+        # kernel; the decoder is stepped by the seq2seq decoder functions, so
+        # it falls back to the (per timestep) fused LSTMBlockCell
+        if cell_type == 'LSTMBlockFused':
+            self.encoder_cell = None
+            self.decoder_cell = _new_RNN_cell(
+                memory_dim, num_layers, 'LSTMBlock', dropout, self.keep_prob)
+        else:
+            self.encoder_cell = _new_RNN_cell(
+                memory_dim, num_layers, cell_type, dropout, self.keep_prob, lstm_rank)
+            self.decoder_cell = _new_RNN_cell(
+                memory_dim, num_layers, cell_type, dropout, self.keep_prob, lstm_rank)
+
+        if quantized is None:
+            self._make_graph()
+        else:
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=_quantized_getter(quantized)):
+                self._make_graph()
 
         if self.scope is not None:
             saver_vars = [var for var in tf.global_variables(
@@ -243,6 +372,14 @@ class seq2seq_model():
             name='decoder_targets_length',
         )
 
+        # Logits of the teacher network for decoder_train_targets, [time, batch, vocab]
+        if self.distillation_alpha > 0:
+            self.teacher_logits = tf.placeholder(
+                shape=(None, None, self.vocab_size),
+                dtype=tf.float32,
+                name='teacher_logits',
+            )
+
     def _init_decoder_train_connectors(self):
 
         with tf.name_scope('decoderTrainFeeds'):
@@ -294,8 +431,39 @@ class seq2seq_model():
             self.decoder_train_inputs_embedded = tf.nn.embedding_lookup(
                 self.embedding_matrix, self.decoder_train_inputs)
 
+    def _init_fused_encoder(self):
+        inputs = self.encoder_inputs_embedded
+        states = []
+
+        # Mirrors DropoutWrapper(input_keep_prob, output_keep_prob) around every
+        # layer and the rnn/multi_rnn_cell/cell_<i> scopes of dynamic_rnn
+        with tf.variable_scope('rnn'):
+            for i in range(self.num_layers):
+                with tf.variable_scope('multi_rnn_cell/cell_%d' % i if self.num_layers > 1 else 'cell'):
+                    if self.dropout != 0:
+                        inputs = tf.nn.dropout(inputs, self.keep_prob)
+
+                    outputs, (c, h) = LSTMBlockFusedCell(self.memory_dim)(
+                        inputs, dtype=tf.float32, sequence_length=self.encoder_inputs_length)
+
+                    if self.dropout != 0:
+                        outputs = tf.nn.dropout(outputs, self.keep_prob)
+
+                    states.append(LSTMStateTuple(c, h))
+                    inputs = outputs
+
+        # dynamic_rnn zeroes the outputs past each sequence's end, attention sees them
+        mask = tf.transpose(tf.sequence_mask(self.encoder_inputs_length, tf.shape(outputs)[0], dtype=tf.float32))
+        outputs = outputs * tf.expand_dims(mask, -1)
+
+        return outputs, tuple(states) if self.num_layers > 1 else states[0]
+
     def _init_simple_encoder(self):
         with tf.variable_scope("Encoder") as scope:
+            if self.cell_type == 'LSTMBlockFused':
+                self.encoder_outputs, self.encoder_state = self._init_fused_encoder()
+                return
+
             (self.encoder_outputs, self.encoder_state) = (
                 tf.nn.dynamic_rnn(cell=self.encoder_cell,
                                   inputs=self.encoder_inputs_embedded,
@@ -307,7 +475,18 @@ class seq2seq_model():
     def _init_decoder(self):
         with tf.variable_scope("decoder") as scope:
             def output_fn(outputs):
-                return tf.contrib.layers.linear(outputs, self.vocab_size, scope=scope)
+                with tf.name_scope('output_projection'):
+                    if self.projection_rank is None:
+                        return tf.contrib.layers.linear(outputs, self.vocab_size, scope=scope)
+
+                    with tf.variable_scope(scope):
+                        projection_u = tf.get_variable('projection_u', [self.memory_dim, self.projection_rank])
+                        projection_v = tf.get_variable('projection_v', [self.projection_rank, self.vocab_size])
+                        biases = tf.get_variable('biases', [self.vocab_size], initializer=tf.zeros_initializer())
+
+                    logits = tf.matmul(tf.matmul(tf.reshape(outputs, [-1, self.memory_dim]), projection_u),
+                                       projection_v) + biases
+                    return tf.reshape(logits, tf.concat([tf.shape(outputs)[:-1], [self.vocab_size]], 0))
 
             if not self.attention:
                 decoder_fn_train = seq2seq.simple_decoder_fn_train(
@@ -396,8 +575,24 @@ class seq2seq_model():
         self.loss = seq2seq.sequence_loss(logits=logits, targets=targets,
                                           weights=self.loss_weights)
 
+        if self.quantized is not None:
+            return
+
+        # Hinton et al.'s soft target cross entropy at temperature T, scaled by T^2 to keep
+        # its gradients comparable to those of the hard targets. self.loss stays the hard
+        # loss, so that validation needs no teacher
+        objective = self.loss
+        if self.distillation_alpha > 0:
+            T = self.distillation_temperature
+            teacher_probabilities = tf.nn.softmax(tf.transpose(self.teacher_logits, [1, 0, 2]) / T)
+            soft_cross_entropy = -tf.reduce_sum(teacher_probabilities * tf.nn.log_softmax(logits / T), axis=-1)
+            self.distillation_loss = tf.reduce_sum(soft_cross_entropy * self.loss_weights) / tf.reduce_sum(self.loss_weights)
+            objective = (1 - self.distillation_alpha) * self.loss + self.distillation_alpha * T * T * self.distillation_loss
+
         self.optimizer = tf.train.AdamOptimizer()
-        gvs = self.optimizer.compute_gradients(self.loss)
+        if self.optimizer_wrapper is not None:
+            self.optimizer = self.optimizer_wrapper(self.optimizer)
+        gvs = self.optimizer.compute_gradients(objective)
 
         def ClipIfNotNone(grad):
             if grad is None:
@@ -407,7 +602,7 @@ class seq2seq_model():
         # capped_gvs = [(tf.clip_by_value(grad, -1., 1.), var) for grad, var in gvs]
         capped_gvs = [(ClipIfNotNone(grad), var) for grad, var in gvs]
 
-        self.train_op = self.optimizer.apply_gradients(capped_gvs)
+        self.train_op = self.optimizer.apply_gradients(capped_gvs, global_step=self.global_step)
 
     def make_feed_dict(self, x, x_len, y, y_len):
         feed_dict = {
@@ -429,9 +624,13 @@ class seq2seq_model():
     def save_parameters(self, sess, filename, global_step=None):
         self.saver.save(sess, filename, global_step=global_step)
 
-    def train_step(self, session, x, x_len, y, y_len):
+    # [options] and [run_metadata] are passed on to session.run(), see neural_net/tracing.py
+    def train_step(self, session, x, x_len, y, y_len, options=None, run_metadata=None, teacher_logits=None):
         feed_dict = self.make_feed_dict(x, x_len, y, y_len)
-        _, loss = session.run([self.train_op, self.loss], feed_dict)
+        if self.distillation_alpha > 0:
+            feed_dict[self.teacher_logits] = teacher_logits
+        _, loss = session.run([self.train_op, self.loss], feed_dict,
+                              options=options, run_metadata=run_metadata)
         return loss
 
     def validate_step(self, session, x, x_len, y, y_len):
@@ -441,7 +640,14 @@ class seq2seq_model():
                                                                        self.decoder_train_targets], feed_dict)
         return loss, np.array(decoder_prediction).T, np.array(decoder_train_targets).T
 
-    def sample(self, session, X, X_len):
+    # Decoder logits with teacher forcing and without dropout, [time, batch, vocab]
+    def get_logits(self, session, x, x_len, y, y_len):
+        feed_dict = self.make_feed_dict(x, x_len, y, y_len)
+        if self.dropout != 0:
+            feed_dict[self.keep_prob] = 1.0
+        return session.run(self.decoder_logits_train, feed_dict)
+
+    def sample(self, session, X, X_len, options=None, run_metadata=None):
         feed_dict = {self.encoder_inputs: X,
                      self.encoder_inputs_length: X_len}
 
@@ -449,9 +655,196 @@ class seq2seq_model():
             feed_dict.update({self.keep_prob: 1.0})
 
         decoder_prediction = session.run(
-            self.decoder_prediction_inference, feed_dict)
+            self.decoder_prediction_inference, feed_dict,
+            options=options, run_metadata=run_metadata)
         return np.array(decoder_prediction).T
 
+
+# Written into the checkpoints directory once training is over, tells the
+# asynchronous checkpoint evaluator to stop after the last checkpoint
+TRAINING_DONE_MARKER = 'training.done'
+# Written by the asynchronous checkpoint evaluator when validation stops improving
+EARLY_STOP_MARKER = 'early.stop'
+# Where the asynchronous checkpoint evaluator keeps the checkpoint it is scoring
+STAGING_DIRECTORY = 'evaluating'
+# State of early_stopping, restored by --resume_latest
+EARLY_STOPPING_STATE = 'early-stopping.npy'
+
+# Columns of the training metrics file when it is written as csv
+METRICS_FIELDS = ['type', 'step', 'epoch', 'minibatch', 'loss', 'batch_time', 'run_time', 'checkpoint_time',
+                  'examples_per_sec', 'encoder_tokens_per_sec', 'encoder_padding_ratio', 'decoder_padding_ratio',
+                  'steps', 'epoch_time', 'eval_time', 'valid_loss', 'valid_repair_accuracy', 'test_loss',
+                  'test_repair_accuracy']
+
+
+def model_kwargs_from_args(train_args):
+    '''Keyword arguments of seq2seq_model() for the network trained with [train_args],
+    the args saved in experiment-configuration.npy. Defaults are those of train.py.'''
+    return dict(embedding_size=getattr(train_args, 'embedding_dim', 50),
+                max_output_seq_len=getattr(train_args, 'max_output_seq_len', 28),
+                cell_type=getattr(train_args, 'cell_type', 'LSTM'),
+                memory_dim=getattr(train_args, 'memory_dim', 300),
+                num_layers=getattr(train_args, 'num_layers', 4),
+                dropout=getattr(train_args, 'dropout', 0.2),
+                lstm_rank=getattr(train_args, 'lstm_rank', None),
+                projection_rank=getattr(train_args, 'projection_rank', None))
+
+
+def list_checkpoints(checkpoints_directory):
+    # Saver writes the meta graph last, so a checkpoint is complete once its .meta file exists
+    regex = re.compile(r'saved-model-attn-(\d+)\.meta\Z')
+    steps = []
+
+    for file_name in os.listdir(checkpoints_directory):
+        match = regex.match(file_name)
+        if match is not None:
+            steps.append(int(match.group(1)))
+
+    return sorted(steps)
+
+
+def get_dataset_name(checkpoints_directory):
+    # ???
+    dataset_name = '_'.join(checkpoints_directory.split(
+        '/')[2:]) if 'bin_' in checkpoints_directory else '_'.join(checkpoints_directory.split('/')[1:])
+    return dataset_name[:-1]
+
+
+def evaluate(session, model, dataset, which, batch_size, get_all_accuracies_batch, max_examples=None):
+    '''Runs greedy inference over the valid/test examples of [dataset] and
+    returns (loss, token_acc, localization_accuracy, repair_accuracy).
+    [max_examples] restricts evaluation to a (shuffled) prefix of the set.'''
+    loss, token_acc, repair_acc, localization_acc = [], [], [], []
+    num_examples = dataset.data_size[1] if which == 'valid' else dataset.data_size[2]
+
+    if max_examples:
+        num_examples = min(num_examples, max(max_examples, batch_size))
+
+    for i in range(num_examples / batch_size):
+        start = i * batch_size
+        end = (i + 1) * batch_size
+
+        X, X_len, Y, Y_len = dataset.get_batch(start, end, which=which)
+
+        loss_t, Y_hat, Y_targets = model.validate_step(
+            session, X, X_len, Y, Y_len)
+        loss.append(loss_t)
+        token_acc.append(get_accuracy(Y_targets, Y_hat, which='token'))
+
+        localization_equality, fix_equality = get_all_accuracies_batch(Y_targets, Y_hat)
+        repair_accuracy = np.sum(fix_equality)
+        localization_accuracy = np.sum(localization_equality)
+
+        repair_acc.append(float(repair_accuracy) / float(batch_size))
+        localization_acc.append(
+            float(localization_accuracy) / float(batch_size))
+
+    return np.mean(loss), np.mean(token_acc), np.mean(localization_acc), np.mean(repair_acc)
+
+
+class early_stopping:
+    '''Patience-based early stopping on validation repair accuracy or loss.'''
+
+    def __init__(self, patience, metric='repair_accuracy', min_delta=0.0):
+        assert metric in ['repair_accuracy', 'loss'], 'unsupported early stopping metric: %s' % metric
+        self.patience = patience
+        self.metric = metric
+        self.min_delta = min_delta
+        self.best = None
+        self.bad_evaluations = 0
+
+    # Returns True if this evaluation improved upon the best one so far
+    def update(self, loss, repair_accuracy):
+        value = -loss if self.metric == 'loss' else repair_accuracy
+
+        if self.best is None or value > self.best + self.min_delta:
+            self.best = value
+            self.bad_evaluations = 0
+            return True
+
+        self.bad_evaluations += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience > 0 and self.bad_evaluations >= self.patience
+
+    def save(self, checkpoints_directory):
+        np.save(os.path.join(checkpoints_directory, EARLY_STOPPING_STATE),
+                {'metric': self.metric, 'best': self.best, 'bad_evaluations': self.bad_evaluations})
+
+    def restore(self, checkpoints_directory):
+        path = os.path.join(checkpoints_directory, EARLY_STOPPING_STATE)
+        if os.path.exists(path):
+            state = np.load(path, allow_pickle=True).item()
+            if state['metric'] == self.metric:
+                self.best, self.bad_evaluations = state['best'], state['bad_evaluations']
+
+
+class CheckpointVanishedException(Exception):
+    pass
+
+
+def stage_checkpoint(checkpoints_directory, step, staging_directory):
+    '''Hard-links (or copies) the files of checkpoint [step] into [staging_directory],
+    where the Saver, which keeps only the last few checkpoints, cannot delete them.'''
+    files = glob.glob(os.path.join(checkpoints_directory, 'saved-model-attn-%d.*' % step))
+    if not files:
+        raise CheckpointVanishedException(os.path.join(checkpoints_directory, 'saved-model-attn-%d' % step))
+
+    make_dir_if_not_exists(staging_directory)
+    for each_file in files:
+        destination = os.path.join(staging_directory, os.path.basename(each_file))
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(each_file, destination)
+        except OSError:
+            try:
+                copy(each_file, destination)
+            except IOError:
+                raise CheckpointVanishedException(each_file)
+
+    return os.path.join(staging_directory, 'saved-model-attn-%d' % step)
+
+
+def unstage_checkpoint(staging_directory, step):
+    for each_file in glob.glob(os.path.join(staging_directory, 'saved-model-attn-%d.*' % step)):
+        os.remove(each_file)
+
+
+def read_best_ckpt(checkpoints_directory):
+    '''(step, repair_accuracy) of the best checkpoint recorded in best/best.txt, or (None, 0).'''
+    best_step, best_accuracy = None, 0
+    path = os.path.join(checkpoints_directory, 'best', 'best.txt')
+
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                fields = dict(re.findall(r'(\w+): (\S+)', line))
+                if 'step' in fields and float(fields.get('repair_accuracy', 0)) > best_accuracy:
+                    best_step, best_accuracy = int(fields['step']), float(fields['repair_accuracy'])
+
+    return best_step, best_accuracy
+
+
+def update_best_ckpt(checkpoints_directory, step, source_directory=None, **kwargs):
+    '''Copies checkpoint [step] from [source_directory] (default: [checkpoints_directory])
+    into best/ and appends [kwargs] to best/best.txt.'''
+    files = glob.glob(os.path.join(source_directory or checkpoints_directory, 'saved-model-attn-%d.*' % step))
+    if not files:
+        raise CheckpointVanishedException(os.path.join(source_directory or checkpoints_directory,
+                                                       'saved-model-attn-%d' % step))
+
+    for each_file in files:
+        copy(each_file, os.path.join(checkpoints_directory, 'best'))
+
+    kwargs['step'] = step
+    with open(os.path.join(checkpoints_directory, 'best', 'best.txt'), 'a+') as f:
+        for each in kwargs:
+            f.write('{}: {} '.format(each, kwargs[each]))
+        f.write('\n')
+
 ######################################################################
 ######################################################################
 
@@ -478,7 +871,7 @@ if __name__ == '__main__':
     parser.add_argument('-rmb', "--resume_minibatch",
                         type=int, help="resume_minibatch", default=0)
     parser.add_argument(
-        '--cell_type', help='One of LSTM or GRU.', default='LSTM')
+        '--cell_type', help='One of LSTM, LSTMBlock, LSTMBlockFused or GRU.', default='LSTM')
     parser.add_argument(
         '-c', '--ckpt_every', help='How often to save checkpoints', type=int, default=500)
     parser.add_argument('-o', '--max_output_seq_len',
@@ -487,15 +880,57 @@ if __name__ == '__main__':
         '-d', '--dropout', help='Probability to use for dropout', type=float, default=0.2)
     parser.add_argument(
         '-v', '--vram', help='Fraction of GPU memory to use', type=float, default=0.85)
+    parser.add_argument('--async_eval', action='store_true',
+                        help='Score checkpoints in a separate evaluator process instead of after every epoch')
+    parser.add_argument('--eval_vram', type=float,
+                        help='Fraction of GPU memory to use for the asynchronous evaluator', default=0.1)
+    parser.add_argument('--eval_every', type=int,
+                        help='Evaluate on the validation and test sets every k epochs', default=1)
+    parser.add_argument('--eval_max_examples', type=int,
+                        help='Evaluate on at most this many validation/test examples (0 for all)', default=0)
+    parser.add_argument('-p', '--patience', type=int,
+                        help='Stop after this many evaluations without improvement (0 to disable)', default=0)
+    parser.add_argument('--early_stopping_metric', choices=['repair_accuracy', 'loss'],
+                        help='Validation metric used for early stopping', default='repair_accuracy')
+    parser.add_argument('--min_delta', type=float,
+                        help='Minimum change of the early stopping metric that counts as an improvement', default=0.0)
+    parser.add_argument('--trace_steps', type=lambda steps: [int(step) for step in steps.split(',')],
+                        help='Comma separated training steps to trace, e.g. 10,11,12', default=[])
+    parser.add_argument('--trace_directory',
+                        help='Where to write step traces (default: <checkpoints_directory>/traces)', default=None)
+    parser.add_argument('--terminal_interval', type=float,
+                        help='Write the log to the terminal at most once every this many seconds', default=0.0)
+    parser.add_argument('--metrics_file',
+                        help='Per-step throughput metrics, .jsonl or .csv (default: logs/metrics-<dataset>.jsonl)', default=None)
+    parser.add_argument('--lstm_rank', type=int,
+                        help='Factor the LSTM weight matrices to this rank (see neural_net/compress.py)', default=None)
+    parser.add_argument('--projection_rank', type=int,
+                        help='Factor the output projection to this rank (see neural_net/compress.py)', default=None)
+    parser.add_argument('--resume_latest', action='store_true',
+                        help='Resume from the newest checkpoint in checkpoints_directory, if there is one (overrides -r/-re/-rmb)')
+    parser.add_argument('--cpu', action='store_true', help='Run on the CPU even if there is a GPU')
+    parser.add_argument('--intra_op_threads', type=int,
+                        help='Threads used within one op (0 lets TensorFlow decide)', default=0)
+    parser.add_argument('--inter_op_threads', type=int,
+                        help='Ops run concurrently (0 lets TensorFlow decide)', default=0)
+    parser.add_argument('--online_mutation', action='store_true',
+                        help='Train on pairs mutated on the fly from the training problems instead of examples-train.npy')
+    parser.add_argument('--online_workers', type=int,
+                        help='Number of mutation processes for --online_mutation', default=4)
+    parser.add_argument('--online_queue_size', type=int,
+                        help='Maximum number of mutated programs waiting for the trainer', default=64)
+    parser.add_argument('--online_variants', type=int,
+                        help='Mutated variants generated per program with --online_mutation', default=8)
 
     args = parser.parse_args()
 
-    # ???
-    dataset_name = '_'.join(args.checkpoints_directory.split(
-        '/')[2:]) if 'bin_' in args.checkpoints_directory else '_'.join(args.checkpoints_directory.split('/')[1:])
-    dataset_name = dataset_name[:-1]
+    dataset_name = get_dataset_name(args.checkpoints_directory)
+
+    if args.metrics_file is None:
+        args.metrics_file = os.path.join('logs', 'metrics-' + dataset_name + '.jsonl')
+    metrics = metrics_writer(args.metrics_file, METRICS_FIELDS)
 
-    log = logger('log-' + dataset_name + '.txt')
+    log = buffered_logger('log-' + dataset_name + '.txt', terminal_interval=args.terminal_interval)
     print '\nlogging into {}'.format(log.log_file)
     sys.stdout = log
 
@@ -517,12 +952,6 @@ if __name__ == '__main__':
     np.save(os.path.join(args.checkpoints_directory,
                          'experiment-configuration.npy'), configuration)
 
-    def update_best_ckpt(**kwargs):
-        with open(os.path.join(args.checkpoints_directory, 'best', 'best.txt'), 'a+') as f:
-            for each in kwargs:
-                f.write('{}: {} '.format(each, kwargs[each]))
-            f.write('\n')
-
     print 'data_directory            :', args.data_directory
     print 'checkpoints_directory     :', args.checkpoints_directory
     print 'Checkpoint every          :', args.ckpt_every
@@ -537,7 +966,17 @@ if __name__ == '__main__':
     print 'Resume minibatch          :', args.resume_minibatch
     print 'cell type                 :', args.cell_type
     print 'dropout                   :', args.dropout
+    print 'lstm rank                 :', args.lstm_rank
+    print 'projection rank           :', args.projection_rank
     print 'vram                      :', args.vram
+    print 'async eval                :', args.async_eval
+    print 'eval every                :', args.eval_every
+    print 'eval max examples         :', args.eval_max_examples
+    print 'patience                  :', args.patience
+    print 'early stopping metric     :', args.early_stopping_metric
+    print 'metrics file              :', args.metrics_file
+    print 'trace steps               :', args.trace_steps
+    print 'online mutation           :', args.online_mutation
     print 'network                   :', which_network
 
     dataset = load_data(args.data_directory)
@@ -545,16 +984,36 @@ if __name__ == '__main__':
     rev_tl_dict = dataset.get_rev_tl_dictionary()
     batch_size = args.batch_size
     acc_calc = Accuracy_calculator_for_deepfix(tl_dict['~'])
-    get_all_accuracies = acc_calc.get_all_accuracies
+    get_all_accuracies_batch = acc_calc.get_all_accuracies_batch
 
     num_train, num_validation, num_test = dataset.data_size
     print 'Training:', num_train, 'examples', '\nValidation:', num_validation, 'examples', '\nTest:', num_test, 'examples'
     print 'vocabulary size:', dataset.vocabulary_size
 
+    if args.resume_latest and list_checkpoints(args.checkpoints_directory):
+        steps_per_epoch = num_train / args.batch_size
+        args.resume_at = list_checkpoints(args.checkpoints_directory)[-1]
+        args.resume_epoch, args.resume_minibatch = divmod(args.resume_at, steps_per_epoch)
+        print 'Resuming from the latest checkpoint at Step {}, Epoch {}, Minibatch {}'.format(
+            args.resume_at, args.resume_epoch, args.resume_minibatch)
+
+    # Started before the session, the workers are forked without any TensorFlow state.
+    # An epoch keeps its length of num_train examples
+    stream = None
+    if args.online_mutation:
+        stream = online_data_stream(args.data_directory, which_network, tl_dict,
+                                    num_workers=args.online_workers, queue_size=args.online_queue_size,
+                                    variants_per_program=args.online_variants)
+
     print '\n\n===================== initializing model =====================\n\n'
 
     gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.vram)
-    sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
+    config = tf.ConfigProto(gpu_options=gpu_options,
+                            intra_op_parallelism_threads=args.intra_op_threads,
+                            inter_op_parallelism_threads=args.inter_op_threads)
+    if args.cpu:
+        config.device_count['GPU'] = 0
+    sess = tf.Session(config=config)
     scope = which_network
 
     with tf.variable_scope(scope):
@@ -564,7 +1023,9 @@ if __name__ == '__main__':
                                 memory_dim=args.memory_dim,
                                 num_layers=args.num_layers,
                                 dropout=args.dropout,
-                                scope=scope
+                                scope=scope,
+                                lstm_rank=args.lstm_rank,
+                                projection_rank=args.projection_rank
                                 )
 
     if args.resume_at == 0:
@@ -577,41 +1038,42 @@ if __name__ == '__main__':
     resume_minibatch = args.resume_minibatch
     best_overall_accuracy = 0
 
+    tracer = None
+    if args.trace_steps:
+        tracer = step_tracer(args.trace_directory or os.path.join(args.checkpoints_directory, 'traces'),
+                             args.trace_steps)
+
+    stopper = early_stopping(args.patience, args.early_stopping_metric, args.min_delta)
+
+    # Otherwise the first evaluation after a restart would replace a better best/ checkpoint
+    if args.resume_at > 0:
+        best_step, best_overall_accuracy = read_best_ckpt(args.checkpoints_directory)
+        stopper.restore(args.checkpoints_directory)
+        print 'Best checkpoint so far    :', best_step, '(repair accuracy {})'.format(best_overall_accuracy)
+        print 'Evaluations w/o improving :', stopper.bad_evaluations
+
+    evaluator = None
+    if args.async_eval:
+        done_marker = os.path.join(args.checkpoints_directory, TRAINING_DONE_MARKER)
+        early_stop_marker = os.path.join(args.checkpoints_directory, EARLY_STOP_MARKER)
+        for marker in [done_marker, early_stop_marker]:
+            if os.path.exists(marker):
+                os.remove(marker)
+
+        evaluator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluate_checkpoints.py'),
+                                      args.checkpoints_directory, '-b', str(args.batch_size), '-v', str(args.eval_vram),
+                                      '--start_after', str(args.resume_at),
+                                      '--max_examples', str(args.eval_max_examples),
+                                      '--eval_every', str(args.eval_every), '--epochs', str(args.epochs),
+                                      '--patience', str(args.patience),
+                                      '--early_stopping_metric', args.early_stopping_metric,
+                                      '--min_delta', str(args.min_delta)])
+        print 'Started asynchronous checkpoint evaluator, pid:', evaluator.pid
+
     def test_or_validate(which='valid'):
         epoch = t + 1
-        loss, token_acc, repair_acc, localization_acc = [], [], [], []
-        num_examples = num_validation if which == 'valid' else num_test
-
-        for i in range(num_examples / batch_size):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-
-            X, X_len, Y, Y_len = dataset.get_batch(start, end, which=which)
-
-            loss_t, Y_hat, Y_targets = seq2seq.validate_step(
-                sess, X, X_len, Y, Y_len)
-            loss.append(loss_t)
-            token_acc.append(get_accuracy(Y_targets, Y_hat, which='token'))
-
-            repair_accuracy = 0
-            localization_accuracy = 0
-
-            for _, (y, y_hat) in enumerate(zip(Y_targets, Y_hat)):
-                localization_equality, fix_equality = get_all_accuracies(
-                    y, y_hat)
-
-                if localization_equality:
-                    localization_accuracy += 1
-                if fix_equality:
-                    repair_accuracy += 1
-
-            repair_acc.append(float(repair_accuracy) / float(batch_size))
-            localization_acc.append(
-                float(localization_accuracy) / float(batch_size))
-
-        loss, token_acc, repair_accuracy, \
-            localization_accuracy = np.mean(loss), np.mean(token_acc), np.mean(repair_acc), \
-            np.mean(localization_acc)
+        loss, token_acc, localization_accuracy, repair_accuracy = evaluate(
+            sess, seq2seq, dataset, which, batch_size, get_all_accuracies_batch, args.eval_max_examples)
 
         # Print epoch step and validation information
         print "[{}] Epoch: {}, Loss: {}, Token-level-acc: {}, loc-acc: {}, repair-acc: {}" .format(which,
@@ -621,15 +1083,13 @@ if __name__ == '__main__':
             global best_overall_accuracy
             if repair_accuracy > best_overall_accuracy:
                 best_overall_accuracy = repair_accuracy
-                for each_file in glob.glob(os.path.join(args.checkpoints_directory, 'saved-model-attn-%d*' % step)):
-                    copy(each_file, os.path.join(
-                        args.checkpoints_directory, 'best'))
-
-                update_best_ckpt(epoch=epoch, step=step, loss=loss, token_acc=token_acc, localization_accuracy=localization_accuracy,
-                                 repair_accuracy=repair_accuracy)
+                update_best_ckpt(args.checkpoints_directory, step, epoch=epoch, loss=loss, token_acc=token_acc,
+                                 localization_accuracy=localization_accuracy, repair_accuracy=repair_accuracy)
 
                 print "[Best Checkpoint] Checkpointed at Epoch %d, Minibatch %d." % (t + 1, 0)
 
+        return loss, token_acc, localization_accuracy, repair_accuracy
+
     ##############################################################################
 
     # Training
@@ -637,14 +1097,28 @@ if __name__ == '__main__':
         # Training
         start_time = time.time()
         train_loss = []
+        epoch_batch_time, epoch_run_time, epoch_checkpoint_time, epoch_eval_time = 0.0, 0.0, 0.0, 0.0
+        epoch_examples, epoch_encoder_tokens = 0, 0
 
         total_steps = num_train / args.batch_size - resume_minibatch
         for i in range(resume_minibatch, num_train / args.batch_size):
+            batch_start_time = time.time()
             start = i * args.batch_size
             end = (i + 1) * args.batch_size
-            x, x_len, y, y_len = dataset.get_batch(start, end, which='train')
+            if stream is not None:
+                X, Y = zip(*stream.get_examples(args.batch_size))
+                x, x_len, y, y_len = tuple(load_data.prepare_batch(X) + load_data.prepare_batch(Y))
+            else:
+                x, x_len, y, y_len = dataset.get_batch(start, end, which='train')
+
+            options, run_metadata = tracer.run_options(step + 1) if tracer is not None else (None, None)
 
-            loss = seq2seq.train_step(sess, x, x_len, y, y_len)
+            run_start_time = time.time()
+            loss = seq2seq.train_step(sess, x, x_len, y, y_len, options=options, run_metadata=run_metadata)
+            run_end_time = time.time()
+
+            if run_metadata is not None:
+                tracer.record('train', step + 1, run_metadata)
 
             train_loss.append(loss)
 
@@ -653,18 +1127,39 @@ if __name__ == '__main__':
             print "Step: {}/{},\tMinibatch: {},\tEpoch: {},\tLoss: {}".format(step, total_steps, i, t + float(i + 1) / (num_train / args.batch_size), train_loss[-1])
 
             # Checkpoint
+            checkpoint_time = None
             if step % args.ckpt_every == 0:
                 seq2seq.save_parameters(sess, os.path.join(
                     args.checkpoints_directory, 'saved-model-attn'), global_step=step)
+                checkpoint_time = time.time() - run_end_time
+                epoch_checkpoint_time += checkpoint_time
                 print "[Checkpoint] Checkpointed at Epoch %d, Minibatch %d." % (t, i)
 
+            batch_time = run_start_time - batch_start_time
+            run_time = run_end_time - run_start_time
+            encoder_tokens = int(np.sum(x_len))
+
+            epoch_batch_time += batch_time
+            epoch_run_time += run_time
+            epoch_examples += len(x_len)
+            epoch_encoder_tokens += encoder_tokens
+
+            metrics.write(type='step', step=step, epoch=t + 1, minibatch=i, loss=float(loss),
+                          batch_time=batch_time, run_time=run_time, checkpoint_time=checkpoint_time,
+                          examples_per_sec=len(x_len) / (batch_time + run_time),
+                          encoder_tokens_per_sec=encoder_tokens / (batch_time + run_time),
+                          encoder_padding_ratio=1.0 - float(encoder_tokens) / np.size(x),
+                          decoder_padding_ratio=1.0 - float(np.sum(y_len)) / np.size(y))
+
         train_loss = np.mean(train_loss, 0)
         resume_minibatch = 0
 
         # Checkpoint before going into validation/testing
         if step % args.ckpt_every != 0:
+            checkpoint_start_time = time.time()
             seq2seq.save_parameters(sess, os.path.join(
                 args.checkpoints_directory, 'saved-model-attn'), global_step=step)
+            epoch_checkpoint_time += time.time() - checkpoint_start_time
             print "[Checkpoint] Checkpointed at Epoch {}, Minibatch {}.".format(t + 1, 0)
 
         print "End of Epoch: {}".format(t + 1)
@@ -672,12 +1167,49 @@ if __name__ == '__main__':
 
         ##############################################################################
 
-        test_or_validate('valid')
-        test_or_validate('test')
+        eval_metrics = {}
+
+        if evaluator is None and ((t + 1) % args.eval_every == 0 or t + 1 == args.epochs):
+            eval_start_time = time.time()
+            valid_loss, _, _, valid_repair_accuracy = test_or_validate('valid')
+            test_loss, _, _, test_repair_accuracy = test_or_validate('test')
+            epoch_eval_time = time.time() - eval_start_time
+
+            eval_metrics = dict(valid_loss=valid_loss, valid_repair_accuracy=valid_repair_accuracy,
+                                test_loss=test_loss, test_repair_accuracy=test_repair_accuracy)
+
+            if not stopper.update(valid_loss, valid_repair_accuracy):
+                print "[Early Stopping] No improvement in {} for {} evaluation(s).".format(args.early_stopping_metric, stopper.bad_evaluations)
+            stopper.save(args.checkpoints_directory)
 
         ##############################################################################
 
-        print "[Time] Took {} minutes to run." .format((time.time() - start_time) / 60)
+        epoch_time = time.time() - start_time
+        print "[Time] Took {} minutes to run." .format(epoch_time / 60)
+
+        metrics.write(type='epoch', step=step, epoch=t + 1, loss=float(train_loss), steps=total_steps,
+                      batch_time=epoch_batch_time, run_time=epoch_run_time, checkpoint_time=epoch_checkpoint_time,
+                      examples_per_sec=epoch_examples / max(epoch_batch_time + epoch_run_time, 1e-9),
+                      encoder_tokens_per_sec=epoch_encoder_tokens / max(epoch_batch_time + epoch_run_time, 1e-9),
+                      epoch_time=epoch_time, eval_time=epoch_eval_time, **eval_metrics)
+        metrics.flush()
+
+        if stopper.should_stop or (evaluator is not None and os.path.exists(early_stop_marker)):
+            print "[Early Stopping] Stopped after Epoch {}.".format(t + 1)
+            break
+
+    if tracer is not None:
+        tracer.write_summary()
 
     sess.close()
+
+    if stream is not None:
+        stream.close()
+
+    if evaluator is not None:
+        open(done_marker, 'w').close()
+        print 'Waiting for the checkpoint evaluator to finish...'
+        evaluator.wait()
+
+    metrics.close()
     log.close()
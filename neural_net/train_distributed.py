@@ -0,0 +1,457 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+from neural_net.train import load_data, seq2seq_model, evaluate, update_best_ckpt, get_dataset_name, \
+    METRICS_FIELDS, TRAINING_DONE_MARKER
+from util.helpers import make_dir_if_not_exists, buffered_logger, metrics_writer, read_metrics, \
+    Accuracy_calculator_for_deepfix
+
+
+# Synchronous data-parallel training with between-graph replication: every
+# worker process builds the graph, variables live on the parameter server(s),
+# and each global batch of --batch_size examples is split evenly across the
+# workers. SyncReplicasOptimizer averages the (clipped) gradients of all
+# workers before applying one Adam update, so one global step here matches one
+# step of train.py with the same batch size. Worker 0 (the chief) saves the
+# usual saved-model-attn-* checkpoints, evaluates and logs. To check that the
+# loss curves match those of single-process training:
+#
+#   python neural_net/train.py DATA CHECKPOINTS-1 -e 2 --metrics_file logs/single.jsonl
+#   python neural_net/train_distributed.py DATA CHECKPOINTS-2 -e 2 --local_workers 2 --compare_to logs/single.jsonl
+
+
+def shard_bounds(start, end, task_index, num_workers):
+    shard_size = (end - start) / num_workers
+    return start + task_index * shard_size, start + (task_index + 1) * shard_size
+
+
+def load_shuffled_data(data_directory, is_chief):
+    # Only the chief may write data_directory/shuffled; the others repeat the
+    # same seeded shuffle in memory instead of racing it
+    if is_chief or os.path.exists(os.path.join(data_directory, 'shuffled', 'examples-test.npy')):
+        return load_data(data_directory)
+
+    dataset = load_data(data_directory, shuffle=False)
+    dataset.rng.shuffle(dataset.train_ex)
+    dataset.rng.shuffle(dataset.valid_ex)
+    dataset.rng.shuffle(dataset.test_ex)
+    return dataset
+
+
+def compare_loss_curves(reference_file, metrics_file, tolerance):
+    '''Compares the per-epoch training and validation losses in [metrics_file] with
+    those of a train.py run in [reference_file] (--metrics_file of both). Returns
+    False if one of them differs by more than [tolerance], relative to train.py.
+
+    The training loss of the chief is that of its shard and dropout draws differ,
+    so the curves match within a tolerance rather than exactly.'''
+    def epochs(path):
+        # The last record of an epoch wins, as after a resumed run
+        return dict((int(record['epoch']), record) for record in read_metrics(path) if record.get('type') == 'epoch')
+
+    reference, distributed = epochs(reference_file), epochs(metrics_file)
+    common = sorted(set(reference) & set(distributed))
+    if not common:
+        print 'No epochs in common between {} and {}'.format(reference_file, metrics_file)
+        return False
+
+    matches = True
+    print 'Epoch\tKey\ttrain.py\tdistributed\trelative difference'
+    for epoch in common:
+        for key in ['loss', 'valid_loss']:
+            if reference[epoch].get(key) is None or distributed[epoch].get(key) is None:
+                continue
+            expected, actual = float(reference[epoch][key]), float(distributed[epoch][key])
+            difference = abs(actual - expected) / max(abs(expected), 1e-9)
+            matches = matches and difference <= tolerance
+            print '{}\t{}\t{:.5f}\t{:.5f}\t{:.4f}{}'.format(epoch, key, expected, actual, difference,
+                                                              '' if difference <= tolerance else '\t<--')
+
+    print 'Loss curves {} within a relative tolerance of {}'.format('match' if matches else 'do NOT match', tolerance)
+    return matches
+
+
+def launch_local_cluster(args):
+    '''Starts one parameter server and --local_workers workers on localhost and waits for the workers.'''
+    ps_hosts = ['localhost:%d' % (args.base_port + i) for i in range(args.num_ps)]
+    worker_hosts = ['localhost:%d' % (args.base_port + args.num_ps + i) for i in range(args.local_workers)]
+
+    argv = sys.argv[1:]
+    if '--local_workers' in argv:
+        k = argv.index('--local_workers')
+        argv = argv[:k] + argv[k + 2:]
+    argv = [arg for arg in argv if not arg.startswith('--local_workers=')]
+    if '--compare_to' in argv:
+        k = argv.index('--compare_to')
+        argv = argv[:k] + argv[k + 2:]
+    argv = [arg for arg in argv if not arg.startswith('--compare_to=')]
+
+    command = [sys.executable, os.path.abspath(__file__)] + argv + \
+              ['--ps_hosts', ','.join(ps_hosts), '--worker_hosts', ','.join(worker_hosts)]
+
+    env = dict(os.environ)
+    if args.cpu:
+        env['CUDA_VISIBLE_DEVICES'] = ''
+
+    processes = [subprocess.Popen(command + ['--job_name', 'ps', '--task_index', str(i)], env=env)
+                 for i in range(args.num_ps)]
+    workers = [subprocess.Popen(command + ['--job_name', 'worker', '--task_index', str(i)], env=env)
+               for i in range(args.local_workers)]
+
+    print 'Started {} parameter server(s) and {} worker(s) on localhost, ports {}-{}'.format(
+        args.num_ps, args.local_workers, args.base_port, args.base_port + args.num_ps + args.local_workers - 1)
+
+    return_codes = [worker.wait() for worker in workers]
+
+    # Parameter servers serve until they are killed
+    for process in processes:
+        process.terminate()
+
+    if args.compare_to is not None and max(return_codes) == 0:
+        metrics_file = args.metrics_file or os.path.join(
+            'logs', 'metrics-' + get_dataset_name(args.checkpoints_directory) + '.jsonl')
+        if not compare_loss_curves(args.compare_to, metrics_file, args.compare_tolerance):
+            return 1
+
+    return max(return_codes)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Train a fault-localization and repair seq2seq RNN with synchronous data-parallel workers.')
+    parser.add_argument('data_directory', help='Data directory')
+    parser.add_argument('checkpoints_directory', help='Checkpoints directory')
+    parser.add_argument('-b', "--batch_size", type=int,
+                        help="global batch size, split across the workers", default=128)
+    parser.add_argument("--embedding_dim", type=int,
+                        help="embedding_dim", default=50)
+    parser.add_argument("--memory_dim", type=int,
+                        help="memory_dim", default=300)
+    parser.add_argument('-n', "--num_layers", type=int,
+                        help="num_layers", default=4)
+    parser.add_argument('-e', "--epochs", type=int, help="epochs", default=20)
+    parser.add_argument('-r', "--resume_at", type=int,
+                        help="resume_at", default=0)
+    parser.add_argument(
+        '--cell_type', help='One of LSTM, LSTMBlock, LSTMBlockFused or GRU.', default='LSTM')
+    parser.add_argument(
+        '-c', '--ckpt_every', help='How often to save checkpoints', type=int, default=500)
+    parser.add_argument('-o', '--max_output_seq_len',
+                        help='max_output_seq_len', type=int, default=28)
+    parser.add_argument(
+        '-d', '--dropout', help='Probability to use for dropout', type=float, default=0.2)
+    parser.add_argument(
+        '-v', '--vram', help='Fraction of GPU memory to use per worker', type=float, default=0.85)
+    parser.add_argument('--async_eval', action='store_true',
+                        help='Score checkpoints in a separate evaluator process instead of on the chief')
+    parser.add_argument('--eval_vram', type=float,
+                        help='Fraction of GPU memory to use for the asynchronous evaluator', default=0.1)
+    parser.add_argument('--eval_every', type=int,
+                        help='Evaluate on the validation and test sets every k epochs', default=1)
+    parser.add_argument('--eval_max_examples', type=int,
+                        help='Evaluate on at most this many validation/test examples (0 for all)', default=0)
+    parser.add_argument('--metrics_file',
+                        help='Per-step metrics of the chief, .jsonl or .csv (default: logs/metrics-<dataset>.jsonl)', default=None)
+
+    parser.add_argument('--ps_hosts', help='Comma separated host:port of the parameter servers', default=None)
+    parser.add_argument('--worker_hosts', help='Comma separated host:port of the workers', default=None)
+    parser.add_argument('--job_name', choices=['ps', 'worker'], help='Role of this process', default=None)
+    parser.add_argument('--task_index', type=int, help='Index of this process within its job', default=0)
+    parser.add_argument('--local_workers', type=int,
+                        help='Start a parameter server and this many workers on localhost', default=0)
+    parser.add_argument('--num_ps', type=int, help='Number of parameter servers started by --local_workers', default=1)
+    parser.add_argument('--base_port', type=int, help='First port used by --local_workers', default=2222)
+    parser.add_argument('--threads', type=int,
+                        help='intra/inter op threads per process (0 lets TensorFlow decide)', default=0)
+    parser.add_argument('--cpu', action='store_true', help='Hide the GPUs from every process')
+    parser.add_argument('--compare_to', metavar='TRAIN_PY_METRICS_FILE',
+                        help='With --local_workers, compare the loss curves with those of a train.py run '
+                             'with the same arguments and fail if they differ', default=None)
+    parser.add_argument('--compare_tolerance', type=float,
+                        help='Relative loss difference allowed by --compare_to', default=0.05)
+    parser.add_argument('--shutdown_timeout', type=int,
+                        help='Seconds the chief waits for the other workers to finish their last step', default=300)
+
+    args = parser.parse_args()
+
+    if args.local_workers > 0:
+        sys.exit(launch_local_cluster(args))
+
+    assert args.ps_hosts is not None and args.worker_hosts is not None and args.job_name is not None, \
+        'pass --local_workers, or --ps_hosts, --worker_hosts, --job_name and --task_index'
+
+    ps_hosts = args.ps_hosts.split(',')
+    worker_hosts = args.worker_hosts.split(',')
+    num_workers = len(worker_hosts)
+
+    cluster = tf.train.ClusterSpec({'ps': ps_hosts, 'worker': worker_hosts})
+    server = tf.train.Server(cluster, job_name=args.job_name, task_index=args.task_index,
+                             config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    if args.job_name == 'ps':
+        server.join()
+        sys.exit(0)
+
+    is_chief = args.task_index == 0
+    assert args.batch_size % num_workers == 0, 'batch size should be divisible by the number of workers'
+
+    dataset_name = get_dataset_name(args.checkpoints_directory)
+
+    log_file = 'log-' + dataset_name + '.txt' if is_chief else 'log-' + dataset_name + '-worker-%d.txt' % args.task_index
+    log = buffered_logger(log_file)
+    print '\nlogging into {}'.format(log.log_file)
+    sys.stdout = log
+
+    assert args.data_directory != args.checkpoints_directory, 'data and checkpoints directories should be different!'
+    assert 'typo' in args.data_directory or 'ids' in args.data_directory, 'data_directory argument has neither *typo* nor *ids* keyword!'
+
+    which_network = 'typo' if 'typo' in args.data_directory else 'ids'
+
+    if is_chief:
+        make_dir_if_not_exists(args.checkpoints_directory)
+        make_dir_if_not_exists(os.path.join(args.checkpoints_directory, 'best'))
+
+        configuration = {}
+        configuration["args"] = args
+        configuration["log"] = log_file
+        configuration['which_network'] = which_network
+
+        np.save(os.path.join(args.checkpoints_directory,
+                             'experiment-configuration.npy'), configuration)
+
+    print 'data_directory            :', args.data_directory
+    print 'checkpoints_directory     :', args.checkpoints_directory
+    print 'Global batch size         :', args.batch_size
+    print 'Workers                   :', num_workers
+    print 'Parameter servers         :', len(ps_hosts)
+    print 'Task                      :', args.job_name, args.task_index
+    print 'cell type                 :', args.cell_type
+    print 'Epochs                    :', args.epochs
+    print 'Resume at                 :', args.resume_at
+    print 'network                   :', which_network
+
+    dataset = load_shuffled_data(args.data_directory, is_chief)
+    num_train, num_validation, num_test = dataset.data_size
+    steps_per_epoch = num_train / args.batch_size
+
+    print 'Training:', num_train, 'examples', '\nValidation:', num_validation, 'examples', '\nTest:', num_test, 'examples'
+
+    worker_device = '/job:worker/task:%d' % args.task_index
+    with tf.device(tf.train.replica_device_setter(worker_device=worker_device, cluster=cluster)):
+        # Outside the network's scope, so checkpoints stay loadable by train.py and the evaluators
+        global_step = tf.Variable(args.resume_at, name='global_step', trainable=False)
+        workers_done = tf.Variable(0, name='workers_done', trainable=False)
+        worker_done_op = workers_done.assign_add(1)
+
+        def sync_replicas(optimizer):
+            return tf.train.SyncReplicasOptimizer(optimizer, replicas_to_aggregate=num_workers,
+                                                  total_num_replicas=num_workers)
+
+        with tf.variable_scope(which_network):
+            seq2seq = seq2seq_model(dataset.vocabulary_size, args.embedding_dim,
+                                    args.max_output_seq_len,
+                                    cell_type=args.cell_type,
+                                    memory_dim=args.memory_dim,
+                                    num_layers=args.num_layers,
+                                    dropout=args.dropout,
+                                    scope=which_network,
+                                    optimizer_wrapper=sync_replicas,
+                                    global_step=global_step
+                                    )
+
+        optimizer = seq2seq.optimizer
+        init_op = tf.global_variables_initializer()
+
+        if is_chief:
+            local_init_op = optimizer.chief_init_op
+            chief_queue_runner = optimizer.get_chief_queue_runner()
+            sync_init_op = optimizer.get_init_tokens_op()
+            release_tokens_op = optimizer.get_init_tokens_op(num_workers)
+        else:
+            local_init_op = optimizer.local_step_init_op
+
+    init_fn = None
+    if args.resume_at > 0:
+        def init_fn(session):
+            seq2seq.load_parameters(session, os.path.join(
+                args.checkpoints_directory, 'saved-model-attn-' + str(args.resume_at)))
+
+    # No logdir: checkpoints are written by the model's own saver, as in train.py
+    supervisor = tf.train.Supervisor(is_chief=is_chief, logdir=None, init_op=init_op, init_fn=init_fn,
+                                     local_init_op=local_init_op,
+                                     ready_for_local_init_op=optimizer.ready_for_local_init_op,
+                                     recovery_wait_secs=1, global_step=global_step)
+
+    config = tf.ConfigProto(allow_soft_placement=True,
+                            intra_op_parallelism_threads=args.threads,
+                            inter_op_parallelism_threads=args.threads,
+                            device_filters=['/job:ps', worker_device])
+    if args.cpu:
+        config.device_count['GPU'] = 0
+    else:
+        config.gpu_options.per_process_gpu_memory_fraction = args.vram
+
+    print '\n\n===================== waiting for the session =====================\n\n'
+    sess = supervisor.prepare_or_wait_for_session(server.target, config=config)
+
+    if is_chief:
+        sess.run(sync_init_op)
+        supervisor.start_queue_runners(sess, [chief_queue_runner])
+
+    metrics = None
+    evaluator = None
+    best_overall_accuracy = 0
+    get_all_accuracies_batch = Accuracy_calculator_for_deepfix(dataset.get_tl_dictionary()['~']).get_all_accuracies_batch
+
+    if is_chief:
+        if args.metrics_file is None:
+            args.metrics_file = os.path.join('logs', 'metrics-' + dataset_name + '.jsonl')
+        metrics = metrics_writer(args.metrics_file, METRICS_FIELDS)
+
+        if args.async_eval:
+            done_marker = os.path.join(args.checkpoints_directory, TRAINING_DONE_MARKER)
+            if os.path.exists(done_marker):
+                os.remove(done_marker)
+
+            evaluator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluate_checkpoints.py'),
+                                          args.checkpoints_directory, '-b', str(args.batch_size), '-v', str(args.eval_vram),
+                                          '--start_after', str(args.resume_at),
+                                          '--max_examples', str(args.eval_max_examples)])
+            print 'Started asynchronous checkpoint evaluator, pid:', evaluator.pid
+
+    ##############################################################################
+
+    # Training
+    # Every worker trains until the global step (one per aggregated update) reaches the
+    # end of the last epoch. A fast worker's stale gradients are dropped, so the number
+    # of local steps differs between workers and cannot decide when to stop.
+    final_step = args.epochs * steps_per_epoch
+    step = sess.run(global_step)
+    t = step / steps_per_epoch
+    last_checkpoint = step
+    start_time = time.time()
+    train_loss = []
+
+    while not supervisor.should_stop() and step < final_step:
+        batch_start_time = time.time()
+        i = step % steps_per_epoch
+        start, end = shard_bounds(i * args.batch_size, (i + 1) * args.batch_size, args.task_index, num_workers)
+        x, x_len, y, y_len = dataset.get_batch(start, end, which='train')
+
+        run_start_time = time.time()
+        loss = seq2seq.train_step(sess, x, x_len, y, y_len)
+        run_end_time = time.time()
+        train_loss.append(loss)
+
+        previous_step, step = step, sess.run(global_step)
+        print "Step: {},\tMinibatch: {},\tEpoch: {},\tShard loss: {}".format(step, i, float(step) / steps_per_epoch, loss)
+
+        if is_chief:
+            checkpoint_time = None
+            if step / args.ckpt_every > previous_step / args.ckpt_every:
+                seq2seq.save_parameters(sess, os.path.join(
+                    args.checkpoints_directory, 'saved-model-attn'), global_step=step)
+                last_checkpoint = step
+                checkpoint_time = time.time() - run_end_time
+                print "[Checkpoint] Checkpointed at Epoch %d, Minibatch %d." % (t, i)
+
+            batch_time = run_start_time - batch_start_time
+            run_time = run_end_time - run_start_time
+
+            # Throughput of the whole cluster, assuming equally fast workers
+            metrics.write(type='step', step=step, epoch=t + 1, minibatch=i, loss=float(loss),
+                          batch_time=batch_time, run_time=run_time, checkpoint_time=checkpoint_time,
+                          examples_per_sec=num_workers * len(x_len) / (batch_time + run_time),
+                          encoder_tokens_per_sec=num_workers * int(np.sum(x_len)) / (batch_time + run_time),
+                          encoder_padding_ratio=1.0 - float(np.sum(x_len)) / np.size(x),
+                          decoder_padding_ratio=1.0 - float(np.sum(y_len)) / np.size(y))
+
+        if step / steps_per_epoch == t:
+            continue
+
+        print "End of Epoch: {}".format(t + 1)
+        print "[Training] Shard loss: {}".format(np.mean(train_loss))
+
+        if is_chief:
+            if last_checkpoint != step:
+                seq2seq.save_parameters(sess, os.path.join(
+                    args.checkpoints_directory, 'saved-model-attn'), global_step=step)
+                last_checkpoint = step
+                print "[Checkpoint] Checkpointed at Epoch {}, Minibatch {}.".format(t + 1, 0)
+
+            # The other workers block on the next synchronous step until the chief is back
+            eval_metrics = {}
+            if evaluator is None and ((t + 1) % args.eval_every == 0 or t + 1 == args.epochs):
+                for which in ['valid', 'test']:
+                    loss, token_acc, localization_accuracy, repair_accuracy = evaluate(
+                        sess, seq2seq, dataset, which, args.batch_size, get_all_accuracies_batch, args.eval_max_examples)
+                    eval_metrics[which + '_loss'], eval_metrics[which + '_repair_accuracy'] = loss, repair_accuracy
+
+                    print "[{}] Epoch: {}, Loss: {}, Token-level-acc: {}, loc-acc: {}, repair-acc: {}" .format(which,
+                                                                                                               t + 1, loss, token_acc, localization_accuracy, repair_accuracy)
+
+                    if (num_test > 0 and which == 'test') or (num_test == 0 and which == 'valid'):
+                        if repair_accuracy > best_overall_accuracy:
+                            best_overall_accuracy = repair_accuracy
+                            update_best_ckpt(args.checkpoints_directory, step, epoch=t + 1, loss=loss, token_acc=token_acc,
+                                             localization_accuracy=localization_accuracy, repair_accuracy=repair_accuracy)
+                            print "[Best Checkpoint] Checkpointed at Epoch %d, Minibatch %d." % (t + 1, 0)
+
+            metrics.write(type='epoch', step=step, epoch=t + 1, loss=float(np.mean(train_loss)),
+                          steps=steps_per_epoch, epoch_time=time.time() - start_time, **eval_metrics)
+            metrics.flush()
+
+        print "[Time] Took {} minutes to run." .format((time.time() - start_time) / 60)
+
+        t = step / steps_per_epoch
+        start_time = time.time()
+        train_loss = []
+
+    # A worker can be blocked in a last step on a token of the chief's queue
+    # runner, which has nothing left to aggregate: the chief hands out tokens
+    # until every worker is through, or gives up after --shutdown_timeout
+    sess.run(worker_done_op)
+    if is_chief:
+        deadline = time.time() + args.shutdown_timeout
+        while sess.run(workers_done) < num_workers and time.time() < deadline:
+            sess.run(release_tokens_op)
+            time.sleep(1)
+
+        if sess.run(workers_done) < num_workers:
+            print 'Gave up waiting for {} worker(s) after {} seconds'.format(
+                num_workers - sess.run(workers_done), args.shutdown_timeout)
+        supervisor.request_stop()
+
+    supervisor.stop()
+
+    if evaluator is not None:
+        open(done_marker, 'w').close()
+        print 'Waiting for the checkpoint evaluator to finish...'
+        evaluator.wait()
+
+    if metrics is not None:
+        metrics.close()
+    log.close()
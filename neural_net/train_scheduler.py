@@ -0,0 +1,209 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+from util.helpers import make_dir_if_not_exists
+
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+def split_threads(cores, concurrent_jobs):
+    '''(intra_op_threads, inter_op_threads) for each of [concurrent_jobs] jobs sharing [cores].'''
+    threads = max(cores / concurrent_jobs, 1)
+    # The seq2seq graph has little op-level parallelism, most of a job's share goes to intra-op threads
+    inter_op_threads = 2 if threads >= 4 else 1
+    return threads, inter_op_threads
+
+
+class train_scheduler:
+    '''Runs the train.py jobs of the fold x network matrix, at most
+    [concurrent_jobs] at a time on the CPU, and keeps their status in a JSON file.
+    A job that fails is restarted with --resume_latest up to [max_retries] times.'''
+
+    def __init__(self, jobs, status_file, concurrent_jobs, cores, max_retries=2, train_args=None, log_directory='logs'):
+        self.status_file = status_file
+        self.concurrent_jobs = concurrent_jobs
+        self.max_retries = max_retries
+        self.train_args = train_args or []
+        self.log_directory = log_directory
+        self.intra_op_threads, self.inter_op_threads = split_threads(cores, concurrent_jobs)
+        self.processes = {}
+
+        status = {}
+        if os.path.exists(status_file):
+            with open(status_file) as f:
+                status = json.load(f)
+
+        self.jobs = []
+        for name, data_directory, checkpoints_directory in jobs:
+            job = {'name': name, 'data_directory': data_directory, 'checkpoints_directory': checkpoints_directory,
+                   'state': PENDING, 'attempts': 0}
+
+            # Finished jobs of an earlier run are kept, everything else starts (or resumes) again
+            if status.get(name, {}).get('state') == DONE:
+                job = status[name]
+            elif name in status:
+                job['attempts'] = status[name].get('attempts', 0)
+
+            self.jobs.append(job)
+
+        make_dir_if_not_exists(log_directory)
+        self.write_status()
+
+    def write_status(self):
+        temp_file = self.status_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({job['name']: job for job in self.jobs}, f, indent=4, sort_keys=True)
+        os.rename(temp_file, self.status_file)
+
+    def start(self, job):
+        command = [sys.executable, '-O', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py'),
+                   job['data_directory'], job['checkpoints_directory'], '--cpu',
+                   '--intra_op_threads', str(self.intra_op_threads),
+                   '--inter_op_threads', str(self.inter_op_threads)] + self.train_args
+
+        # Every start after the first picks up from the job's newest checkpoint
+        if job['attempts'] > 0:
+            command.append('--resume_latest')
+
+        env = dict(os.environ)
+        env['CUDA_VISIBLE_DEVICES'] = ''
+        env['OMP_NUM_THREADS'] = str(self.intra_op_threads)
+
+        output_file = os.path.join(self.log_directory, 'scheduler-%s.out' % job['name'])
+        with open(output_file, 'a') as output:
+            self.processes[job['name']] = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, env=env)
+
+        job.update({'state': RUNNING, 'attempts': job['attempts'] + 1, 'pid': self.processes[job['name']].pid,
+                    'start_time': time.time(), 'end_time': None, 'return_code': None, 'output': output_file})
+        print '[Scheduler] Started {} (attempt {}), pid {}'.format(job['name'], job['attempts'], job['pid'])
+
+    def poll(self):
+        for job in self.jobs:
+            if job['state'] != RUNNING:
+                continue
+
+            return_code = self.processes[job['name']].poll()
+            if return_code is None:
+                continue
+
+            del self.processes[job['name']]
+            job.update({'return_code': return_code, 'end_time': time.time(), 'pid': None})
+
+            if return_code == 0:
+                job['state'] = DONE
+            elif job['attempts'] <= self.max_retries:
+                job['state'] = PENDING
+                print '[Scheduler] {} exited with {}, it will resume from its latest checkpoint'.format(job['name'], return_code)
+            else:
+                job['state'] = FAILED
+
+            print '[Scheduler] {}: {} after {:.1f} minutes'.format(job['name'], job['state'],
+                                                                   (job['end_time'] - job['start_time']) / 60)
+
+    def run(self, poll_interval=10):
+        try:
+            while True:
+                self.poll()
+
+                for job in self.jobs:
+                    if len(self.processes) >= self.concurrent_jobs:
+                        break
+                    if job['state'] == PENDING:
+                        self.start(job)
+
+                self.write_status()
+
+                if not self.processes:
+                    break
+
+                time.sleep(poll_interval)
+
+        except KeyboardInterrupt:
+            for name, process in self.processes.items():
+                process.terminate()
+                print '[Scheduler] Terminated', name
+            raise
+
+        finally:
+            for job in self.jobs:
+                if job['state'] == RUNNING and job['name'] not in self.processes:
+                    job['state'] = PENDING
+            self.write_status()
+
+        return [job['name'] for job in self.jobs if job['state'] == FAILED]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Train the typo and ids networks of all folds concurrently on the CPU. '
+                    'Arguments after -- are passed on to train.py.')
+    parser.add_argument('--networks', help='Comma separated networks to train', default='typo,ids')
+    parser.add_argument('--bins', help='Comma separated folds to train', default='0,1,2,3,4')
+    parser.add_argument('--seed', type=int, help='Seed in the name of the data directories', default=1189)
+    parser.add_argument('--data_root', help='Directory with the iitk-<network>-<seed> data', default='data/network_inputs')
+    parser.add_argument('--checkpoints_root', help='Where to put the checkpoints', default='data/checkpoints')
+    parser.add_argument('-j', '--jobs', type=int, help='Jobs to run at the same time (default: all of them, '
+                        'at least one core each)', default=0)
+    parser.add_argument('--cores', type=int, help='Cores to split among the jobs', default=multiprocessing.cpu_count())
+    parser.add_argument('--max_retries', type=int, help='Restarts of a failed job', default=2)
+    parser.add_argument('--status_file', help='Per-job status', default='logs/train-scheduler-status.json')
+    parser.add_argument('--poll_interval', type=int, help='Seconds between status checks', default=10)
+
+    argv = sys.argv[1:]
+    train_args = []
+    if '--' in argv:
+        train_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for network in args.networks.split(','):
+        for binid in args.bins.split(','):
+            dataset = 'iitk-%s-%d' % (network, args.seed)
+            jobs.append(('%s-bin_%s' % (network, binid),
+                         os.path.join(args.data_root, dataset, 'bin_%s' % binid) + '/',
+                         os.path.join(args.checkpoints_root, dataset, 'bin_%s' % binid) + '/'))
+
+    concurrent_jobs = args.jobs if args.jobs > 0 else min(len(jobs), args.cores)
+
+    print 'Jobs                      :', len(jobs)
+    print 'Concurrent jobs           :', concurrent_jobs
+    print 'Cores                     :', args.cores
+    print 'Threads per job           :', split_threads(args.cores, concurrent_jobs)
+    print 'train.py arguments        :', ' '.join(train_args)
+    print 'Status file               :', args.status_file
+
+    scheduler = train_scheduler(jobs, args.status_file, concurrent_jobs, args.cores,
+                                max_retries=args.max_retries, train_args=train_args,
+                                log_directory=os.path.dirname(args.status_file) or '.')
+    failed = scheduler.run(poll_interval=args.poll_interval)
+
+    if failed:
+        print '[Scheduler] Failed:', ', '.join(failed)
+        sys.exit(1)
+    print '[Scheduler] All jobs done.'
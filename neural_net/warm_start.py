@@ -0,0 +1,192 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from neural_net.train import load_data, seq2seq_model, list_checkpoints, model_kwargs_from_args
+from data_processing.training_data_generator_cs import save_pairs
+from util.helpers import make_dir_if_not_exists
+
+
+# Warm-starting a network after the corpus has grown:
+#
+#   python data_processing/training_data_generator_cs.py --extend_dictionary data/network_inputs/iitk-typo-1189
+#   python neural_net/warm_start.py data/checkpoints/iitk-typo-1189/bin_0/ \
+#       data/network_inputs/iitk-typo-1189-extended/bin_0/ \
+#       data/network_inputs/iitk-typo-1189-warm/bin_0/ data/checkpoints/iitk-typo-1189-warm/bin_0/
+#
+# and then run the train.py command it prints.
+
+
+class VocabularyMismatchException(Exception):
+    pass
+
+
+class MissingWeightsException(Exception):
+    pass
+
+
+def check_extends(old_tl_dict, new_tl_dict):
+    for token, index in old_tl_dict.items():
+        if new_tl_dict.get(token) != index:
+            raise VocabularyMismatchException('{}: {} in the old dictionary, {} in the new one'.format(
+                token, index, new_tl_dict.get(token)))
+
+
+def grow(old_value, new_value):
+    '''[new_value] with [old_value] copied into its leading slice along every axis.
+    Rows/columns of new tokens keep their fresh initialization (zeros for Adam slots).'''
+    assert old_value.ndim == new_value.ndim
+    value = new_value.copy()
+    value[tuple(slice(0, dim) for dim in old_value.shape)] = old_value
+    return value
+
+
+def warm_start_checkpoint(old_checkpoint, train_args, which_network, vocabulary_size, destination, step):
+    with tf.variable_scope(which_network):
+        model = seq2seq_model(vocabulary_size, scope=which_network, **model_kwargs_from_args(train_args))
+
+    sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+    sess.run(tf.global_variables_initializer())
+
+    reader = tf.train.NewCheckpointReader(old_checkpoint)
+    old_shapes = reader.get_variable_to_shape_map()
+    trainable = set(tf.trainable_variables())
+
+    missing = [variable.op.name for variable in model.saver._var_list
+               if variable in trainable and variable.op.name not in old_shapes]
+    if missing:
+        raise MissingWeightsException('not in {}: {}'.format(old_checkpoint, ', '.join(missing)))
+
+    for variable in model.saver._var_list:
+        name = variable.op.name
+
+        if name not in old_shapes:
+            print 'Not in the checkpoint, left initialized:', name
+            continue
+
+        old_value = reader.get_tensor(name)
+        new_shape = variable.get_shape().as_list()
+
+        if list(old_value.shape) == new_shape:
+            value = old_value
+        else:
+            # Embedding [vocab, dim], output projection [dim, vocab] and [vocab], and their Adam slots
+            assert all(old_dim <= new_dim for old_dim, new_dim in zip(old_value.shape, new_shape)), \
+                '{}: cannot grow {} into {}'.format(name, old_value.shape, new_shape)
+            value = grow(old_value, sess.run(variable))
+            print 'Grown {} from {} to {}'.format(name, list(old_value.shape), new_shape)
+
+        variable.load(value, sess)
+
+    model.saver.save(sess, os.path.join(destination, 'saved-model-attn'), global_step=step)
+    sess.close()
+
+
+def mix_examples(old_data_directory, new_data_directory, output_directory, new_tl_dict, replay_ratio, rng):
+    '''New training examples plus [replay_ratio] times as many old ones, and the union of the
+    old and new validation and test sets (the new problems are disjoint from the old ones).'''
+    old = load_data(old_data_directory, shuffle=False)
+    new = load_data(new_data_directory, shuffle=False)
+
+    num_replay = min(len(old.train_ex), int(round(replay_ratio * len(new.train_ex))))
+    replay = [old.train_ex[k] for k in rng.choice(len(old.train_ex), num_replay, replace=False)]
+
+    token_vectors = {'train': list(new.train_ex) + replay,
+                     'validation': list(old.valid_ex) + list(new.valid_ex),
+                     'test': list(old.test_ex) + list(new.test_ex)}
+
+    make_dir_if_not_exists(output_directory)
+    save_pairs(output_directory, token_vectors, new_tl_dict)
+
+    problem_ids = {}
+    for data_directory in [old_data_directory, new_data_directory]:
+        if os.path.exists(os.path.join(data_directory, 'problem-ids.npy')):
+            for split, ids in np.load(os.path.join(data_directory, 'problem-ids.npy'), allow_pickle=True).item().items():
+                problem_ids.setdefault(split, []).extend(ids)
+    if problem_ids:
+        np.save(os.path.join(output_directory, 'problem-ids.npy'), problem_ids)
+
+    print 'Train: {} new + {} replayed, Validation: {}, Test: {}'.format(
+        len(new.train_ex), num_replay, len(token_vectors['validation']), len(token_vectors['test']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Initialize a network for a grown corpus from the checkpoint of the previous one.')
+    parser.add_argument('old_checkpoints_directory', help='Checkpoints directory of the trained network')
+    parser.add_argument('new_data_directory',
+                        help='Data directory generated with training_data_generator_cs.py --extend_dictionary')
+    parser.add_argument('output_data_directory', help='Where to write the new + replayed examples')
+    parser.add_argument('checkpoints_directory', help='Checkpoints directory of the warm-started network')
+    parser.add_argument('--old_data_directory',
+                        help='Data the network was trained on (default: from its experiment configuration)', default=None)
+    parser.add_argument('--checkpoint', type=int,
+                        help='Step of the checkpoint to start from (default: the newest in best/)', default=None)
+    parser.add_argument('--replay_ratio', type=float,
+                        help='Old training examples replayed per new one', default=1.0)
+    parser.add_argument('-e', '--epochs', type=int, help='Epochs of fine-tuning', default=20)
+    parser.add_argument('--seed', type=int, help='seed', default=1189)
+
+    args = parser.parse_args()
+
+    configuration = np.load(os.path.join(args.old_checkpoints_directory, 'experiment-configuration.npy'),
+                            allow_pickle=True).item()
+    train_args = configuration['args']
+    which_network = configuration['which_network']
+
+    assert which_network in args.output_data_directory, \
+        'output_data_directory should contain *{}*, train.py tells the networks apart by it'.format(which_network)
+
+    if args.old_data_directory is None:
+        args.old_data_directory = train_args.data_directory
+
+    if args.checkpoint is None:
+        checkpoint = os.path.join(args.old_checkpoints_directory, 'best',
+                                  'saved-model-attn-%d' % list_checkpoints(os.path.join(args.old_checkpoints_directory, 'best'))[-1])
+    else:
+        checkpoint = os.path.join(args.old_checkpoints_directory, 'saved-model-attn-%d' % args.checkpoint)
+        if not os.path.exists(checkpoint + '.meta'):
+            checkpoint = os.path.join(args.old_checkpoints_directory, 'best', 'saved-model-attn-%d' % args.checkpoint)
+    step = int(checkpoint.rsplit('-', 1)[1])
+
+    old_tl_dict = load_data(args.old_data_directory, load_only_dicts=True).get_tl_dictionary()
+    new_tl_dict = load_data(args.new_data_directory, load_only_dicts=True).get_tl_dictionary()
+    check_extends(old_tl_dict, new_tl_dict)
+
+    print 'Checkpoint                :', checkpoint
+    print 'Vocabulary                :', len(old_tl_dict), '->', len(new_tl_dict)
+
+    mix_examples(args.old_data_directory, args.new_data_directory, args.output_data_directory, new_tl_dict,
+                 args.replay_ratio, np.random.RandomState(args.seed))
+
+    make_dir_if_not_exists(args.checkpoints_directory)
+    warm_start_checkpoint(checkpoint, train_args, which_network, len(new_tl_dict), args.checkpoints_directory, step)
+
+    print '\nWarm-started checkpoint written to', os.path.join(args.checkpoints_directory, 'saved-model-attn-%d' % step)
+    print 'Fine-tune with:\n'
+    lstm_rank = getattr(train_args, 'lstm_rank', None)
+    projection_rank = getattr(train_args, 'projection_rank', None)
+    print 'python -O neural_net/train.py {} {} -r {} -re 0 -e {} --embedding_dim {} --memory_dim {} -n {} --cell_type {} -o {} -d {}{}{}'.format(
+        args.output_data_directory, args.checkpoints_directory, step, args.epochs, train_args.embedding_dim,
+        train_args.memory_dim, train_args.num_layers, train_args.cell_type, train_args.max_output_seq_len,
+        train_args.dropout, ' --lstm_rank %d' % lstm_rank if lstm_rank else '',
+        ' --projection_rank %d' % projection_rank if projection_rank else '')
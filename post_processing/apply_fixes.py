@@ -20,7 +20,7 @@ import argparse
 import sqlite3
 import json
 import time
-from util.helpers import tokens_to_source, compilation_errors, apply_fix, logger, InvalidFixLocationException
+from util.helpers import tokens_to_source, compilation_errors, apply_fix, buffered_logger, InvalidFixLocationException
 from post_processing.postprocessing_helpers import meets_criterion, get_final_results
 
 
@@ -30,7 +30,7 @@ parser.add_argument('--is_timing_experiment', action="store_true",
                     help="This is a timing experiment, do not store results")
 args = parser.parse_args()
 
-log = logger(args.database.split('.db')[
+log = buffered_logger(args.database.split('.db')[
              0] + '_results', move_to_logs_dir=False)
 print 'logging into {}'.format(log.log_file)
 sys.stdout = log
@@ -102,9 +102,11 @@ def do_problem(problem_id):
 
         try:
             for fix in fixes_suggested_by_typo_network:
-                if meets_criterion(reconstruction[problem_id][prog_id][-1], fix, 'replace'):
+                # Networks trained with --edit_targets store edit scripts
+                kind = 'edit' if '_<edit>_' in fix else 'replace'
+                if meets_criterion(reconstruction[problem_id][prog_id][-1], fix, kind):
                     temp_prog = apply_fix(
-                        reconstruction[problem_id][prog_id][-1], fix, 'replace')
+                        reconstruction[problem_id][prog_id][-1], fix, kind)
                     temp_errors, temp_errors_full = compilation_errors(
                         tokens_to_source(temp_prog, name_dict, False))
 
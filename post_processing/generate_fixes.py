@@ -24,10 +24,12 @@ import math
 import numpy as np
 import tensorflow as tf
 from data_processing.training_data_generator import vectorize
-from neural_net.train import load_data, seq2seq_model as model
+from neural_net.train import load_data, seq2seq_model as model, model_kwargs_from_args
+from neural_net.quantize import load_quantized, quantized_mode
+from neural_net.tracing import step_tracer
 from post_processing.postprocessing_helpers import devectorize, \
     VectorizationFailedException
-from util.helpers import apply_fix, vstack_with_right_padding, make_dir_if_not_exists
+from util.helpers import apply_fix, vstack_with_right_padding, make_dir_if_not_exists, get_fix_kind
 from util.helpers import InvalidFixLocationException, SubstitutionFailedException
 
 
@@ -42,13 +44,13 @@ parser.add_argument('-w', '--which', help='Which test data.',
 parser.add_argument('-b', '--batch_size', type=int,
                     help="batch_size", default=100)
 parser.add_argument("--embedding_dim", type=int,
-                    help="embedding_dim", default=50)
+                    help="embedding_dim (default: from the experiment configuration)", default=None)
 parser.add_argument('-m', "--memory_dim", type=int,
-                    help="memory_dim", default=300)
+                    help="memory_dim (default: from the experiment configuration)", default=None)
 parser.add_argument('-n', "--num_layers", type=int,
-                    help="num_layers", default=4)
+                    help="num_layers (default: from the experiment configuration)", default=None)
 parser.add_argument('-c', '--cell_type',
-                    help='One of RNN, LSTM or GRU.', default="LSTM")
+                    help='One of LSTM, LSTMBlock, LSTMBlockFused or GRU (default: from the experiment configuration).', default=None)
 parser.add_argument(
     '-v', '--vram', help='Fraction of GPU memory to use', type=float, default=0.9)
 parser.add_argument('-a', '--max_attempts',
@@ -60,9 +62,15 @@ parser.add_argument("-t", "--task", help="Specify the task for which the network
 parser.add_argument("--max_prog_length", type=int,
                     help="maximum length of the programs in tokens", default=450)
 parser.add_argument('-o', '--max_output_seq_len',
-                    help='max_output_seq_len', type=int, default=28)
+                    help='max_output_seq_len (default: from the experiment configuration)', type=int, default=None)
 parser.add_argument('--is_timing_experiment', action="store_true",
                     help="This is a timing experiment, do not store results")
+parser.add_argument('--quantized',
+                    help="Run the int8/float16 weights of this file written by neural_net/quantize.py instead of the checkpoint", default=None)
+parser.add_argument('--trace_batches', type=int,
+                    help="Trace this many sample() calls and write their timelines", default=0)
+parser.add_argument('--trace_directory',
+                    help="Where to write traces (default: <checkpoint_directory>/traces)", default=None)
 
 args = parser.parse_args()
 
@@ -85,6 +93,19 @@ training_args = np.load(os.path.join(
     args.checkpoint_directory, 'experiment-configuration.npy'), allow_pickle=True).item()['args']
 data_directory = training_args.data_directory
 
+# Dimensions of the network in the checkpoint directory, unless overridden
+model_kwargs = model_kwargs_from_args(training_args)
+for arg, kwarg in [('embedding_dim', 'embedding_size'), ('max_output_seq_len', 'max_output_seq_len'),
+                   ('cell_type', 'cell_type'), ('memory_dim', 'memory_dim'), ('num_layers', 'num_layers')]:
+    if getattr(args, arg) is None:
+        setattr(args, arg, model_kwargs[kwarg])
+    else:
+        model_kwargs[kwarg] = getattr(args, arg)
+# lstm_rank and projection_rank always come from the configuration, they must match the checkpoint
+model_kwargs['dropout'] = 0
+if args.quantized is not None:
+    model_kwargs['quantized'] = quantized_mode(args.quantized)
+
 print 'data directory:', data_directory
 
 conn = sqlite3.connect(database)
@@ -139,18 +160,27 @@ dictionary = dataset.get_tl_dictionary()
 scope = 'typo' if 'typo' in data_directory else 'ids'
 
 with tf.variable_scope(scope):
-    seq2seq = model(dataset.vocabulary_size, args.embedding_dim,
-                    args.max_output_seq_len,
-                    cell_type=args.cell_type,
-                    memory_dim=args.memory_dim,
-                    num_layers=args.num_layers,
-                    dropout=0
-                    )
+    seq2seq = model(dataset.vocabulary_size, **model_kwargs)
+
+
+tracer = None
+if args.trace_batches > 0:
+    tracer = step_tracer(args.trace_directory or os.path.join(args.checkpoint_directory, 'traces'),
+                         range(1, args.trace_batches + 1))
+sampled_batches = 0
 
 
 def get_fixes_in_batch(sess, programs):
+    global sampled_batches
+    sampled_batches += 1
+
     X, X_len = tuple(dataset.prepare_batch(programs))
-    fixes = seq2seq.sample(sess, X, X_len)
+    options, run_metadata = tracer.run_options(sampled_batches) if tracer is not None else (None, None)
+    fixes = seq2seq.sample(sess, X, X_len, options=options, run_metadata=run_metadata)
+
+    if run_metadata is not None:
+        tracer.record('sample', sampled_batches, run_metadata)
+
     assert len(programs) == np.shape(fixes)[0]
     return fixes
 
@@ -175,7 +205,10 @@ def get_fixes(sess, programs):
 gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.vram)
 sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
 
-if args.resume_at is None:
+if args.quantized is not None:
+    print 'Loading quantized weights from', args.quantized
+    load_quantized(sess, seq2seq, args.quantized)
+elif args.resume_at is None:
     seq2seq.load_parameters(sess, os.path.join(
         args.checkpoint_directory, 'best', 'saved-model-attn-' + str(best_checkpoint)))
 else:
@@ -195,11 +228,12 @@ fixes_suggested_by_network = {}
 
 if args.task == 'typo':
     normalize_names = True
-    fix_kind = 'replace'
 else:
     assert args.task == 'ids'
     normalize_names = False
-    fix_kind = 'insert'
+
+fix_kind = get_fix_kind(data_directory, args.task)
+print 'fix kind:', fix_kind
 
 times = []
 counts = []
@@ -322,4 +356,7 @@ print 'Average time per program:', int(float(np.sum(times)) / float(np.sum(count
 print
 print 'results for {} dataset saved in {}'.format(args.which, database)
 
+if tracer is not None:
+    tracer.write_summary()
+
 conn.close()
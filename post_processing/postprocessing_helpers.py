@@ -18,7 +18,8 @@ limitations under the License.
 
 import sqlite3
 import numpy as np
-from util.helpers import get_lines, extract_line_number, get_rev_dict, FailedToGetLineNumberException, _truncate_fix
+from util.helpers import get_lines, extract_line_number, get_rev_dict, FailedToGetLineNumberException, _truncate_fix, \
+    edit_fix_to_line_fix, InvalidFixLocationException, SubstitutionFailedException
 import regex as re
 
 
@@ -69,6 +70,16 @@ def meets_criterion(incorrect_program_tokens, fix, type_, silent=True):
     if _is_stop_signal(fix):
         return False
 
+    if type_ == 'edit':
+        # Judge the line the edits produce
+        try:
+            fix = edit_fix_to_line_fix(incorrect_program_tokens, fix)
+        except (InvalidFixLocationException, SubstitutionFailedException):
+            if not silent:
+                print 'edit script does not apply'
+            return False
+        type_ = 'replace'
+
     try:
         fix_line_number = extract_line_number(fix)
     except FailedToGetLineNumberException:
@@ -10,17 +10,18 @@ from pathlib import Path
 from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 from data_processing.training_data_generator_cs import vectorize
-from neural_net.train import load_data, seq2seq_model
+from neural_net.train import load_data, seq2seq_model, model_kwargs_from_args
+from neural_net.quantize import load_quantized, quantized_mode
 from post_processing.postprocessing_helpers import devectorize, meets_criterion
 from util.cs_tokenizer import CS_Tokenizer
-from util.helpers import apply_fix, tokens_to_source, vstack_with_right_padding
+from util.helpers import apply_fix, tokens_to_source, vstack_with_right_padding, get_fix_kind, TokenizedProgram
 
 
 class FixProgress:
 
     def __init__(self, raw_code, raw_error_count, tokenized_code,
                  tokenized_code_2, name_dict, error_count, iteration_count):
-        # type: (str, int, str, str, Dict[str, str], int, int) -> None
+        # type: (str, int, TokenizedProgram, TokenizedProgram, Dict[str, str], int, int) -> None
         self.raw_code = raw_code
         self.raw_error_count = raw_error_count
         self.tokenized_code = tokenized_code
@@ -53,6 +54,8 @@ class FixProgress:
         if error_count == 0:
             return code
         tokenized_code, name_dict, _ = CS_Tokenizer().tokenize(code)
+        # Fixes are applied line by line, without going back to the string each time
+        tokenized_code = TokenizedProgram.from_string(tokenized_code)
         return FixProgress(
             raw_code=code, raw_error_count=error_count,
             tokenized_code=tokenized_code, tokenized_code_2=tokenized_code,
@@ -124,9 +127,7 @@ class MachineWithSingleNetwork:
 
     def get_fix_kind(self):
         # type: () -> str
-        if self.get_task() == 'typo':
-            return 'replace'
-        return 'insert'
+        return get_fix_kind(self.configuration['args'].data_directory, self.get_task())
 
     @staticmethod
     def get_best_checkpoint_identifier(checkpoint_path):
@@ -145,28 +146,33 @@ class MachineWithSingleNetwork:
         return best
 
     @staticmethod
-    def from_checkpoint_directory(path):
-        # type: (Path) -> MachineWithSingleNetwork
+    def from_checkpoint_directory(path, quantized=None):
+        # type: (Path, Optional[str]) -> MachineWithSingleNetwork
         configuration = np.load(path/'experiment-configuration.npy',
                                 allow_pickle=True).item()  # type: Any
         data_directory = configuration['args'].data_directory  # type: str
         dataset = load_data(data_directory, shuffle=False,
                             load_only_dicts=True)
+        model_kwargs = model_kwargs_from_args(configuration['args'])
+        model_kwargs['dropout'] = 0
+        if quantized is not None:
+            model_kwargs['quantized'] = quantized_mode(quantized)
         with tf.variable_scope(configuration['which_network']):
-            raw_model = seq2seq_model(
-                dataset.vocabulary_size, 50, 28, cell_type='LSTM',
-                memory_dim=300, num_layers=4, dropout=0)
+            raw_model = seq2seq_model(dataset.vocabulary_size, **model_kwargs)
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.9)
         session = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
-        best = MachineWithSingleNetwork.get_best_checkpoint_identifier(path)
-        best = str(path/'best'/'saved-model-attn-{}'.format(best))
-        raw_model.load_parameters(session, best)
+        if quantized is not None:
+            load_quantized(session, raw_model, quantized)
+        else:
+            best = MachineWithSingleNetwork.get_best_checkpoint_identifier(path)
+            best = str(path/'best'/'saved-model-attn-{}'.format(best))
+            raw_model.load_parameters(session, best)
         return MachineWithSingleNetwork(
             configuration=configuration, dataset=dataset,
             raw_model=raw_model, tf_session=session)
 
     def vectorize(self, tokenized_code):
-        # type: (str) -> Optional[List[int]]
+        # type: (TokenizedProgram) -> Optional[List[int]]
         try:
             return vectorize(tokenized_code, self.get_dictionary(), 450,
                              self.is_id_dropped(), reverse=True)
@@ -230,7 +236,7 @@ class MachineWithSingleNetwork:
                 if self.get_task() != 'typo':
                     raise NotImplementedError
                 if not meets_criterion(fix_progress.tokenized_code,
-                                       fix, 'replace'):
+                                       fix, self.get_fix_kind()):
                     indices_unneeded_to_fix.append(i)
                     continue
                 error_count_new = FixProgress.get_error_count(tokens_to_source(
@@ -277,8 +283,11 @@ def main():
     code_paths_with_pieces_of_code =\
         get_code_paths_with_pieces_of_code(Path(sys.argv[1]))
     checkpoint_path = Path('data/checkpoints/iitk-typo-1189/bin_0/')
+    # Optional second argument: weights written by neural_net/quantize.py
+    quantized = sys.argv[2] if len(sys.argv) > 2 else None
     machine =\
-        MachineWithSingleNetwork.from_checkpoint_directory(checkpoint_path)
+        MachineWithSingleNetwork.from_checkpoint_directory(checkpoint_path,
+                                                           quantized)
     print(into_json(zip(
         (path for path, _ in code_paths_with_pieces_of_code),
         machine.process_many(code for _, code in
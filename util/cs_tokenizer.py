@@ -24,6 +24,9 @@ Token = collections.namedtuple('Token', ['typ', 'value', 'line', 'column'])
 
 
 class CS_Tokenizer(Tokenizer):
+    # Bump whenever tokenize() changes its output, see util/tokenized_cache.py
+    version = 1
+
     _keywords = ['abstract', 'add', 'alias', 'as', 'ascending', 'async',
                  'await', 'base', 'break', 'by', 'case', 'catch', 'checked',
                  'class', 'const', 'continue', 'default', 'delegate',
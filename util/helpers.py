@@ -16,10 +16,18 @@ limitations under the License.
 """
 
 import os
+import csv
+import json
+import atexit
+import threading
+import Queue
 import tempfile
 import time
 import sys
 import subprocess32 as subprocess
+import difflib
+import bisect
+import zlib
 import numpy as np
 
 
@@ -65,6 +73,9 @@ def compilation_errors(string):
 # Input: tokenized program
 # Returns: array of lines, each line is tokenized
 def get_lines(program_string):
+    if isinstance(program_string, TokenizedProgram):
+        return program_string.lines()
+
     lines = []
     ignore_tokens = [str(n) for n in range(10)]
     for token in program_string.split():
@@ -95,6 +106,9 @@ def recompose_program(lines):
 
 # Fetches a specific line from the program
 def fetch_line(program_string, line_number, include_line_number=True):
+    if isinstance(program_string, TokenizedProgram):
+        return program_string.fetch_line(line_number, include_line_number)
+
     result = ''
 
     if include_line_number:
@@ -107,6 +121,240 @@ def fetch_line(program_string, line_number, include_line_number=True):
     # assert result.strip() != ''
     return result
 
+
+# Every token string gets one integer id, shared by all TokenizedPrograms.
+# The table is never trimmed, since ids must stay valid for the life of the
+# programs holding them: it keeps every distinct token the process has seen.
+# Abstract tokens (_<op>_;, _<id>_3@) are few, but the numbers and literals a
+# tokenizer keeps are not, so a long-running process such as the proc_cs.py
+# server grows with the distinct tokens of the programs it is sent.
+_token_ids = {}
+_id_tokens = []
+
+
+def intern_token(token):
+    try:
+        return _token_ids[token]
+    except KeyError:
+        _token_ids[token] = len(_id_tokens)
+        _id_tokens.append(token)
+        return _token_ids[token]
+
+
+def token_ids_to_string(token_ids):
+    return ' '.join(_id_tokens[token_id] for token_id in token_ids)
+
+
+class TokenizedProgram(object):
+    '''A tokenized program as one tuple of token ids per line, so that a line
+    is fetched, replaced or inserted without re-splitting the whole program.
+
+    Converts to and from the string format: from_string() reads what get_lines()
+    reads, lines()/fetch_line() return what get_lines()/fetch_line() return and
+    to_string() returns what recompose_program() returns. A line can be indexed,
+    assigned and inserted like the list get_lines() returns.'''
+
+    __slots__ = ('_lines',)
+
+    def __init__(self, lines=()):
+        self._lines = [tuple(line) for line in lines]
+
+    @classmethod
+    def from_string(cls, program_string):
+        lines = []
+        ignore_tokens = [str(n) for n in range(10)]
+        for token in program_string.split():
+            if token == '~':
+                lines.append([])
+            elif token not in ignore_tokens:
+                lines[-1].append(intern_token(token))
+        return cls(lines)
+
+    @classmethod
+    def from_lines(cls, lines):
+        return cls([cls._line_ids(line) for line in lines])
+
+    @staticmethod
+    def _line_ids(line):
+        if isinstance(line, tuple):
+            return line
+        return tuple(intern_token(token) for token in line.split())
+
+    def copy(self):
+        program = TokenizedProgram()
+        program._lines = list(self._lines)
+        return program
+
+    def __len__(self):
+        return len(self._lines)
+
+    def get_line_ids(self, line_number):
+        return self._lines[line_number]
+
+    def get_line(self, line_number):
+        line = token_ids_to_string(self.get_line_ids(line_number))
+        # get_lines() leaves the last line unstripped
+        if line and line_number in (-1, len(self) - 1):
+            line += ' '
+        return line
+
+    __getitem__ = get_line
+
+    def replace_line(self, line_number, line):
+        '''[line] is a token string or a tuple of token ids.'''
+        self._lines[line_number] = self._line_ids(line)
+
+    __setitem__ = replace_line
+
+    def insert_line(self, line_number, line):
+        self._lines.insert(line_number, self._line_ids(line))
+
+    insert = insert_line
+
+    def fetch_line(self, line_number, include_line_number=True):
+        if not include_line_number:
+            return self.get_line(line_number)
+        return ' '.join(str(line_number)) + ' ~ ' + self.get_line(line_number)
+
+    def lines(self):
+        return [self.get_line(i) for i in range(len(self))]
+
+    def tokens(self):
+        '''The token list of to_string(), line numbers and ~ included.'''
+        tokens = []
+        for i in range(len(self)):
+            tokens += list(str(i))
+            tokens.append('~')
+            tokens += [_id_tokens[token_id] for token_id in self.get_line_ids(i)]
+        return tokens
+
+    def token_count(self):
+        '''len(tokens())'''
+        return sum(map(len, self._lines)) + len(''.join(map(str, range(len(self._lines))))) + len(self._lines)
+
+    def to_string(self):
+        return ''.join(' '.join(str(i)) + ' ~ ' + line + ' ' for i, line in enumerate(self.lines()))
+
+    __str__ = to_string
+
+    def __eq__(self, other):
+        return isinstance(other, TokenizedProgram) and self._lines == other._lines
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self._lines))
+
+    def __reduce__(self):
+        # Token ids are only valid in the process that interned them
+        return _tokenized_program_from_string, (self.to_string(),)
+
+
+def _tokenized_program_from_string(program_string):
+    return TokenizedProgram.from_string(program_string)
+
+
+class ProgramDelta(TokenizedProgram):
+    '''A variant of a [base] TokenizedProgram, stored as the lines it replaces
+    and optionally a renaming of tokens, instead of as a copy of the program:
+    the variants of one program share it. Reads like a TokenizedProgram
+    (vectorize() gets its tokens() without building a string); copy() returns
+    the materialized TokenizedProgram, which can be edited.'''
+
+    __slots__ = ('base', 'edits', 'rename')
+
+    def __init__(self, base, edits=None, rename=None):
+        self.base = base
+        # ((line number, token ids), ...) from {line number: token ids}
+        self.edits = tuple(sorted(edits.items())) if edits else ()
+        # (token id, new token id, token id, new token id, ...) or None
+        self.rename = rename
+
+    @classmethod
+    def between(cls, base, program):
+        '''The delta from [base] to a TokenizedProgram with as many lines.'''
+        assert len(base) == len(program), 'a ProgramDelta replaces lines, it does not add or remove them'
+        return cls(base, {line: token_ids for line, (token_ids, base_token_ids) in enumerate(zip(program._lines, base._lines))
+                          if token_ids != base_token_ids})
+
+    def __len__(self):
+        return len(self.base)
+
+    def _renaming(self):
+        return dict(zip(self.rename[::2], self.rename[1::2]))
+
+    def get_line_ids(self, line_number):
+        if line_number < 0:
+            line_number += len(self.base)
+        edits = dict(self.edits)
+        line = edits[line_number] if line_number in edits else self.base.get_line_ids(line_number)
+        if self.rename is None:
+            return line
+        renaming = self._renaming()
+        return tuple(renaming.get(token_id, token_id) for token_id in line)
+
+    def renamed(self, rename):
+        '''The same variant with the tokens in the {token: token} [rename] replaced.'''
+        assert self.rename is None, 'already renamed'
+        renaming = sorted((intern_token(old), intern_token(new)) for old, new in rename.items())
+        return ProgramDelta(self.base, dict(self.edits), tuple(token_id for pair in renaming for token_id in pair))
+
+    def materialize(self):
+        lines = list(self.base._lines)
+        for line, token_ids in self.edits:
+            lines[line] = token_ids
+        if self.rename is not None:
+            renaming = self._renaming()
+            lines = [tuple(renaming.get(token_id, token_id) for token_id in line) for line in lines]
+        return TokenizedProgram(lines)
+
+    copy = materialize
+
+    # Whole-program reads renaming every line once
+    def lines(self):
+        return self.materialize().lines()
+
+    def tokens(self):
+        return self.materialize().tokens()
+
+    def token_count(self):
+        return self.base.token_count() + sum(len(token_ids) - len(self.base.get_line_ids(line))
+                                             for line, token_ids in self.edits)
+
+    def replace_line(self, line_number, line):
+        raise TypeError('a ProgramDelta is read-only, edit its copy()')
+
+    __setitem__ = insert_line = insert = replace_line
+
+    # Equal to another delta with the same edits of an equal base, the set of
+    # variants of a program is kept without materializing them
+    def __eq__(self, other):
+        return (isinstance(other, ProgramDelta) and (other.base is self.base or other.base == self.base)
+                and self.edits == other.edits and self.rename == other.rename)
+
+    def __hash__(self):
+        return hash((self.edits, self.rename))
+
+    def __reduce__(self):
+        edits = [(line, token_ids_to_string(token_ids)) for line, token_ids in self.edits]
+        rename = [_id_tokens[token_id] for token_id in self.rename] if self.rename is not None else None
+        return _program_delta_from_strings, (self.base, edits, rename)
+
+
+def _program_delta_from_strings(base, edits, rename):
+    delta = ProgramDelta(base, {line: TokenizedProgram._line_ids(tokens) for line, tokens in edits})
+    return delta.renamed(dict(zip(rename[::2], rename[1::2]))) if rename is not None else delta
+
+
+def program_tokens(program):
+    '''Tokens of a program string or TokenizedProgram, line numbers and ~ included.'''
+    return program.tokens() if isinstance(program, TokenizedProgram) else program.split()
+
+
+def count_tokens(program):
+    return program.token_count() if isinstance(program, TokenizedProgram) else len(program.split())
+
 # Input: tokenized program
 # Returns: source code, optionally clang-formatted
 
@@ -121,7 +369,7 @@ def tokens_to_source(tokens, name_dict, clang_format=False, name_seq=None):
     for k, v in name_dict.iteritems():
         reverse_name_dict[v] = k
 
-    for token in tokens.split():
+    for token in program_tokens(tokens):
         try:
             prev_type_was_op = (type_ == 'op')
 
@@ -212,22 +460,93 @@ def extract_line_number(line):
 # fix_string is the token string of the fix
 # program_string is the token string of the program
 def fix_ids_are_in_program(program_string, fix_string):
-    prog_ids = []
-    fix_ids = []
+    prog_ids = set(token for token in program_string.split() if '_<id>_' in token)
+    return all(fix_id in prog_ids for fix_id in get_ids(fix_string))
 
-    for token in program_string.split():
-        if '_<id>_' in token and token not in prog_ids:
-            prog_ids.append(token)
 
-    for token in fix_string.split():
-        if '_<id>_' in token and token not in fix_ids:
-            fix_ids.append(token)
+def get_ids(token_string):
+    return [token for token in token_string.split() if '_<id>_' in token]
+
+
+def _first_columns(tokens):
+    columns = {}
+    for column, token in enumerate(tokens):
+        if '_<id>_' in token and token not in columns:
+            columns[token] = column
+    return columns
+
+
+class IdOccurrenceIndex(object):
+    '''For every _<id>_ token of a program, the (sorted) lines it occurs on and
+    its first column on each of them.
+
+    update_line() re-indexes a line that changed; copy() shares everything that
+    a later update_line() replaces rather than modifies.'''
+
+    def __init__(self, lines):
+        '''[lines] are token lists, or token strings as get_lines() returns them.'''
+        self.lines_of = {}
+        self.columns = {}
+        self.ids_on_line = []
+
+        for line, tokens in enumerate(lines):
+            columns = _first_columns(tokens.split() if isinstance(tokens, basestring) else tokens)
+            self.ids_on_line.append(columns)
+
+            for id_, column in columns.items():
+                self.lines_of.setdefault(id_, []).append(line)
+                self.columns.setdefault(id_, {})[line] = column
+
+    @classmethod
+    def from_program(cls, program):
+        return cls(get_lines(program))
 
-    for fix_id in fix_ids:
-        if fix_id not in prog_ids:
-            return False
+    def copy(self):
+        index = IdOccurrenceIndex(())
+        index.lines_of = dict(self.lines_of)
+        index.columns = dict(self.columns)
+        index.ids_on_line = list(self.ids_on_line)
+        return index
 
-    return True
+    def update_line(self, line, tokens):
+        new_columns = _first_columns(tokens)
+
+        for id_ in set(self.ids_on_line[line]) | set(new_columns):
+            lines = [each for each in self.lines_of.get(id_, []) if each != line]
+            columns = dict(self.columns.get(id_, {}))
+            columns.pop(line, None)
+
+            if id_ in new_columns:
+                bisect.insort(lines, line)
+                columns[line] = new_columns[id_]
+
+            if lines:
+                self.lines_of[id_], self.columns[id_] = lines, columns
+            else:
+                del self.lines_of[id_], self.columns[id_]
+
+        self.ids_on_line[line] = new_columns
+
+    def first_line(self, id_):
+        return self.lines_of[id_][0] if id_ in self.lines_of else None
+
+    def last_line(self, id_):
+        return self.lines_of[id_][-1] if id_ in self.lines_of else None
+
+    def occurrence_lines(self, id_):
+        return self.lines_of.get(id_, [])
+
+    def all_occur_from(self, ids, line):
+        '''fix_ids_are_in_program() for the program from [line] on.'''
+        return all(id_ in self.lines_of and self.lines_of[id_][-1] >= line for id_ in ids)
+
+    def first_occurrence_from(self, id_, line):
+        '''(line, column) of the first occurrence of [id_] at or after [line], or None.'''
+        lines = self.lines_of.get(id_, [])
+        k = bisect.bisect_left(lines, line)
+        if k == len(lines):
+            return None
+        return lines[k], self.columns[id_][lines[k]]
 
 
 def replace_ids(new_line, old_line):
@@ -266,13 +585,124 @@ def _truncate_fix(fix):
     return result.strip()
 
 
+# Edit-script fixes: '<line number> ~ <op> _<pos>_<index> [token] ...' where
+# <op> is one of the tokens below and <index> is the position of a token in the
+# (incorrect) line. Insertions go in front of the token at <index>, which may
+# be one past the end of the line.
+EDIT_OPS = ['_<edit>_ins', '_<edit>_del', '_<edit>_rep']
+
+
+def line_to_edit_script(old_line, new_line):
+    old_tokens, new_tokens = old_line.split(), new_line.split()
+    script = []
+
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            continue
+
+        common = min(i2 - i1, j2 - j1)
+
+        for k in range(common):
+            script += ['_<edit>_rep', '_<pos>_%d' % (i1 + k), new_tokens[j1 + k]]
+        for i in range(i1 + common, i2):
+            script += ['_<edit>_del', '_<pos>_%d' % i]
+        for j in range(j1 + common, j2):
+            script += ['_<edit>_ins', '_<pos>_%d' % i2, new_tokens[j]]
+
+    return ' '.join(script)
+
+
+def apply_edit_script(line, script):
+    tokens = line.split()
+    script = script.split()
+    insertions, changes = {}, {}
+    i = 0
+
+    while i < len(script):
+        op = script[i]
+        if op not in EDIT_OPS or i + 1 >= len(script) or not script[i + 1].startswith('_<pos>_'):
+            raise SubstitutionFailedException('malformed edit script: %s' % ' '.join(script))
+
+        try:
+            position = int(script[i + 1][len('_<pos>_'):])
+        except ValueError:
+            raise SubstitutionFailedException('malformed edit script: %s' % ' '.join(script))
+
+        if op == '_<edit>_del':
+            token, i = None, i + 2
+        elif i + 2 < len(script):
+            token, i = script[i + 2], i + 3
+        else:
+            raise SubstitutionFailedException('edit without a token: %s' % ' '.join(script))
+
+        if op == '_<edit>_ins':
+            if position > len(tokens):
+                raise SubstitutionFailedException('insertion past the end of the line')
+            insertions.setdefault(position, []).append(token)
+        else:
+            if position >= len(tokens) or position in changes:
+                raise SubstitutionFailedException('bad position in edit script')
+            changes[position] = token
+
+    result = []
+    for position in range(len(tokens) + 1):
+        result += insertions.get(position, [])
+        if position < len(tokens):
+            if position not in changes:
+                result.append(tokens[position])
+            elif changes[position] is not None:
+                result.append(changes[position])
+
+    return ' '.join(result)
+
+
+def line_fix_to_edit_fix(program, fix):
+    line_number = extract_line_number(fix)
+    line = program.get_line(line_number) if isinstance(program, TokenizedProgram) else get_lines(program)[line_number]
+    return '%s ~ %s' % (fix.split('~')[0].strip(), line_to_edit_script(line, _remove_line_number(fix)))
+
+
+def edit_fix_to_line_fix(program, fix):
+    '''The whole-line ('replace') fix an edit-script fix amounts to.'''
+    fix = _truncate_fix(fix)
+
+    if len(fix.split('~')) != 2:
+        raise InvalidFixLocationException
+
+    try:
+        fix_location = extract_line_number(fix)
+    except FailedToGetLineNumberException:
+        raise InvalidFixLocationException
+
+    lines = program if isinstance(program, TokenizedProgram) else get_lines(program)
+    if fix_location >= len(lines):
+        raise InvalidFixLocationException
+
+    return '%s ~ %s' % (fix.split('~')[0].strip(), apply_edit_script(lines[fix_location], _remove_line_number(fix)))
+
+
+def get_fix_kind(data_directory, task):
+    '''apply_fix() kind of the fixes the network trained on [data_directory] outputs.'''
+    if task != 'typo':
+        return 'insert'
+
+    fix_kind_file = os.path.join(data_directory, 'fix-kind.npy')
+    if os.path.exists(fix_kind_file):
+        return str(np.load(fix_kind_file))
+    return 'replace'
+
+
 def apply_fix(program, fix, kind='replace', flag_replace_ids=True):
-    # Break up program string into lines
-    lines = get_lines(program)
+    # Break up program string into lines, a TokenizedProgram is edited (and returned) as a copy
+    lines = program.copy() if isinstance(program, TokenizedProgram) else get_lines(program)
 
     # Truncate the fix
     fix = _truncate_fix(fix)
 
+    if kind == 'edit':
+        fix = edit_fix_to_line_fix(program, fix)
+        kind = 'replace'
+
     # Make sure there are two parts
     if len(fix.split('~')) != 2:
         # print 'cant partition in 2 on ~'
@@ -315,9 +745,16 @@ def apply_fix(program, fix, kind='replace', flag_replace_ids=True):
         assert kind == 'insert'
         lines.insert(fix_location + 1, fix)
 
+    if isinstance(lines, TokenizedProgram):
+        return lines
     return recompose_program(lines)
 
 
+def problem_rng(seed, problem_id):
+    '''A random stream of its own for every problem, the same in any process.'''
+    return np.random.RandomState([seed, zlib.crc32(str(problem_id)) & 0xffffffff])
+
+
 def make_dir_if_not_exists(path):
     try:
         os.makedirs(path)
@@ -394,6 +831,147 @@ class logger():
         self.handle.flush()
 
 
+class buffered_logger(logger):
+    '''Drop-in replacement for logger: writes are queued and done by a background
+    thread, which flushes the log-file every [flush_interval] seconds and writes
+    to the terminal at most once every [terminal_interval] seconds. The queue is
+    drained on close() and at interpreter exit, including after a crash.'''
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, log_file, move_to_logs_dir=True, flush_interval=1.0, terminal_interval=0.0):
+        self.flush_interval = flush_interval
+        self.terminal_interval = terminal_interval
+        self.queue = Queue.Queue()
+        self.writer = None
+
+        logger.__init__(self, log_file, move_to_logs_dir)
+
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+        atexit.register(self._close_at_exit)
+
+    def _write_loop(self):
+        terminal_buffer = []
+        last_flush = last_terminal_write = time.time()
+
+        while True:
+            try:
+                message = self.queue.get(timeout=self.flush_interval)
+            except Queue.Empty:
+                message = None
+
+            if message is not None and message is not self._FLUSH and message is not self._STOP:
+                self.handle.write(message)
+                terminal_buffer.append(message)
+
+            now = time.time()
+            stopping = message is self._STOP
+
+            if terminal_buffer and (stopping or message is self._FLUSH or now - last_terminal_write >= self.terminal_interval):
+                self.terminal.write(''.join(terminal_buffer))
+                self.terminal.flush()
+                terminal_buffer = []
+                last_terminal_write = now
+
+            if stopping or message is self._FLUSH or now - last_flush >= self.flush_interval:
+                self.handle.flush()
+                last_flush = now
+
+            if stopping:
+                return
+
+    def _close_at_exit(self):
+        if self.open:
+            self.close()
+
+    def close(self):
+        if self.writer is not None and self.writer.is_alive():
+            self.queue.put(self._STOP)
+            self.writer.join()
+        logger.close(self)
+
+    # for backward compatibility
+    def log(self, *msg_list):
+        self.write(' '.join(map(str, msg_list)) + '\n')
+
+    # set ** sys.stdout = buffered_logger(filename) ** and then simply use print call
+    def write(self, message):
+        if not self.open:
+            self._open()
+
+        if self.writer is None or not self.writer.is_alive():
+            logger.write(self, message)
+        else:
+            self.queue.put(message)
+
+    # Asks the background writer to flush, without waiting for it
+    def flush(self):
+        if self.writer is None or not self.writer.is_alive():
+            logger.flush(self)
+        else:
+            self.queue.put(self._FLUSH)
+
+
+class metrics_writer():
+    '''Appends one record per call to a JSONL file, or to a CSV file with
+    columns [fields] if metrics_file ends with .csv'''
+
+    def __init__(self, metrics_file, fields=None):
+        self.metrics_file = metrics_file
+        self.format = 'csv' if metrics_file.endswith('.csv') else 'jsonl'
+
+        if os.path.dirname(metrics_file):
+            make_dir_if_not_exists(os.path.dirname(metrics_file))
+
+        write_header = not os.path.exists(metrics_file) or os.path.getsize(metrics_file) == 0
+        self.handle = open(metrics_file, 'a+')
+
+        if self.format == 'csv':
+            assert fields is not None, 'fields are required for csv metrics files'
+            self.writer = csv.DictWriter(self.handle, fieldnames=['time'] + list(fields), extrasaction='ignore')
+            if write_header:
+                self.writer.writeheader()
+
+    def write(self, **record):
+        record['time'] = time.time()
+
+        if self.format == 'csv':
+            self.writer.writerow(record)
+        else:
+            # default=float takes care of numpy scalars
+            self.handle.write(json.dumps(record, sort_keys=True, default=float) + '\n')
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
+
+
+def read_metrics(metrics_file):
+    '''The records of a metrics_writer file, with the numbers of a .csv file parsed back.'''
+    with open(metrics_file) as f:
+        if not metrics_file.endswith('.csv'):
+            return [json.loads(line) for line in f if line.strip()]
+
+        records = []
+        for row in csv.DictReader(f):
+            record = {}
+            for key, value in row.items():
+                if value == '':
+                    continue
+                try:
+                    record[key] = float(value)
+                except ValueError:
+                    record[key] = value
+            records.append(record)
+        return records
+
+
 def get_rev_dict(dict_):
     assert len(dict_) > 0, 'passed dict has size zero'
     rev_dict_ = {}
@@ -455,11 +1033,7 @@ def get_accuracy(Y, Y_hat, which):
     Y, Y_hat, batch_size = make_equal_size_matrices(Y, Y_hat)
 
     if which == 'sequence':
-        accuracy = 0.0
-        for y, y_hat in zip(Y, Y_hat):
-            if np.array_equal(y, y_hat):
-                accuracy += 1.0
-        return accuracy / float(batch_size)
+        return np.sum(np.all(np.equal(Y, Y_hat), axis=1)) / float(batch_size)
 
     elif which == 'token':
         return np.sum(np.equal(Y, Y_hat)) / float(np.prod(np.shape(Y)))
@@ -506,3 +1080,54 @@ class Accuracy_calculator_for_deepfix():
             self.get_df_fix(y), self.get_df_fix(y_hat))
 
         return localization_equality, fix_equality
+
+    def get_all_accuracies_batch(self, Y, Y_hat):
+        '''get_all_accuracies() for every row of two [batch_size X seq_len] matrices at once,
+        returns two boolean arrays. As there, everything after the first tilde except
+        other tildes (_eos_ and padding included) is the fix, and two rows without any
+        tilde agree on both. Matrices of different widths (e.g. targets and a decoding
+        of another length) are right-padded to a common one with -1, which is no token.'''
+        Y, Y_hat = np.asarray(Y), np.asarray(Y_hat)
+
+        if len(Y) == 0:
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+
+        if np.ndim(Y) != 2 or np.ndim(Y_hat) != 2:
+            # Rows of different lengths
+            return tuple(np.array(result, dtype=bool) for result in
+                         zip(*[self.get_all_accuracies(y, y_hat) for y, y_hat in zip(Y, Y_hat)]))
+
+        seq_len = max(np.shape(Y)[1], np.shape(Y_hat)[1])
+        Y = np.pad(Y.astype(np.int64), ((0, 0), (0, seq_len - np.shape(Y)[1])), 'constant', constant_values=-1)
+        Y_hat = np.pad(Y_hat.astype(np.int64), ((0, 0), (0, seq_len - np.shape(Y_hat)[1])), 'constant',
+                       constant_values=-1)
+        positions = np.arange(seq_len)
+
+        def tilde_masks(M):
+            is_tilde = np.equal(M, self.tilde_token)
+            has_tilde = np.any(is_tilde, axis=1)
+            first_tilde = np.where(has_tilde, np.argmax(is_tilde, axis=1), seq_len)
+            return is_tilde, has_tilde, first_tilde
+
+        def compact_fix(M, is_tilde, first_tilde):
+            # Moves the fix tokens of each row to its front, -1 fills the rest
+            fix_mask = (positions[np.newaxis, :] > first_tilde[:, np.newaxis]) & ~is_tilde
+            fix = np.full(np.shape(M), -1, dtype=np.int64)
+            rows, _ = np.nonzero(fix_mask)
+            fix[rows, np.cumsum(fix_mask, axis=1)[fix_mask] - 1] = M[fix_mask]
+            return fix
+
+        is_tilde_y, has_tilde_y, first_tilde_y = tilde_masks(Y)
+        is_tilde_y_hat, has_tilde_y_hat, first_tilde_y_hat = tilde_masks(Y_hat)
+
+        mismatch = np.not_equal(Y, Y_hat)
+        first_mismatch = np.where(np.any(mismatch, axis=1), np.argmax(mismatch, axis=1), seq_len)
+
+        localization_equality = (has_tilde_y & has_tilde_y_hat & (first_tilde_y == first_tilde_y_hat) &
+                                 (first_mismatch >= first_tilde_y)) | (~has_tilde_y & ~has_tilde_y_hat)
+
+        fix_equality = localization_equality & np.all(
+            np.equal(compact_fix(Y, is_tilde_y, first_tilde_y),
+                     compact_fix(Y_hat, is_tilde_y_hat, first_tilde_y_hat)), axis=1)
+
+        return localization_equality, fix_equality
@@ -0,0 +1,80 @@
+"""
+Copyright 2017 Rahul Gupta, Soham Pal, Aditya Kanade, Shirish Shevade.
+Indian Institute of Science.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import sqlite3
+import cPickle as pickle
+
+
+# (tokenized_code, name_dict, name_seq) of tokenizer.tokenize(source), kept in
+# an sqlite file across runs and in a dict within one. Entries are keyed by the
+# sha1 of the source and tokenizer.version, so changing the tokenizer (and
+# bumping its version) invalidates them without deleting the file.
+
+TOKENIZED_CACHE = 'data/cs-tokenized-cache.db'
+
+
+class TokenizedCache(object):
+
+    def __init__(self, tokenizer, path=TOKENIZED_CACHE, max_memo=100000):
+        self.tokenizer = tokenizer
+        self.version = tokenizer.version
+        self.path = path
+        self.memo = {}
+        # For a corpus read lazily, see data_processing/cs_corpus.py
+        self.max_memo = max_memo
+
+        with self.connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS Tokenized '
+                         '(source_sha1 TEXT, version INTEGER, tokenized BLOB, PRIMARY KEY (source_sha1, version));')
+
+    def connect(self):
+        # Shards of data_processing/sharded_generation_cs.py may share the file
+        return sqlite3.connect(self.path, timeout=600)
+
+    @staticmethod
+    def key(code):
+        return hashlib.sha1(code.encode('utf-8') if isinstance(code, unicode) else code).hexdigest()
+
+    def tokenize(self, code):
+        return self.tokenize_many([code])[0]
+
+    def tokenize_many(self, codes):
+        '''[tokenizer.tokenize(code) for code in codes], only tokenizing what is in neither the memo nor the file.'''
+        keys = [self.key(code) for code in codes]
+        missing = set(key for key in keys if key not in self.memo)
+
+        if missing and len(self.memo) + len(missing) > self.max_memo:
+            self.memo = {key: self.memo[key] for key in keys if key in self.memo}
+
+        if missing:
+            with self.connect() as conn:
+                query = 'SELECT tokenized FROM Tokenized WHERE source_sha1=? and version=?;'
+                for key in missing:
+                    row = conn.execute(query, (key, self.version)).fetchone()
+                    if row is not None:
+                        self.memo[key] = pickle.loads(str(row[0]))
+
+                new_rows = []
+                for key, code in zip(keys, codes):
+                    if key not in self.memo:
+                        self.memo[key] = self.tokenizer.tokenize(code)
+                        new_rows.append((key, self.version, sqlite3.Binary(pickle.dumps(self.memo[key], 2))))
+
+                conn.executemany('INSERT OR REPLACE INTO Tokenized VALUES (?,?,?);', new_rows)
+
+        return [self.memo[key] for key in keys]